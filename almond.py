@@ -3,6 +3,12 @@ from argparse import (
     ArgumentDefaultsHelpFormatter,
 )
 
+from recorder.admission import DiskSpaceAdmission
+from recorder.archive import ArchiveIndex
+from recorder.backends import capture_backends
+from recorder.instrument import metrics
+from recorder.scheduler import RecordingScheduler, load_jobs
+
 
 class AlmondArgumentParser(object):
 
@@ -11,10 +17,34 @@ class AlmondArgumentParser(object):
         self.build_parser()
 
     def build_parser(self):
-        pass
+        self.parser.add_argument('-j', '--jobs', required=True, help='job list file in JSON')
+        self.parser.add_argument('-w', '--workers', type=int, default=4, help='maximum simultaneous recordings')
+        self.parser.add_argument('--lead-time', type=float, default=5, help='seconds to resolve urls in advance')
+
+        # ffmpeg argument
+        self.parser.add_argument('--ffmpeg-path', nargs='?')
+
+        # MPlayer arguments
+        self.parser.add_argument('--mplayer-path', nargs='?')
+        self.parser.add_argument('--mplayer-cache-size', nargs='?', type=int)
+
+        # AudioStreamRecorder argument
+        self.parser.add_argument('--backend', nargs='?', choices=sorted(capture_backends))
+        self.parser.add_argument('--work-path', nargs='?')
+
+        # recordings under this directory are indexed in its ArchiveIndex
+        self.parser.add_argument('--archive', nargs='?', help='recording directory')
+
+        # jobs fail at their start if their space is not free
+        self.parser.add_argument('--headroom', type=int, nargs='?', help='MB always left free')
+        self.parser.add_argument('--evict', action='store_true', help='remove the oldest recordings of --archive')
+
+        # timers and counters
+        self.parser.add_argument('--metrics', nargs='?', help='metrics output file')
+        self.parser.add_argument('--metrics-format', choices=metrics.formats, default='jsonl')
 
     def parse_args(self):
-        return self.parser.parse_args(namespace='almond')
+        return self.parser.parse_args()
 
 
 class AlmondRecorder(object):
@@ -23,7 +53,37 @@ class AlmondRecorder(object):
         self.parser = AlmondArgumentParser()
 
     def run(self):
-        args = self.parser.parse_args()
+        args = vars(self.parser.parse_args())
+
+        if args['metrics']:
+            metrics.enable(args['metrics'], args['metrics_format'])
+
+        # extract kwargs
+        kwargs = {}
+        kws = ('ffmpeg_path', 'mplayer_path', 'mplayer_cache_size', 'backend', 'work_path')
+        for kw in kws:
+            if args[kw]:
+                kwargs[kw] = args[kw]
+
+        archive = ArchiveIndex(args['archive']) if args['archive'] else None
+
+        admission = None
+        if args['headroom'] is not None:
+            headroom = args['headroom'] * 1024 * 1024
+            if args['evict'] and archive is not None:
+                admission = DiskSpaceAdmission.with_archive(archive, headroom=headroom, probe=True)
+            else:
+                admission = DiskSpaceAdmission(headroom=headroom, probe=True)
+
+        scheduler = RecordingScheduler(
+            jobs=load_jobs(args['jobs']),
+            workers=args['workers'],
+            lead_time=args['lead_time'],
+            archive=archive,
+            admission=admission,
+            **kwargs
+        )
+        scheduler.run()
 
 
 if __name__ == '__main__':
@@ -1,28 +1,51 @@
 from argparse import ArgumentParser
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from csv import reader as csv_reader
 from hashlib import md5
 from os import (
+    getcwd,
+    listdir,
     rename,
     stat,
     unlink,
 )
 
 from os.path import (
+    abspath,
+    dirname,
     exists as path_exists,
+    isdir,
+    isfile,
+    join as path_join,
     splitext,
 )
 
+from re import compile as re_compile
 from sys import stdout, stderr
-from time import time
+from time import (
+    monotonic,
+    time,
+)
 from random import random
 
+from recorder.archive import ArchiveIndex
 from recorder.playlist import MBCRadioPlaylistCrawler
 from recorder.backends import FFMpeg
+from recorder.instrument import metrics
+from recorder.ratelimit import TokenBucket
+from recorder.tags import write_tags
 
 
 class MBCPlaylist(object):
 
-    def __init__(self, table_path=None, ffmpeg_path=None):
-        self.crawler = MBCRadioPlaylistCrawler(table_path=table_path)
+    default_cache_path = path_join(abspath(getcwd()), 'imbc_playlist_cache.sqlite')
+
+    def __init__(self, table_path=None, ffmpeg_path=None, cache_path=None):
+        self.crawler = MBCRadioPlaylistCrawler(table_path=table_path, cache_path=cache_path)
         self.ffmpeg = FFMpeg(ffmpeg_path=ffmpeg_path)
 
     def list_programs(self, out=stdout):
@@ -48,16 +71,26 @@ class MBCPlaylist(object):
     def version(self, out=stdout):
         print(self.crawler.program_table.version, file=out)
 
-    def insert_playlist(self, program_id, program_date, input_path, output_path):
+    def get_metadata(self, program_id, program_date):
         playlist = self.crawler.get_playlist(program_id, program_date)
+        return {
+            'comment': self.format_text(playlist)
+        }
+
+    def insert_playlist(self, program_id, program_date, input_path, output_path):
         return self.ffmpeg.insert_metadata(
             input_path=input_path,
             output_path=output_path,
-            metadata={
-                'comment': self.format_text(playlist)
-            }
+            metadata=self.get_metadata(program_id, program_date)
         )
 
+    def replace_playlist(self, program_id, program_date, input_path, temp_output_path):
+        """
+        Tag input_path in place if its format allows, otherwise remux to temp_output_path and replace input_path.
+        """
+        metadata = self.get_metadata(program_id, program_date)
+        return replace_metadata(input_path, metadata, temp_output_path, self.ffmpeg)
+
     @staticmethod
     def format_text(playlist):
         last_seq = playlist[-1]['seq'] if playlist else 0
@@ -69,6 +102,177 @@ class MBCPlaylist(object):
         return '\n'.join(lines)
 
 
+def replace_metadata(input_path, metadata, temp_output_path, ffmpeg):
+    """
+    Tag input_path in place if its format allows, otherwise remux to temp_output_path and replace input_path.
+    """
+    if write_tags(input_path, metadata):
+        return 0
+
+    return_val = ffmpeg.insert_metadata(input_path=input_path, metadata=metadata, output_path=temp_output_path)
+    if return_val == 0 and path_exists(temp_output_path):
+        # also deliberately check two file's size.
+        # output file should be equal or greater than input
+        input_stat = stat(input_path)
+        output_stat = stat(temp_output_path)
+        if output_stat.st_size >= input_stat.st_size:
+            unlink(input_path)
+            rename(temp_output_path, input_path)
+    return return_val
+
+
+def tag_file(input_path, metadata, ffmpeg_path=None):
+    """
+    Process pool entry of MBCPlaylistBatch. Returns (input_path, return value, file size).
+    """
+    temp_output_path = MBCPlaylistScript._get_temp_output_path(input_path)
+    return_val = replace_metadata(input_path, metadata, temp_output_path, FFMpeg(ffmpeg_path=ffmpeg_path))
+    return input_path, return_val, stat(input_path).st_size
+
+
+class MBCPlaylistBatch(object):
+    """
+    Tag many files with their playlists.
+
+    Playlists are fetched by a thread pool, no more than 'rate' requests per second in total.
+    Files are tagged by a process pool as soon as their playlist arrives. Files are always replaced.
+    """
+
+    date_expr = re_compile(r'(\d{4})-?(\d{2})-?(\d{2})')
+
+    extensions = ('.aac', '.m4a', '.mp3', '.mp4')
+
+    def __init__(self, playlist: MBCPlaylist, workers=4, processes=None, rate=1.0, ffmpeg_path=None, archive=None):
+        """
+        :param playlist:    MBCPlaylist. Its crawler and program table are shared by all fetches.
+        :param workers:     playlist fetching threads.
+        :param processes:   tagging processes. Defaults to the number of CPUs.
+        :param rate:        playlist fetches per second. 0 means no limit.
+        :param ffmpeg_path: used when a file cannot be tagged in place.
+        :param archive:     ArchiveIndex. Tagged files under its root are marked as tagged.
+        """
+        self.playlist = playlist
+        self.workers = workers
+        self.processes = processes
+        self.rate_limiter = TokenBucket(rate) if rate else None
+        self.ffmpeg_path = ffmpeg_path
+        self.archive = archive
+
+    @classmethod
+    def from_directory(cls, directory, program_id):
+        """
+        Items of the directory. Broadcast dates are taken from file names, e.g. 'show_2016-12-01.m4a'.
+        """
+        items = []
+        for name in sorted(listdir(directory)):
+            path = abspath(path_join(directory, name))
+            mat = cls.date_expr.search(name)
+            if mat and isfile(path) and splitext(name)[1].lower() in cls.extensions:
+                items.append((path, program_id, '-'.join(mat.groups())))
+        return items
+
+    @classmethod
+    def from_archive(cls, archive: ArchiveIndex, directory, program_id, untagged_only=False):
+        """
+        Items of the directory as indexed, instead of listing it. Files of other programs are left out.
+        """
+        items = []
+        for row in archive.query(under=abspath(directory), recursive=False, order_by='path'):
+            if (
+                row['air_date'] and row['program_id'] in (None, program_id)
+                and splitext(row['path'])[1].lower() in cls.extensions
+                and not (untagged_only and row['tagged'])
+            ):
+                items.append((row['path'], program_id, row['air_date']))
+        return items
+
+    @staticmethod
+    def from_manifest(manifest_path):
+        """
+        Items of a CSV file whose rows are: file path, program id, date (yyyy-mm-dd).
+        Relative paths are relative to the manifest.
+        """
+        items = []
+        base = dirname(abspath(manifest_path))
+        with open(manifest_path, 'r') as f:
+            for cols in csv_reader(f):
+                if len(cols) >= 3 and cols[1].strip().isdigit():
+                    items.append((path_join(base, cols[0].strip()), int(cols[1]), cols[2].strip()))
+        return items
+
+    def run(self, items, out=stdout):
+        """
+        :param items: list of (file path, program id, date)
+        :return: summary dict
+        """
+        begin = monotonic()
+        summary = {'files': 0, 'bytes': 0, 'playlists': 0, 'errors': 0}
+
+        by_playlist = {}
+        for path, program_id, program_date in items:
+            by_playlist.setdefault((program_id, program_date), []).append(path)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as threads, \
+                ProcessPoolExecutor(max_workers=self.processes) as processes:
+            fetches = dict(
+                (threads.submit(self._fetch, program_id, program_date), (program_id, program_date))
+                for program_id, program_date in by_playlist
+            )
+            tagging = {}
+            for future in as_completed(fetches):
+                key = fetches[future]
+                try:
+                    metadata = future.result()
+                except Exception as e:
+                    print('playlist %s %s failed: %s' % (key[0], key[1], e), file=stderr)
+                    summary['errors'] += len(by_playlist[key])
+                    continue
+                summary['playlists'] += 1
+                for path in by_playlist[key]:
+                    tagging[processes.submit(tag_file, path, metadata, self.ffmpeg_path)] = key
+
+            for future in as_completed(tagging):
+                try:
+                    path, return_val, size = future.result()
+                except Exception as e:
+                    print('tagging failed: %s' % e, file=stderr)
+                    summary['errors'] += 1
+                    continue
+                if return_val == 0:
+                    summary['files'] += 1
+                    summary['bytes'] += size
+                    if self.archive is not None:
+                        self.archive.mark_tagged(path, *tagging[future])
+                else:
+                    print('tagging %s failed: %d' % (path, return_val), file=stderr)
+                    summary['errors'] += 1
+
+        summary['elapsed'] = monotonic() - begin
+        self.print_summary(summary, out)
+        return summary
+
+    def _fetch(self, program_id, program_date):
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        return self.playlist.get_metadata(program_id, program_date)
+
+    @staticmethod
+    def print_summary(summary, out=stdout):
+        elapsed = summary['elapsed'] or 1e-9
+        print(
+            '%d files (%.1f MB) tagged with %d playlists in %.2f s: %.2f files/s, %.2f MB/s, %d errors' % (
+                summary['files'],
+                summary['bytes'] / 1024 / 1024,
+                summary['playlists'],
+                summary['elapsed'],
+                summary['files'] / elapsed,
+                summary['bytes'] / 1024 / 1024 / elapsed,
+                summary['errors'],
+            ),
+            file=out
+        )
+
+
 class MBCPlaylistScript(object):
 
     def __init__(self):
@@ -82,6 +286,21 @@ class MBCPlaylistScript(object):
         self.parser.add_argument('-d', '--playlist-date')
         self.parser.add_argument('-t', '--table-path', default=None)
         self.parser.add_argument('--ffmpeg-path', default=None)
+        self.parser.add_argument('--cache-path', default=MBCPlaylist.default_cache_path)
+        self.parser.add_argument('--no-cache', action='store_true', default=False)
+
+        # batch mode: a directory (with --program-id), or a CSV manifest of 'file,program id,date' rows
+        self.parser.add_argument('-b', '--batch', default=None)
+        self.parser.add_argument('--workers', type=int, default=4)
+        self.parser.add_argument('--processes', type=int, default=None)
+        self.parser.add_argument('--rate', type=float, default=1.0)
+
+        # ArchiveIndex of this directory: batch directories are listed from it, and tagged files are marked
+        self.parser.add_argument('--archive', default=None)
+
+        # timers and counters: JSON lines, or Prometheus text
+        self.parser.add_argument('--metrics', default=None)
+        self.parser.add_argument('--metrics-format', choices=metrics.formats, default='jsonl')
 
         # misc functions
         self.parser.add_argument('--print-only', action='store_true', default=False)
@@ -93,9 +312,15 @@ class MBCPlaylistScript(object):
 
     def run(self):
         args = self.parse()
+        if args.metrics:
+            metrics.enable(args.metrics, args.metrics_format)
+
+        archive = ArchiveIndex(args.archive) if args.archive else None
+
         playlist = MBCPlaylist(
             table_path=args.table_path,
-            ffmpeg_path=args.ffmpeg_path
+            ffmpeg_path=args.ffmpeg_path,
+            cache_path=None if args.no_cache else args.cache_path
         )
 
         if args.list_programs:
@@ -107,6 +332,26 @@ class MBCPlaylistScript(object):
         elif args.version:
             playlist.version()
 
+        elif args.batch:
+            if isdir(args.batch):
+                if not self._check_program_id(args, stderr):
+                    return
+                if archive is not None:
+                    archive.reconcile()
+                    items = MBCPlaylistBatch.from_archive(archive, args.batch, args.program_id)
+                else:
+                    items = MBCPlaylistBatch.from_directory(args.batch, args.program_id)
+            else:
+                items = MBCPlaylistBatch.from_manifest(args.batch)
+            MBCPlaylistBatch(
+                playlist,
+                workers=args.workers,
+                processes=args.processes,
+                rate=args.rate,
+                ffmpeg_path=args.ffmpeg_path,
+                archive=archive
+            ).run(items)
+
         else:
             if args.print_only:
                 if not self._check_program_id(args, stderr):
@@ -131,17 +376,14 @@ class MBCPlaylistScript(object):
 
                 if args.replace:
                     output_path = self._get_temp_output_path(args.input)
-                    return_val = playlist.insert_playlist(args.program_id, args.playlist_date, args.input, output_path)
-                    if return_val == 0 and path_exists(output_path):
-                        # also deliberately check two file's size.
-                        # output file should be equal or greater than input
-                        input_stat = stat(args.input)
-                        output_stat = stat(output_path)
-                        if output_stat.st_size >= input_stat.st_size:
-                            unlink(args.input)
-                            rename(output_path, args.input)
+                    return_val = playlist.replace_playlist(args.program_id, args.playlist_date, args.input, output_path)
+                    tagged_path = args.input
                 else:
-                    playlist.insert_playlist(args.program_id, args.playlist_date, args.input, args.output)
+                    return_val = playlist.insert_playlist(args.program_id, args.playlist_date, args.input, args.output)
+                    tagged_path = args.output
+
+                if archive is not None and return_val == 0 and path_exists(tagged_path):
+                    archive.mark_tagged(tagged_path, args.program_id, args.playlist_date)
 
     @staticmethod
     def _check_program_id(args, file):
@@ -1,30 +1,113 @@
 from argparse import ArgumentParser
+from datetime import date
+from os.path import (
+    exists as path_exists,
+    splitext,
+)
 
 from recorder import AudioStreamRecorder, MetadataPostProcess
+from recorder.admission import DiskSpaceAdmission
+from recorder.archive import ArchiveIndex
+from recorder.backends import capture_backends
+from recorder.instrument import metrics
 from recorder.urls import MbcRadioUrl
 
 
 class MBCRecorder(object):
 
     def __init__(self, **kwargs):
+        """
+        Keywords
+        --------
+            archive: ArchiveIndex. Recordings under its root are indexed as they are finished.
+            admission: DiskSpaceAdmission. A recording fails at its start if its space is not free.
+            Others are passed to AudioStreamRecorder and MetadataPostProcess.
+        """
+        self.archive = kwargs.pop('archive', None)
+        self.admission = kwargs.pop('admission', None)
         self.stream_Recorder = AudioStreamRecorder(**kwargs)
         self.post_process = MetadataPostProcess(**kwargs)
         self.radio_url = MbcRadioUrl()
 
-    def record(self, channel: str, duration: int, output_path: str, metadata: dict=None):
+    def record(self, channel: str, duration: int, output_path: str, metadata: dict=None, resilient=False):
         if channel not in MbcRadioUrl.channels:
             raise AttributeError(
                 'Invalid channel: \'%s\'. Supported channels are %s' % (channel, ', '.join(MbcRadioUrl.channels))
             )
 
-        url = getattr(self.radio_url, channel)()
+        air_date = date.today().strftime('%Y-%m-%d')
+
+        # resilient recordings acquire their own urls at every connection.
+        url = None if resilient and self.admission is None else getattr(self.radio_url, channel)()
+
+        reservation = None
+        if self.admission is not None:
+            # resilient recordings are joined from segments in the work path.
+            post_process = resilient or (metadata and not self.stream_Recorder.tags_while_recording)
+            reservation = self.admission.admit(
+                self.admission.needs_of(
+                    channel,
+                    duration,
+                    output_path,
+                    work_path=self.stream_Recorder.work_path if post_process else None,
+                    url=url
+                ),
+                label=output_path
+            )
+
+        try:
+            if resilient:
+                self.record_resilient(channel, duration, output_path, metadata)
+            else:
+                self.record_once(channel, duration, output_path, metadata, url=url)
+        finally:
+            if reservation:
+                reservation.release()
+
+        if self.archive is not None and path_exists(output_path):
+            self.archive.add(output_path, channel=channel, air_date=air_date)
+
+    def record_once(self, channel: str, duration: int, output_path: str, metadata: dict=None, url: str=None):
+        url = url or getattr(self.radio_url, channel)()
 
         if not metadata:
             self.stream_Recorder.record(url=url, duration=duration, destination=output_path)
+        elif self.stream_Recorder.tags_while_recording:
+            # single pass. No temporary file, no rewrite.
+            self.stream_Recorder.record(url=url, duration=duration, destination=output_path, metadata=metadata)
         else:
             temporary_path = self.stream_Recorder.record(url=url, duration=duration)
             self.post_process.process(temporary_path, metadata=metadata, output_path=output_path)
 
+    def record_resilient(self, channel: str, duration: int, output_path: str, metadata: dict=None):
+        """
+        Survive stream drops: a fresh url is acquired on every reconnection.
+        """
+        def url_resolver():
+            return self.radio_url.refresh(channel)
+
+        report_path = output_path + '.gaps.json'
+
+        # segments take the extension of the output, so that ffmpeg can pick their format.
+        suffix = splitext(output_path)[1]
+
+        if not metadata:
+            self.stream_Recorder.record_resilient(
+                url_resolver=url_resolver,
+                duration=duration,
+                destination=output_path,
+                suffix=suffix,
+                report_path=report_path
+            )
+        else:
+            temporary_path = self.stream_Recorder.record_resilient(
+                url_resolver=url_resolver,
+                duration=duration,
+                suffix=suffix,
+                report_path=report_path
+            )
+            self.post_process.process(temporary_path, metadata=metadata, output_path=output_path)
+
 
 class MBCRecorderScript(object):
 
@@ -46,14 +129,31 @@ class MBCRecorderScript(object):
         self.parser.add_argument('--mplayer-cache-size', nargs='?', type=int)
 
         # AudioStreamRecorder argument
+        self.parser.add_argument('--backend', nargs='?', choices=sorted(capture_backends))
         self.parser.add_argument('--work-path', nargs='?')
+        self.parser.add_argument('--resilient', action='store_true', default=False)
+        self.parser.add_argument('--retry-limit', nargs='?', type=int)
+
+        # recordings under this directory are indexed in its ArchiveIndex
+        self.parser.add_argument('--archive', nargs='?')
+
+        # the recording fails at its start if its space is not free: MB always left free
+        self.parser.add_argument('--headroom', nargs='?', type=int)
+        self.parser.add_argument('--evict', action='store_true', default=False)
+
+        # timers and counters: JSON lines, or Prometheus text
+        self.parser.add_argument('--metrics', nargs='?')
+        self.parser.add_argument('--metrics-format', choices=metrics.formats, default='jsonl')
 
     def run(self):
         args = vars(self.parser.parse_args())
 
+        if args['metrics']:
+            metrics.enable(args['metrics'], args['metrics_format'])
+
         # extract kwargs
         kwargs = {}
-        kws = ('ffmpeg_path', 'mplayer_path', 'mplayer_cache_size', 'work_path')
+        kws = ('ffmpeg_path', 'mplayer_path', 'mplayer_cache_size', 'backend', 'work_path', 'retry_limit')
         for kw in kws:
             if args[kw]:
                 kwargs[kw] = args[kw]
@@ -67,12 +167,23 @@ class MBCRecorderScript(object):
                 val = item[idx+1:].strip()
                 metadata_dict[key] = val
 
+        if args['archive']:
+            kwargs['archive'] = ArchiveIndex(args['archive'])
+
+        if args['headroom'] is not None:
+            headroom = args['headroom'] * 1024 * 1024
+            if args['evict'] and args['archive']:
+                kwargs['admission'] = DiskSpaceAdmission.with_archive(kwargs['archive'], headroom=headroom, probe=True)
+            else:
+                kwargs['admission'] = DiskSpaceAdmission(headroom=headroom, probe=True)
+
         recorder = MBCRecorder(**kwargs)
         recorder.record(
             channel=args['channel'],
             duration=args['duration'],
             output_path=args['output'],
             metadata=metadata_dict,
+            resilient=args['resilient'],
         )
 
 
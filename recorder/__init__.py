@@ -1,12 +1,26 @@
+from datetime import datetime
+from json import dump as json_dump
+
 from os import (
     close as os_close,
+    replace,
     unlink
 )
 
+from os.path import (
+    exists as path_exists,
+    getsize,
+)
+
 from tempfile import mkstemp, gettempdir
+from time import (
+    monotonic,
+    sleep,
+)
 
-from .backends import MPlayer, FFMpeg, FFMpegMetadata
+from .backends import FFMpeg, FFMpegMetadata, WaitReason, capture_backends
 from .exceptions import InvalidChannelException
+from .instrument import metrics
 from .urls import MbcRadioUrl
 
 
@@ -16,10 +30,26 @@ class AudioStreamRecorder(object):
         """
         Keywords
         --------
+            backend: capture backend name. 'mplayer' (default), 'native' for http(s) and HLS streams,
+                     or 'ffmpeg' to tag while recording.
             work_path: recording path. Defaults to the system's temporary directory.
+            retry_limit: reconnection attempts in a row for record_resilient(). 0 means retry until the deadline.
+            retry_backoff: first reconnection delay in seconds. Doubled on each failure.
+            retry_backoff_max: upper bound of the reconnection delay.
         """
-        self.backend = MPlayer(**kwargs)
-        self.work_path = kwargs.pop('work_path', gettempdir())
+        backend = kwargs.pop('backend', 'mplayer') or 'mplayer'
+        if backend not in capture_backends:
+            raise ValueError('Invalid backend: \'%s\'. Supported backends are %s' % (
+                backend, ', '.join(sorted(capture_backends))
+            ))
+        self.backend = capture_backends[backend](**kwargs)
+        self.ffmpeg = FFMpeg(**kwargs)
+        self.work_path = kwargs.pop('work_path', gettempdir()) or gettempdir()
+        self.retry_limit = kwargs.pop('retry_limit', 0)
+        self.retry_backoff = kwargs.pop('retry_backoff', 1)
+        self.retry_backoff_max = kwargs.pop('retry_backoff_max', 60)
+        self.wait_reason = None
+        self.gaps = []
 
     @property
     def is_recording(self):
@@ -29,28 +59,170 @@ class AudioStreamRecorder(object):
     def is_stopped(self):
         return self.backend.is_stopped
 
-    def record(self, url, duration=0, destination=None):
+    @property
+    def tags_while_recording(self):
+        """
+        True if record() accepts metadata, so that the output needs no post-process.
+        """
+        return getattr(self.backend, 'tags_while_recording', False)
+
+    def record(self, url, duration=0, destination=None, metadata=None):
         if self.backend.is_recording:
             return
 
+        if metadata and not self.tags_while_recording:
+            raise ValueError('The backend cannot tag while recording. Use MetadataPostProcess.')
+
         if destination is None:
             temp_fd, destination = mkstemp(dir=self.work_path)
             os_close(temp_fd)
 
+        # duration 0: record until the backend exits or Ctrl+C is pressed.
+        # the reason why the recording has ended is left in wait_reason.
         try:
-            if duration == 0:
-                self.backend.record(url, destination)
-                while True:
-                    self.backend.wait(10)
-            else:
-                self.backend.record(url, destination).wait(duration)
+            with metrics.timer('record_seconds', backend=type(self.backend).__name__):
+                if metadata:
+                    self.backend.record(url, destination, metadata=metadata)
+                else:
+                    self.backend.record(url, destination)
+                self.wait_reason = self.backend.wait_for(duration or None)
         except KeyboardInterrupt:
-            pass
+            self.wait_reason = WaitReason.INTERRUPTED
         finally:
             self.backend.stop()
+            metrics.count('recordings_total', backend=type(self.backend).__name__, reason=self.wait_reason)
 
         return destination
 
+    def record_resilient(self, url_resolver, duration=0, destination=None, suffix='', report_path=None):
+        """
+        Record like record(), but reconnect when the stream drops.
+
+        Each connection is dumped into its own segment. When the backend exits before the deadline,
+         url_resolver is called for a fresh stream url and a new segment is started, with exponential backoff.
+        Finally the segments are joined by FFMpeg.concat() without re-encoding, and the gaps between
+         segments are written to report_path as JSON (default: destination + '.gaps.json').
+
+        :param url_resolver: callable with no arguments, returns a stream url.
+        :param duration:     seconds. 0 means until Ctrl+C is pressed.
+        :param destination:  output path. A temporary file (with suffix) is created if omitted.
+        :param suffix:       extension of temporary files, so that ffmpeg can pick the output format.
+        :param report_path:  where the gap report is written.
+        :return: destination
+        """
+        if self.backend.is_recording:
+            return
+
+        if destination is None:
+            temp_fd, destination = mkstemp(suffix=suffix, dir=self.work_path)
+            os_close(temp_fd)
+
+        deadline = monotonic() + duration if duration else None
+        segments = []
+        self.gaps = []
+        gap_begin = None
+        attempts = 0
+        backoff = self.retry_backoff
+
+        try:
+            while True:
+                remaining = deadline - monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    self.wait_reason = WaitReason.DEADLINE
+                    break
+
+                url = self._resolve(url_resolver)
+                if url:
+                    temp_fd, segment = mkstemp(suffix=suffix, dir=self.work_path)
+                    os_close(temp_fd)
+                    segments.append(segment)
+
+                    segment_begin = datetime.now()
+                    self.wait_reason = self.backend.record(url, segment).wait_for(remaining)
+                    self.backend.stop()
+                    if getsize(segment):
+                        # the connection has delivered something. The gap is over, start over the backoff.
+                        if gap_begin:
+                            self._close_gap(gap_begin, segment_begin, attempts)
+                            gap_begin = None
+                        attempts = 0
+                        backoff = self.retry_backoff
+                    if self.wait_reason != WaitReason.EXITED:
+                        break
+
+                if not gap_begin:
+                    gap_begin = datetime.now()
+                attempts += 1
+                if self.retry_limit and attempts > self.retry_limit:
+                    break
+
+                remaining = deadline - monotonic() if deadline else None
+                sleep(backoff if remaining is None else max(0, min(backoff, remaining)))
+                backoff = min(backoff * 2, self.retry_backoff_max)
+
+        except KeyboardInterrupt:
+            self.wait_reason = WaitReason.INTERRUPTED
+        finally:
+            self.backend.stop()
+
+        if gap_begin:
+            # the stream has never come back.
+            self._close_gap(gap_begin, datetime.now(), attempts)
+
+        joined = self._join_segments(segments, destination)
+        self._write_gap_report(report_path or destination + '.gaps.json', destination, [] if joined else segments)
+
+        return destination
+
+    @staticmethod
+    def _resolve(url_resolver):
+        try:
+            return url_resolver()
+        except (OSError, KeyError, ValueError):
+            # network errors, or an invalid response. Treated as another drop.
+            return None
+
+    def _close_gap(self, gap_begin, gap_end, attempts):
+        self.gaps.append({
+            'begin': gap_begin.isoformat(),
+            'end': gap_end.isoformat(),
+            'length': (gap_end - gap_begin).total_seconds(),
+            'attempts': attempts,
+        })
+
+    def _join_segments(self, segments, destination):
+        for segment in [x for x in segments if not getsize(x)]:
+            unlink(segment)
+            segments.remove(segment)
+
+        if not segments:
+            return False
+
+        if len(segments) == 1:
+            replace(segments[0], destination)
+            return True
+
+        if self.ffmpeg.concat(segments, destination) == 0 and path_exists(destination):
+            for segment in segments:
+                unlink(segment)
+            return True
+
+        # leave segments as they are. They are listed in the report.
+        return False
+
+    def _write_gap_report(self, report_path, destination, unjoined_segments):
+        with open(report_path, 'w') as f:
+            json_dump(
+                {
+                    'destination': destination,
+                    'unjoined_segments': unjoined_segments,
+                    'reason': self.wait_reason,
+                    'gaps': self.gaps,
+                },
+                f,
+                indent=2
+            )
+
 
 class MetadataPostProcess(object):
 
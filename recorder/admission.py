@@ -0,0 +1,237 @@
+from os import stat
+from re import IGNORECASE
+from os.path import (
+    abspath,
+    dirname,
+    exists as path_exists,
+    getsize,
+    isdir,
+)
+from shutil import disk_usage
+from threading import Lock
+
+from .backends import (
+    FFProbe,
+    FFPROBE_PATH,
+)
+from .exceptions import InsufficientSpaceException
+from .utils import DirectoryCleaner
+
+
+class Reservation(object):
+    """
+    Bytes reserved on filesystems for a recording. Use in 'with' statement, or call release() when it is done.
+    """
+
+    def __init__(self, admission, needs, label=''):
+        """
+        :param needs: list of (directory, bytes, path). path is the file to be written there, or None.
+                      as the file grows, less of the reservation is outstanding.
+        """
+        self.admission = admission
+        self.needs = needs
+        self.label = label
+        self.released = False
+
+    def outstanding(self, device):
+        total = 0
+        for directory, needed, path in self.needs:
+            if self.admission.device_of(directory) == device:
+                written = getsize(path) if path and path_exists(path) else 0
+                total += max(0, needed - written)
+        return total
+
+    def release(self):
+        self.admission.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class DiskSpaceAdmission(object):
+    """
+    Admits a recording only if the space it needs is free, so that a full disk fails a job at its start, with
+     InsufficientSpaceException, instead of truncating every recording in progress at once.
+
+    Space is estimated by the channel's bitrate and the duration, and reserved until the recording is done.
+    Free space is reduced by the outstanding reservations of recordings in progress, and by the headroom.
+    When space is short, the oldest files selected by the cleaner are removed, only as many as needed, and only if
+     that is enough.
+    """
+
+    # bits per second, when the stream cannot be probed.
+    default_bitrate = 128000
+
+    # seconds, for a recording until it is stopped.
+    open_ended_duration = 3600
+
+    # seconds. A live stream that does not answer in time gets the default bitrate.
+    probe_timeout = 10
+
+    # files to evict by with_archive()
+    recording_expr = r'\.(aac|m4a|mp3|mp4)$'
+
+    def __init__(self, headroom=256 * 1024 * 1024, margin=0.1, channel_bitrates=None, probe=False, cleaner=None,
+                 usage=disk_usage, **kwargs):
+        """
+        :param headroom:         bytes always left free.
+        :param margin:           estimates are increased by this ratio, for container overhead and bitrate changes.
+        :param channel_bitrates: dict of channel: bits per second, overriding probed or default bitrates.
+        :param probe:            probe stream urls with FFProbe for their bitrates, once a channel.
+        :param cleaner:          DirectoryCleaner. Its files are candidates for eviction, the oldest first.
+        :param usage:            callable(path) returns (total, used, free), as shutil.disk_usage().
+        :param kwargs:           passed to FFProbe, e.g. ffprobe_path.
+        """
+        self.headroom = headroom
+        self.margin = margin
+        self.channel_bitrates = dict(channel_bitrates or {})
+        self.probe = probe and path_exists(kwargs.get('ffprobe_path') or FFPROBE_PATH)
+        self.cleaner = cleaner
+        self.usage = usage
+        self.probe_kwargs = kwargs
+
+        self._lock = Lock()
+        self._reservations = []
+
+    @classmethod
+    def with_archive(cls, archive, **kwargs):
+        """
+        Evicts the oldest recordings of the ArchiveIndex.
+        """
+        cleaner = DirectoryCleaner().dir(archive.root).recursive(True).pattern(cls.recording_expr, IGNORECASE)
+        return cls(cleaner=cleaner.index(archive), **kwargs)
+
+    def bitrate(self, channel, url=None):
+        """
+        Bits per second of the channel: configured, probed from the url, or the default.
+        """
+        if channel in self.channel_bitrates:
+            return self.channel_bitrates[channel]
+
+        bitrate = None
+        if self.probe and url:
+            bitrate = self.probe_bitrate(url)
+            if bitrate:
+                with self._lock:
+                    self.channel_bitrates[channel] = bitrate
+
+        return bitrate or self.default_bitrate
+
+    def probe_bitrate(self, url):
+        """
+        Bits per second of the stream, or None if it cannot be probed in probe_timeout seconds.
+        """
+        try:
+            ffprobe = FFProbe(**self.probe_kwargs)
+            result = ffprobe.probe(url, timeout=self.probe_timeout)
+            if ffprobe.return_val != 0:
+                # killed at the timeout, or failed.
+                return None
+            return sum(int(x.bitrate) for x in result.streams if x.bitrate) or None
+        except (OSError, ValueError):
+            return None
+
+    def estimate(self, channel, duration, url=None):
+        """
+        Bytes of a recording of the channel for duration seconds.
+        """
+        seconds = duration or self.open_ended_duration
+        return int(self.bitrate(channel, url) / 8 * seconds * (1 + self.margin))
+
+    def needs_of(self, channel, duration, output_path, work_path=None, url=None):
+        """
+        (directory, bytes, path) list for admit(). Without work_path, the recording is written to output_path.
+        With work_path, it is written there first, then copied to output_path with tags: both copies exist at once.
+        """
+        size = self.estimate(channel, duration, url)
+        output_dir = dirname(abspath(output_path))
+        if work_path is None:
+            return [(output_dir, size, output_path)]
+        return [(abspath(work_path), size, None), (output_dir, size, output_path)]
+
+    def admit(self, needs, label=''):
+        """
+        Reserve the space, evicting files if needed. Returns a Reservation.
+
+        :param needs: list of (directory, bytes, path). See needs_of().
+        :raise InsufficientSpaceException: the space is not free, even after eviction.
+        """
+        with self._lock:
+            by_device = {}
+            for directory, needed, _ in needs:
+                device = self.device_of(directory)
+                by_device.setdefault(device, [directory, 0])[1] += needed
+
+            for directory, needed in by_device.values():
+                available = self._available(directory)
+                if needed > available and self.cleaner is not None:
+                    self._evict(directory, needed - available)
+                    available = self._available(directory)
+                if needed > available:
+                    raise InsufficientSpaceException(directory, needed, available, label)
+
+            reservation = Reservation(self, needs, label)
+            self._reservations.append(reservation)
+
+        return reservation
+
+    def release(self, reservation):
+        with self._lock:
+            if not reservation.released:
+                self._reservations.remove(reservation)
+                reservation.released = True
+
+    def available(self, directory):
+        """
+        Bytes free for another recording: free space less the headroom and outstanding reservations.
+        """
+        with self._lock:
+            return self._available(directory)
+
+    @staticmethod
+    def existing_parent(directory):
+        """
+        The directory may not exist yet. Its closest existing parent is on the same filesystem.
+        """
+        while not isdir(directory) and dirname(directory) != directory:
+            directory = dirname(directory)
+        return directory
+
+    @classmethod
+    def device_of(cls, directory):
+        return stat(cls.existing_parent(directory)).st_dev
+
+    def _available(self, directory):
+        device = self.device_of(directory)
+        outstanding = sum(x.outstanding(device) for x in self._reservations)
+        return self.usage(self.existing_parent(directory))[2] - self.headroom - outstanding
+
+    def _evict(self, directory, nbytes):
+        """
+        Remove the cleaner's files on the same filesystem, the oldest first, until nbytes are freed.
+        Files of recordings in progress are skipped. If all of them are not enough, none is removed.
+        """
+        device = self.device_of(directory)
+        in_progress = set(abspath(path) for x in self._reservations for _, _, path in x.needs if path)
+        victims = []
+        freed = 0
+        for path, _ in sorted(self.cleaner.files(), key=lambda x: x[1]):
+            if freed >= nbytes:
+                break
+            if abspath(path) in in_progress:
+                continue
+            try:
+                st = stat(path)
+            except FileNotFoundError:
+                continue
+            if st.st_dev == device:
+                victims.append((path, st.st_mtime))
+                freed += st.st_size
+
+        # nothing is removed in vain.
+        if victims and freed >= nbytes:
+            self.cleaner.target = victims
+            self.cleaner.clean(reuse_target=True)
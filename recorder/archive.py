@@ -0,0 +1,283 @@
+from datetime import datetime
+from os import (
+    scandir,
+    sep,
+    stat,
+)
+from os.path import (
+    abspath,
+    basename,
+    dirname,
+    expanduser,
+    expandvars,
+    join as path_join,
+)
+from re import compile as re_compile
+from sqlite3 import connect
+from threading import Lock
+
+from .urls import MbcRadioUrl
+
+
+class ArchiveIndex(object):
+    """
+    Recordings under a directory, in an SQLite file in that directory.
+
+    The recorders and the taggers update the index as they write. reconcile() picks up changes made by others:
+     a directory whose mtime is unchanged has the same entries, so only changed directories are scanned.
+    Files modified in place by others are noticed by reconcile(full=True) only.
+
+    Columns: path, size, mtime, channel, program_id, air_date ('yyyy-mm-dd'), and tagged, whether the playlist
+     has been written into the file. Channel and air date are guessed from file names, if not given.
+    """
+
+    default_file_name = '.almond_archive.sqlite'
+
+    date_expr = re_compile(r'(\d{4})-?(\d{2})-?(\d{2})')
+
+    columns = ('path', 'size', 'mtime', 'channel', 'program_id', 'air_date', 'tagged')
+
+    supported_orders = ('path', 'mtime', 'air_date')
+
+    def __init__(self, root, path=None):
+        """
+        :param root: recording directory.
+        :param path: SQLite file path. Defaults to default_file_name in root.
+        """
+        self.root = abspath(expandvars(expanduser(root)))
+        self.path = path or path_join(self.root, self.default_file_name)
+
+        self._lock = Lock()
+        self._conn = connect(self.path, check_same_thread=False)
+        # the journal is kept between transactions, not to change the mtime of the directory at every commit.
+        self._conn.execute('PRAGMA journal_mode=PERSIST')
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                ' path TEXT PRIMARY KEY,'
+                ' dir TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' mtime REAL NOT NULL,'
+                ' channel TEXT,'
+                ' program_id INTEGER,'
+                ' air_date TEXT,'
+                ' tagged INTEGER NOT NULL DEFAULT 0)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS files_program ON files (program_id, mtime)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS files_channel ON files (channel, mtime)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS dirs ('
+                ' path TEXT PRIMARY KEY,'
+                ' parent TEXT,'
+                ' mtime_ns INTEGER NOT NULL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)')
+
+    def covers(self, path):
+        path = abspath(path)
+        return path.startswith(self.root + sep) and not basename(path).startswith(basename(self.path))
+
+    def add(self, path, channel=None, program_id=None, air_date=None, tagged=None):
+        """
+        Index a file just written, or update it. None keeps the known value, or guesses it from the file name.
+        Returns False if the file is not under the root.
+        """
+        path = abspath(path)
+        if not self.covers(path):
+            return False
+
+        st = stat(path)
+        guessed_channel, guessed_date = self.parse_name(basename(path))
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO files (path, dir, size, mtime, channel, program_id, air_date, tagged)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+                ' ON CONFLICT (path) DO UPDATE SET'
+                '  size=excluded.size, mtime=excluded.mtime,'
+                '  channel=COALESCE(?, channel, excluded.channel),'
+                '  program_id=COALESCE(excluded.program_id, program_id),'
+                '  air_date=COALESCE(?, air_date, excluded.air_date),'
+                '  tagged=COALESCE(?, tagged)',
+                (
+                    path, dirname(path), st.st_size, st.st_mtime,
+                    channel or guessed_channel, program_id, air_date or guessed_date, int(bool(tagged)),
+                    channel, air_date, None if tagged is None else int(tagged),
+                )
+            )
+        return True
+
+    def mark_tagged(self, path, program_id=None, air_date=None):
+        """
+        Tagging rewrites the file, so its size and mtime are taken again.
+        """
+        return self.add(path, program_id=program_id, air_date=air_date, tagged=True)
+
+    def remove(self, paths):
+        with self._lock, self._conn:
+            self._conn.executemany('DELETE FROM files WHERE path=?', ((abspath(x), ) for x in paths))
+
+    def get(self, path):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT %s FROM files WHERE path=?' % ', '.join(self.columns), (abspath(path), )
+            ).fetchone()
+        return dict(zip(self.columns, row)) if row else None
+
+    def query(self, program_id=None, channel=None, before=None, after=None, tagged=None, under=None, recursive=True,
+              order_by='mtime', desc=False, limit=0):
+        """
+        Indexed lookup, e.g. files older than 30 days of a program:
+            query(program_id=1234, before=datetime.now() - timedelta(days=30))
+
+        :param before:    mtime, timestamp or datetime. Exclusive.
+        :param after:     mtime, timestamp or datetime. Exclusive.
+        :param tagged:    True or False to choose, None for both.
+        :param under:     directory. Defaults to the root.
+        :param recursive: include subdirectories of under.
+        :param order_by:  one of supported_orders.
+        :return: list of dicts of columns.
+        """
+        if order_by not in self.supported_orders:
+            supported_text = ', '.join(['\'%s\'' % x for x in self.supported_orders])
+            raise ValueError('invalid value \'%s\': supported: %s' % (order_by, supported_text))
+
+        where, params = self._where_under(under or self.root, recursive)
+        for column, op, value in (
+                ('program_id', '=', program_id),
+                ('channel', '=', channel),
+                ('mtime', '<', self._timestamp(before)),
+                ('mtime', '>', self._timestamp(after)),
+                ('tagged', '=', None if tagged is None else int(tagged)),
+        ):
+            if value is not None:
+                where.append('%s %s ?' % (column, op))
+                params.append(value)
+
+        sql = 'SELECT %s FROM files WHERE %s ORDER BY %s %s' % (
+            ', '.join(self.columns), ' AND '.join(where), order_by, 'DESC' if desc else 'ASC'
+        )
+        if limit:
+            sql += ' LIMIT %d' % limit
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [dict(zip(self.columns, row)) for row in rows]
+
+    def iter_files(self, target_dir, recursive, accept=None):
+        """
+        (path, mtime) of indexed files, as DirectoryCleaner._grab_files() crawls them.
+        """
+        where, params = self._where_under(abspath(target_dir), recursive)
+        with self._lock:
+            rows = self._conn.execute('SELECT path, mtime FROM files WHERE %s' % ' AND '.join(where), params).fetchall()
+        return (x for x in rows if accept is None or accept(x[0]))
+
+    def reconcile(self, full=False):
+        """
+        Bring the index up to date with the disk.
+
+        :param full: scan every directory, to notice files modified in place by others.
+        :return: dict of scanned, skipped (directories), added, updated, removed (files).
+        """
+        summary = {'scanned': 0, 'skipped': 0, 'added': 0, 'updated': 0, 'removed': 0}
+        seen = set()
+        pending = [self.root]
+
+        with self._lock, self._conn:
+            known = dict(self._conn.execute('SELECT path, mtime_ns FROM dirs'))
+            while pending:
+                dir_path = pending.pop()
+                try:
+                    mtime_ns = stat(dir_path).st_mtime_ns
+                except OSError:
+                    continue
+                seen.add(dir_path)
+
+                if not full and known.get(dir_path) == mtime_ns:
+                    # the same entries as before. Subdirectories may have changed, though.
+                    pending.extend(
+                        x[0] for x in self._conn.execute('SELECT path FROM dirs WHERE parent=?', (dir_path, ))
+                    )
+                    summary['skipped'] += 1
+                    continue
+
+                self._scan(dir_path, pending, summary)
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                    (dir_path, dirname(dir_path) if dir_path != self.root else None, mtime_ns)
+                )
+                summary['scanned'] += 1
+
+            # directories removed, or moved away.
+            for dir_path in set(known) - seen:
+                self._conn.execute('DELETE FROM dirs WHERE path=?', (dir_path, ))
+                summary['removed'] += self._conn.execute('DELETE FROM files WHERE dir=?', (dir_path, )).rowcount
+
+        return summary
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    @classmethod
+    def parse_name(cls, name):
+        """
+        (channel, air date) guessed from a file name like 'mfm_2016-12-01.m4a'. None if not found.
+        """
+        mat = cls.date_expr.search(name)
+        air_date = '-'.join(mat.groups()) if mat else None
+        tokens = set(re_compile(r'[^a-z0-9]+').split(name.lower()))
+        channel = next((x for x in MbcRadioUrl.channels if x in tokens), None)
+        return channel, air_date
+
+    def _scan(self, dir_path, pending, summary):
+        rows = self._conn.execute('SELECT path, size, mtime FROM files WHERE dir=?', (dir_path, ))
+        indexed = dict((x[0], (x[1], x[2])) for x in rows)
+        with scandir(dir_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                        continue
+                    if not entry.is_file() or not self.covers(entry.path):
+                        continue
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                known = indexed.pop(entry.path, None)
+                if known is None:
+                    channel, air_date = self.parse_name(entry.name)
+                    self._conn.execute(
+                        'INSERT INTO files (path, dir, size, mtime, channel, air_date) VALUES (?, ?, ?, ?, ?, ?)',
+                        (entry.path, dir_path, st.st_size, st.st_mtime, channel, air_date)
+                    )
+                    summary['added'] += 1
+                elif known != (st.st_size, st.st_mtime):
+                    self._conn.execute(
+                        'UPDATE files SET size=?, mtime=? WHERE path=?', (st.st_size, st.st_mtime, entry.path)
+                    )
+                    summary['updated'] += 1
+
+        if indexed:
+            self._conn.executemany('DELETE FROM files WHERE path=?', ((x, ) for x in indexed))
+            summary['removed'] += len(indexed)
+
+    @staticmethod
+    def _where_under(dir_path, recursive):
+        if not recursive:
+            return ['dir = ?'], [dir_path]
+        # subdirectories sort between 'dir/' and 'dir0', as '0' follows the separator.
+        return ['(dir = ? OR (dir >= ? AND dir < ?))'], [dir_path, dir_path + sep, dir_path + chr(ord(sep) + 1)]
+
+    @staticmethod
+    def _timestamp(value):
+        if isinstance(value, datetime):
+            return value.timestamp()
+        return value
@@ -1,7 +1,31 @@
+from os import (
+    close as os_close,
+    fdopen,
+    unlink,
+)
+from select import (
+    poll,
+    POLLIN,
+)
+from re import compile as re_compile
+from socket import SHUT_RDWR
 from subprocess import Popen, PIPE, TimeoutExpired, STDOUT, DEVNULL
 from sys import stdout
-from time import sleep
-
+from tempfile import mkstemp
+from threading import (
+    Event,
+    Thread,
+)
+from time import monotonic
+from urllib.parse import urljoin, urlparse
+from urllib.request import urlopen
+
+try:
+    from os import pidfd_open
+except ImportError:
+    pidfd_open = None
+
+from .instrument import metrics
 from .metadata import FFProbeResult, FFMpegMetadata
 
 FFMPEG_PATH = '/usr/bin/ffmpeg'
@@ -12,6 +36,20 @@ MPLAYER_PATH = '/usr/bin/mplayer'
 
 MPLAYER_CACHE_SIZE = 8192
 
+CAPTURE_BUFFER_SIZE = 256 * 1024
+
+CAPTURE_TIMEOUT = 10
+
+
+class WaitReason(object):
+    """
+    Why PopenBasedBackend.wait_for() returned.
+    """
+    EXITED = 'exited'            # the child process has exited by itself
+    DEADLINE = 'deadline'        # the deadline has been reached while the child is still running
+    INTERRUPTED = 'interrupted'  # KeyboardInterrupt while waiting, or interrupt() called
+    NOT_STARTED = 'not-started'  # there is no child process to wait for
+
 
 class PopenBasedBackend(object):
 
@@ -26,6 +64,7 @@ class PopenBasedBackend(object):
         self.stderr_str = ''
         self.return_val = None
         self.process = None
+        self._interrupted = Event()
 
     @property
     def is_working(self):
@@ -42,9 +81,76 @@ class PopenBasedBackend(object):
 
     def start(self, command, _stdin=PIPE, _stdout=PIPE, _stderr=PIPE):
         if self.is_stopped:
-            self.process = Popen(command, stdin=_stdin, stdout=_stdout, stderr=_stderr)
+            with metrics.timer('backend_start_seconds', backend=type(self).__name__):
+                self.process = Popen(command, stdin=_stdin, stdout=_stdout, stderr=_stderr)
         return self
 
+    def wait_for(self, timeout=None):
+        """
+        Block until the child process exits or the timeout expires, whichever comes first.
+        No periodic wake-ups: a pidfd is polled if the platform provides one, Popen.wait() otherwise.
+        timeout: seconds. None or 0 means no deadline.
+        Returns one of WaitReason values.
+        """
+        if not self.is_working:
+            return WaitReason.NOT_STARTED
+        if self._interrupted.is_set():
+            return WaitReason.INTERRUPTED
+
+        deadline = monotonic() + timeout if timeout else None
+        try:
+            exited = self._wait_pidfd(deadline)
+            if exited is None:
+                exited = self._wait_popen(deadline)
+            if exited:
+                return WaitReason.INTERRUPTED if self._interrupted.is_set() else WaitReason.EXITED
+        except KeyboardInterrupt:
+            return WaitReason.INTERRUPTED
+
+        return WaitReason.DEADLINE
+
+    def interrupt(self):
+        """
+        Make wait_for() in another thread return INTERRUPTED, now or when it is called. Safe from any thread:
+         the child is terminated, but the thread that waits for it calls stop() and reaps it.
+        An interrupted backend stays interrupted.
+        """
+        self._interrupted.set()
+        process = self.process
+        if process is not None:
+            process.terminate()
+
+    def _wait_pidfd(self, deadline):
+        """
+        Returns True if the child has exited, False on deadline, None if pidfd is not available.
+        """
+        if pidfd_open is None:
+            return None
+        try:
+            fd = pidfd_open(self.process.pid)
+        except OSError:
+            # the kernel does not support pidfd, or the child is already reaped.
+            return None
+        try:
+            p = poll()
+            p.register(fd, POLLIN)
+            # poll() restarts itself with the remaining time when interrupted by a signal (PEP 475)
+            timeout_ms = None if deadline is None else max(0, int((deadline - monotonic()) * 1000) + 1)
+            if not p.poll(timeout_ms):
+                return False
+        finally:
+            os_close(fd)
+        # reap the child, it is a zombie now.
+        self.process.wait()
+        return True
+
+    def _wait_popen(self, deadline):
+        try:
+            self.process.wait(timeout=None if deadline is None else max(0, deadline - monotonic()))
+        except TimeoutExpired:
+            return False
+        return True
+
     def stop(self, timeout=2):
         if self.is_working:
             self.process.terminate()
@@ -52,7 +158,8 @@ class PopenBasedBackend(object):
 
     def communicate(self, timeout=None):
         try:
-            self.stdout_str, self.stderr_str = self.process.communicate(timeout=timeout)
+            with metrics.timer('backend_communicate_seconds', backend=type(self).__name__):
+                self.stdout_str, self.stderr_str = self.process.communicate(timeout=timeout)
         except TimeoutExpired:
             self.process.kill()
             self.stdout_str, self.stderr_str = self.process.communicate()
@@ -77,6 +184,7 @@ class MPlayer(PopenBasedBackend):
         super(MPlayer, self).__init__(**kwargs)
         self.mplayer = kwargs.pop('mplayer_path', MPLAYER_PATH) or MPLAYER_PATH
         self.cache_size = kwargs.pop('mplayer_cache_size', MPLAYER_CACHE_SIZE) or MPLAYER_CACHE_SIZE
+        self.wait_reason = None
 
     @property
     def is_recording(self):
@@ -96,11 +204,259 @@ class MPlayer(PopenBasedBackend):
         return self.start(command, _stdout=DEVNULL, _stderr=STDOUT)
 
     def wait(self, duration):
+        """
+        Wait for the duration, but return early if mplayer exits. See wait_reason for the cause.
+        """
         if duration:
-            sleep(duration)
+            self.wait_reason = self.wait_for(duration)
         return self
 
 
+class HttpStreamCapture(object):
+    """
+    In-process stream dumper for HTTP and HLS streams. It can replace MPlayer for http(s) urls.
+
+    There is no child process and no player cache: a capture thread reads the stream into one preallocated
+     buffer and writes it to the dump file. Interface follows MPlayer: record(), wait(), wait_for(), stop().
+    """
+
+    hls_content_types = ('application/vnd.apple.mpegurl', 'application/x-mpegurl', 'audio/mpegurl', 'audio/x-mpegurl')
+
+    bandwidth_expr = re_compile(r'BANDWIDTH=(\d+)')
+
+    def __init__(self, **kwargs):
+        """
+        Keywords
+        --------
+         - capture_buffer_size: read buffer size in bytes.
+         - capture_timeout: socket timeout in seconds.
+        """
+        self.buffer_size = kwargs.pop('capture_buffer_size', CAPTURE_BUFFER_SIZE) or CAPTURE_BUFFER_SIZE
+        self.timeout = kwargs.pop('capture_timeout', CAPTURE_TIMEOUT) or CAPTURE_TIMEOUT
+        self.return_val = None
+        self.error = None
+        self.bytes_written = 0
+        self.wait_reason = None
+        self._capture_begin = None
+        self._buffer = memoryview(bytearray(self.buffer_size))
+        self._stop_event = Event()
+        self._thread = None
+        self._response = None
+        self._interrupted = Event()
+
+    @property
+    def is_working(self):
+        return self._thread is not None
+
+    @property
+    def is_stopped(self):
+        return self._thread is None
+
+    @property
+    def is_recording(self):
+        return self.is_working and self._thread.is_alive()
+
+    def record(self, source_path: str, dump_file: str):
+        if self.is_stopped:
+            self.return_val = None
+            self.error = None
+            self.bytes_written = 0
+            self._stop_event.clear()
+            self._thread = Thread(target=self._capture, args=(source_path, dump_file), daemon=True)
+            self._thread.start()
+        return self
+
+    def wait(self, duration):
+        if duration:
+            self.wait_reason = self.wait_for(duration)
+        return self
+
+    def wait_for(self, timeout=None):
+        """
+        Same as PopenBasedBackend.wait_for(). EXITED means the stream has ended, or the capture has failed.
+        """
+        if self.is_stopped:
+            return WaitReason.NOT_STARTED
+        if self._interrupted.is_set():
+            return WaitReason.INTERRUPTED
+        try:
+            self._thread.join(timeout or None)
+        except KeyboardInterrupt:
+            return WaitReason.INTERRUPTED
+        if self._thread.is_alive():
+            return WaitReason.DEADLINE
+        return WaitReason.INTERRUPTED if self._interrupted.is_set() else WaitReason.EXITED
+
+    def interrupt(self):
+        """
+        Same as PopenBasedBackend.interrupt(). The capture ends, and the thread that waits for it calls stop().
+        """
+        self._interrupted.set()
+        self._stop_event.set()
+        self._shutdown(self._response)
+
+    def stop(self, timeout=2):
+        """
+        Stop the capture and wait for the thread. If it is still writing after the timeout, the capture stays
+         working, so that no other capture starts on the same buffer. Returns None then.
+        """
+        if self.is_working:
+            self._stop_event.set()
+            # a read blocked in the capture thread returns at once.
+            self._shutdown(self._response)
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                return None
+            self._thread = None
+            return self.return_val
+
+    def _capture(self, source_path, dump_file):
+        self._capture_begin = monotonic()
+        try:
+            with open(dump_file, 'wb', buffering=0) as f:
+                response = urlopen(source_path, timeout=self.timeout)
+                if self._is_hls(source_path, response):
+                    try:
+                        playlist = response.read().decode('utf-8')
+                    finally:
+                        response.close()
+                    self._copy_hls(playlist, response.geturl(), f)
+                else:
+                    self._copy(response, f)
+            self.return_val = 0
+        except Exception as e:
+            if self._stop_event.is_set():
+                # stop() has cut the connection.
+                self.return_val = 0
+                return
+            # the recorder finds out through wait_for(), and the error is kept for the post-mortem.
+            self.error = e
+            self.return_val = 1
+            metrics.count('capture_errors_total', backend='native', error=type(e).__name__)
+        finally:
+            metrics.count('capture_bytes_total', self.bytes_written, backend='native')
+
+    def _is_hls(self, source_path, response):
+        content_type = (response.headers.get_content_type() or '').lower()
+        return content_type in self.hls_content_types or urlparse(source_path).path.endswith('.m3u8')
+
+    def _copy(self, response, f):
+        """
+        Copy the response body to the file through the buffer, until the body ends or stop() is called.
+        """
+        if response.length is None and not response.chunked:
+            # a live stream without end: take whatever has arrived, do not block until the buffer is full.
+            read = response.fp.readinto1
+        else:
+            read = response.readinto
+
+        buffer = self._buffer
+        size = len(buffer)
+        filled = 0
+        # stop() shuts it down. The stop event is checked after this, so no response is missed.
+        self._response = response
+        try:
+            while not self._stop_event.is_set():
+                n = read(buffer[filled:])
+                if not n:
+                    break
+                filled += n
+                if filled == size:
+                    self._write(f, buffer)
+                    filled = 0
+        finally:
+            if filled:
+                self._write(f, buffer[:filled])
+            self._response = None
+            response.close()
+
+    @staticmethod
+    def _shutdown(response):
+        """
+        Shut down the socket of the response, if it is still open: a read of it returns the end of stream.
+        """
+        try:
+            response.fp.raw._sock.shutdown(SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+
+    def _write(self, f, view):
+        if not self.bytes_written:
+            metrics.observe('capture_first_byte_seconds', monotonic() - self._capture_begin, backend='native')
+        # unbuffered file: write() may take only a part of the view.
+        written = 0
+        while written < len(view):
+            written += f.write(view[written:])
+        self.bytes_written += written
+
+    def _copy_hls(self, playlist, playlist_url, f):
+        """
+        Follow an HLS playlist: segments are appended to the file in order, and a live playlist is reloaded
+         every half target duration.
+        """
+        last_sequence = -1
+        while not self._stop_event.is_set():
+            variant = self._select_variant(playlist)
+            if variant:
+                # master playlist. move on to the media playlist.
+                playlist_url = urljoin(playlist_url, variant)
+                playlist = self._fetch_text(playlist_url)
+                continue
+
+            sequence, target_duration, uris, ended = self._parse_media_playlist(playlist)
+            for uri in uris:
+                if self._stop_event.is_set():
+                    return
+                if sequence > last_sequence:
+                    self._copy(urlopen(urljoin(playlist_url, uri), timeout=self.timeout), f)
+                    last_sequence = sequence
+                sequence += 1
+
+            if ended or self._stop_event.wait(max(1, target_duration / 2)):
+                return
+
+            playlist = self._fetch_text(playlist_url)
+
+    def _fetch_text(self, url):
+        response = urlopen(url, timeout=self.timeout)
+        try:
+            return response.read().decode('utf-8')
+        finally:
+            response.close()
+
+    def _select_variant(self, playlist):
+        """
+        Returns the uri of the highest bandwidth variant if the playlist is a master playlist.
+        """
+        best, best_bandwidth = None, -1
+        lines = [x.strip() for x in playlist.splitlines() if x.strip()]
+        for idx, line in enumerate(lines[:-1]):
+            if line.startswith('#EXT-X-STREAM-INF'):
+                mat = self.bandwidth_expr.search(line)
+                bandwidth = int(mat.group(1)) if mat else 0
+                if bandwidth > best_bandwidth:
+                    best, best_bandwidth = lines[idx + 1], bandwidth
+        return best
+
+    @staticmethod
+    def _parse_media_playlist(playlist):
+        sequence = 0
+        target_duration = CAPTURE_TIMEOUT
+        uris = []
+        ended = False
+        for line in playlist.splitlines():
+            line = line.strip()
+            if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+                sequence = int(line.split(':', 1)[1])
+            elif line.startswith('#EXT-X-TARGETDURATION:'):
+                target_duration = float(line.split(':', 1)[1])
+            elif line.startswith('#EXT-X-ENDLIST'):
+                ended = True
+            elif line and not line.startswith('#'):
+                uris.append(line)
+        return sequence, target_duration, uris, ended
+
+
 class FFProbe(PopenBasedBackend):
     def __init__(self, **kwargs):
         """
@@ -111,17 +467,28 @@ class FFProbe(PopenBasedBackend):
         super(FFProbe, self).__init__(**kwargs)
         self.ffprobe = kwargs.pop('ffprobe_path', FFPROBE_PATH) or FFPROBE_PATH
 
-    def probe(self, path):
+    def probe(self, path, timeout=None):
+        """
+        timeout: seconds. None means no deadline. The probe is killed when it expires, and the result is empty.
+        """
         command = [
             self.ffprobe,
             '-hide_banner',
             '-loglevel', 'panic',
+        ]
+        if timeout:
+            # a live stream never ends: bound the network reads and the stream analysis, in microseconds.
+            command += [
+                '-rw_timeout', str(int(timeout * 1000000)),
+                '-analyzeduration', str(int(timeout * 1000000 / 2)),
+            ]
+        command += [
             '-print_format', 'json',
             '-show_streams',
             '-show_format',
             path
         ]
-        self.start(command).communicate()
+        self.start(command).communicate(timeout=timeout)
 
         return FFProbeResult(self.stdout_str)
 
@@ -138,6 +505,26 @@ class FFMpeg(PopenBasedBackend):
 
     def insert_metadata(self, input_path: str, metadata, output_path: str):
 
+        command = [
+            self.ffmpeg,
+            '-hide_banner',
+            '-y',
+            '-loglevel', 'panic',
+            '-i', input_path
+        ]
+
+        command += self.metadata_arguments(metadata)
+
+        command += [
+            '-codec', 'copy',
+            output_path
+        ]
+
+        with metrics.timer('ffmpeg_remux_seconds'):
+            return self.start(command).communicate()
+
+    @staticmethod
+    def metadata_arguments(metadata):
         if isinstance(metadata, dict):
             mo = FFMpegMetadata(**metadata)
         elif isinstance(metadata, FFMpegMetadata):
@@ -145,21 +532,109 @@ class FFMpeg(PopenBasedBackend):
         else:
             mo = {}
 
+        arguments = []
+        for key, val in mo.items():
+            if val:
+                arguments += ['-metadata', ('%s=%s' % (key, val))]
+
+        return arguments
+
+    def concat(self, input_paths, output_path: str):
+        """
+        Join input files into output_path using the concat demuxer. Streams are copied, not re-encoded.
+        All inputs must share the same codec parameters, e.g. segments of the same radio stream.
+        """
+        list_fd, list_path = mkstemp(suffix='.txt')
+        with fdopen(list_fd, 'w') as f:
+            for path in input_paths:
+                f.write('file \'%s\'\n' % path.replace('\'', '\'\\\'\''))
+
         command = [
             self.ffmpeg,
             '-hide_banner',
             '-y',
             '-loglevel', 'panic',
-            '-i', input_path
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', list_path,
+            '-codec', 'copy',
+            output_path
         ]
 
-        for key, val in mo.items():
-            if val:
-                command += ['-metadata', ('%s=%s' % (key, val))]
+        try:
+            return self.start(command).communicate()
+        finally:
+            unlink(list_path)
+
+
+class FFMpegCapture(FFMpeg):
+    """
+    Capture backend which records and tags in one pass.
+    ffmpeg reads the stream and muxes it into the output file with metadata, so no post-process rewrite is needed.
+    """
+
+    tags_while_recording = True
+
+    def __init__(self, **kwargs):
+        super(FFMpegCapture, self).__init__(**kwargs)
+        self.wait_reason = None
+
+    @property
+    def is_recording(self):
+        return self.is_working
+
+    def record(self, source_path: str, dump_file: str, metadata=None):
+        command = [
+            self.ffmpeg,
+            '-hide_banner',
+            '-y',
+            '-loglevel', 'panic',
+            '-i', source_path
+        ]
+
+        command += self.metadata_arguments(metadata)
 
         command += [
             '-codec', 'copy',
-            output_path
+            dump_file
         ]
 
-        return self.start(command).communicate()
+        return self.start(command, _stdout=DEVNULL, _stderr=DEVNULL)
+
+    def wait(self, duration):
+        if duration:
+            self.wait_reason = self.wait_for(duration)
+        return self
+
+    def interrupt(self):
+        """
+        Same as PopenBasedBackend.interrupt(), but ffmpeg is asked to finish the output with 'q'.
+        """
+        self._interrupted.set()
+        process = self.process
+        if process is not None:
+            try:
+                process.stdin.write(b'q')
+                process.stdin.flush()
+            except (OSError, ValueError):
+                process.terminate()
+
+    def stop(self, timeout=5):
+        """
+        'q' makes ffmpeg finish the output, e.g. writing the moov atom of m4a files. Terminated if it takes too long.
+        """
+        if self.is_working:
+            try:
+                self.process.stdin.write(b'q')
+                self.process.stdin.flush()
+                self.process.wait(timeout=timeout)
+            except (OSError, TimeoutExpired):
+                self.process.terminate()
+            return self.communicate(timeout=timeout)
+
+
+capture_backends = {
+    'mplayer': MPlayer,
+    'native': HttpStreamCapture,
+    'ffmpeg': FFMpegCapture,
+}
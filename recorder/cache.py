@@ -0,0 +1,91 @@
+from datetime import date
+from json import (
+    dumps as json_dumps,
+    loads as json_loads,
+)
+from sqlite3 import connect
+from threading import Lock
+from time import time
+
+
+class PlaylistCache(object):
+    """
+    Crawled playlists on disk, keyed by (program id, date), in an SQLite file.
+
+    A playlist of a past date is final: it is served as it is, without any request.
+    Others (today's, or an empty one which may be filled later) are served for 'revalidate' seconds.
+    """
+
+    def __init__(self, path, revalidate=600, max_entries=10000, max_age=0):
+        """
+        :param path:        SQLite file path.
+        :param revalidate:  seconds to serve playlists which are not final.
+        :param max_entries: evict the oldest entries beyond this. 0 means no limit.
+        :param max_age:     evict entries older than this, in seconds. 0 means no limit.
+        """
+        self.path = path
+        self.revalidate = revalidate
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+        self._lock = Lock()
+        self._conn = connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS playlists ('
+                ' program_id INTEGER NOT NULL,'
+                ' program_date TEXT NOT NULL,'
+                ' playlist TEXT NOT NULL,'
+                ' fetched_at REAL NOT NULL,'
+                ' final INTEGER NOT NULL,'
+                ' PRIMARY KEY (program_id, program_date))'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS playlists_fetched_at ON playlists (fetched_at)')
+
+    def get(self, program_id, program_date):
+        """
+        Returns the cached playlist, or None if there is none or it needs revalidation.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT playlist, fetched_at, final FROM playlists WHERE program_id=? AND program_date=?',
+                (program_id, program_date)
+            ).fetchone()
+
+        if not row:
+            return None
+        playlist, fetched_at, final = row
+        if not final and time() - fetched_at >= self.revalidate:
+            return None
+        return json_loads(playlist)
+
+    def put(self, program_id, program_date, playlist):
+        final = bool(playlist) and program_date < date.today().strftime('%Y-%m-%d')
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?, ?)',
+                (program_id, program_date, json_dumps(playlist, ensure_ascii=False), time(), int(final))
+            )
+            self._evict()
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM playlists')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM playlists').fetchone()[0]
+
+    def _evict(self):
+        if self.max_age:
+            self._conn.execute('DELETE FROM playlists WHERE fetched_at < ?', (time() - self.max_age, ))
+        if self.max_entries:
+            self._conn.execute(
+                'DELETE FROM playlists WHERE rowid IN ('
+                ' SELECT rowid FROM playlists ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries, )
+            )
@@ -1,23 +1,65 @@
+import asyncio
+from codecs import (
+    BOM_UTF8,
+    getincrementaldecoder,
+)
+from email.parser import Parser
+from io import BytesIO
 from http.cookiejar import LWPCookieJar, LoadError
-from http.client import HTTPMessage
+from http.client import (
+    HTTPConnection,
+    HTTPException,
+    HTTPMessage,
+    HTTPSConnection,
+)
 from re import (
     compile as re_compile,
     IGNORECASE
 )
-from os.path import exists as path_exists
-from time import sleep
-from urllib.parse import urlencode, parse_qsl
+from itertools import chain
+from os import (
+    chmod,
+    replace,
+    umask,
+    unlink,
+)
+from os.path import (
+    abspath,
+    basename,
+    dirname,
+    exists as path_exists,
+)
+from shutil import copymode
+from tempfile import mkstemp
+from threading import Lock
+from time import monotonic
+from urllib.error import (
+    HTTPError,
+    URLError,
+)
+from urllib.parse import (
+    urlencode,
+    urljoin,
+    urlsplit,
+    parse_qsl,
+)
 from urllib.request import (
     build_opener,
     HTTPCookieProcessor,
     Request,
     urlopen
 )
+from urllib.response import addinfourl
 from http.cookiejar import Cookie
 import requests
 
-meta_equiv_expr = re_compile(b'<meta.*?http-equiv="content-type".*?content="(.+);\s*charset=(.+)".*>', IGNORECASE)
-meta_expr = re_compile(b'<meta\s+.*?(charset="(.+?)").*?>')
+from .ratelimit import (
+    RateLimiter,
+    host_of,
+)
+
+meta_equiv_expr = re_compile(rb'<meta.*?http-equiv="content-type".*?content="(.+);\s*charset=(.+)".*>', IGNORECASE)
+meta_expr = re_compile(rb'<meta\s+.*?(charset="(.+?)").*?>')
 charset_expr = re_compile(r'(.+)\s*;\s+charset=([^\s]+)')
 
 
@@ -45,6 +87,9 @@ class ConnectorMixin(object):
 
         return url + ('' if not params else '?' + urlencode(params))
 
+    # as the HTML spec's prescan, charset declarations are looked for only in the beginning of the content.
+    charset_sniff_size = 4096
+
     @staticmethod
     def detect_charset(headers, content, fallback_charset='utf-8'):
         """
@@ -60,6 +105,10 @@ class ConnectorMixin(object):
 
         # damn! content-type header not found!
         # charset is in the content. Let's parse
+        content = content[:ConnectorMixin.charset_sniff_size]
+        if content.startswith(BOM_UTF8):
+            return 'utf-8'
+
         meta_found = meta_expr.search(content)
         if meta_found:
             # <meta charset="...."> found
@@ -72,22 +121,203 @@ class ConnectorMixin(object):
 
         return fallback_charset
 
+    @classmethod
+    def decode_content(cls, headers, raw_content, fallback_charset='utf-8'):
+        """
+        Decode raw_content by the detected charset. Charsets in a fallback list are tried in order.
+        """
+        charset = cls.detect_charset(
+            headers=headers,
+            content=raw_content,
+            fallback_charset=fallback_charset
+        )
+
+        # decode response content by charset
+        if isinstance(charset, str):
+            return raw_content.decode(charset)
+
+        # try the whole content only by charsets decoding its beginning, to avoid full decodes bound to fail.
+        sample = raw_content[:cls.charset_sniff_size]
+        candidates = [c for c in charset if FallbackDecoder.decodes(c, sample)]
+        for c in candidates:
+            try:
+                return raw_content.decode(c)
+            except UnicodeDecodeError:
+                pass
+
+        raise UnicodeDecodeError(
+            ', '.join(charset), raw_content, 0, len(raw_content), 'none of the charsets decodes the content'
+        )
+
+    def host_charset(self, url, headers, content):
+        """
+        detect_charset(), remembered for the host when it is not in the headers.
+         A fallback list is narrowed down to the charset decoding the beginning of the content.
+         The remembered charset is forgotten when it does not decode the beginning of the content.
+        """
+        if isinstance(headers, HTTPMessage):
+            charset_in_header = headers.get_content_charset()
+            if charset_in_header:
+                return charset_in_header
+
+        host = host_of(url)
+        charset = self._host_charsets.get(host)
+        if charset and not FallbackDecoder.decodes(charset, content[:self.charset_sniff_size]):
+            # e.g. iter_text() settles on it with errors='replace': a wrong one is never found out later.
+            self._host_charsets.pop(host, None)
+            charset = None
+        if not charset:
+            charset = self.detect_charset(None, content, self.fallback_charset)
+            if not isinstance(charset, str):
+                charset = FallbackDecoder.choose(charset, content[:self.charset_sniff_size])
+            self._host_charsets[host] = charset
+        return charset
+
+    def decode_response(self, url, headers, raw_content):
+        """
+        Decode raw_content by host_charset(). If it fails, the host's charset is forgotten and decode_content() decides.
+        """
+        charset = self.host_charset(url, headers, raw_content)
+        try:
+            return raw_content.decode(charset)
+        except UnicodeDecodeError:
+            self._host_charsets.pop(host_of(url), None)
+            return self.decode_content(headers, raw_content, self.fallback_charset)
+
+
+class FallbackDecoder(object):
+    """
+    Incremental decoder for a list of charsets. It settles on the first one decoding the first 'sample_size' bytes.
+
+    Raw bytes are kept only until it settles. An undecodable sequence after that is replaced
+     instead of decoding everything again by another charset.
+    """
+
+    def __init__(self, charsets, sample_size=4096):
+        self.charsets = [charsets] if isinstance(charsets, str) else list(charsets)
+        self.sample_size = sample_size
+        self.charset = None
+        self._decoder = None
+        self._pending = b''
+
+        if len(self.charsets) == 1:
+            self._settle(self.charsets[0])
+
+    def iter_decode(self, chunks):
+        """
+        Yields decoded text of byte chunks, the end included.
+        """
+        for chunk in chunks:
+            text = self.decode(chunk)
+            if text:
+                yield text
+        text = self.decode(b'', final=True)
+        if text:
+            yield text
+
+    def decode(self, data, final=False):
+        if self._decoder is not None:
+            return self._decoder.decode(data, final)
+
+        self._pending += data
+        if len(self._pending) < self.sample_size and not final:
+            return ''
+
+        sample, self._pending = self._pending, b''
+        self._settle(self.choose(self.charsets, sample, final))
+        return self._decoder.decode(sample, final)
+
+    def _settle(self, charset):
+        self.charset = charset
+        self._decoder = getincrementaldecoder(charset)(errors='replace')
+
+    @classmethod
+    def choose(cls, charsets, sample, final=False):
+        """
+        The first charset decoding the sample, or the last one if none does.
+        """
+        for charset in charsets:
+            if cls.decodes(charset, sample, final):
+                return charset
+        return charsets[-1]
+
+    @staticmethod
+    def decodes(charset, sample, final=False):
+        try:
+            # not final: the sample may end in the middle of a character.
+            getincrementaldecoder(charset)().decode(sample, final)
+            return True
+        except UnicodeDecodeError:
+            return False
+
+
+def iter_response(response, chunk_size=64 * 1024):
+    """
+    Yields the body of a file-like response in chunks.
+    """
+    return iter(lambda: response.read(chunk_size), b'')
+
+
+def current_umask():
+    mask = umask(0)
+    umask(mask)
+    return mask
+
+
+# mode of a new file by open(), as umask() is not safe to call while other threads create files.
+new_file_mode = 0o666 & ~current_umask()
+
+
+def write_atomic(path, chunks, mode='wb'):
+    """
+    Write chunks to a temporary file next to path, then rename it to path. Readers never see a partial file.
+    The file keeps the permissions of the file it replaces, or gets those of a new file by open().
+    Returns the length written.
+
+    :param mode: 'wb' for bytes chunks, 'w' for str chunks.
+    """
+    fd, temp_path = mkstemp(prefix='.%s.' % basename(path), suffix='.part', dir=dirname(abspath(path)))
+    written = 0
+    try:
+        with open(fd, mode) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                written += len(chunk)
+        # mkstemp() creates the file with 0600.
+        try:
+            copymode(path, temp_path)
+        except FileNotFoundError:
+            chmod(temp_path, new_file_mode)
+        replace(temp_path, path)
+    finally:
+        if path_exists(temp_path):
+            unlink(temp_path)
+    return written
+
 
 class BaseConnector(object):
     """
     Connector base class
     """
 
-    def __init__(self, delay=3, extra_headers=None):
+    # set True to keep the last content for save_last_content().
+    keep_last_content = False
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, delay=3, extra_headers=None, rate_limiter=None):
         """
         Keywords
         --------
-        delay: mandatory halt after each response. May be zero.
+        delay: minimum seconds between starts of two requests to a host. May be zero.
         extra_headers: dict for additional request headers
+        rate_limiter: RateLimiter, which may be shared with other connectors. Overrides delay.
         """
         self._delay = delay
         self._extra_headers = extra_headers or {}
         self._last_content = ''
+        self._host_charsets = {}
+        self.rate_limiter = rate_limiter or RateLimiter.from_delay(delay)
 
     def request(self, url, method='GET', params=None, data=None, headers=None):
         raise NotImplemented()
@@ -98,10 +328,28 @@ class BaseConnector(object):
     def post(self, url, data=None, headers=None):
         return self.request(url, method='POST', data=data, headers=headers)
 
+    def get_stream(self, url, params=None, headers=None, chunk_size=None):
+        """
+        Yields the raw body of a GET request in chunks, not decoded. Close the generator to stop early.
+        """
+        raise NotImplementedError()
+
+    def download_to(self, path, url, params=None, headers=None, chunk_size=None):
+        """
+        Save the raw body of a GET request to path atomically, never holding it in memory as a whole.
+        Returns the number of bytes written.
+        """
+        return write_atomic(path, self.get_stream(url, params=params, headers=headers, chunk_size=chunk_size))
+
     def save_last_content(self, file_name):
         with open(file_name, 'w') as f:
             f.write(self._last_content)
 
+    def _keep(self, content):
+        if self.keep_last_content:
+            self._last_content = content
+        return content
+
 
 class BasicConnector(ConnectorMixin, BaseConnector):
     """
@@ -109,17 +357,20 @@ class BasicConnector(ConnectorMixin, BaseConnector):
     As cookie is NOT supported, you may want to use SimpleCookieConnector, or RequestsConnector
     """
 
-    def __init__(self, delay=0, extra_headers=None, fallback_charset='utf-8'):
+    def __init__(self, delay=0, extra_headers=None, fallback_charset='utf-8', rate_limiter=None):
         """
         Keywords
         --------
          - fallback_charset: a string or a list. Used when no charset hint is found.
         """
-        super(BasicConnector, self).__init__(delay, extra_headers)
+        super(BasicConnector, self).__init__(delay, extra_headers, rate_limiter)
         self.fallback_charset = fallback_charset
 
-    def request(self, url, method='GET', params=None, data=None, headers=None):
-
+    def open(self, url, method='GET', params=None, data=None, headers=None):
+        """
+        Returns the response object, not read yet. Close it after use.
+        304 Not Modified is returned as a response, not raised.
+        """
         headers = (headers or {})
         headers.update(self._extra_headers)
 
@@ -136,37 +387,271 @@ class BasicConnector(ConnectorMixin, BaseConnector):
         else:
             raise AttributeError('GET or POST is allowed.')
 
-        response = urlopen(request)
-        raw_content = response.read()
-        response.close()
+        try:
+            return urlopen(request)
+        except HTTPError as e:
+            if e.code == 304:
+                return e
+            raise
 
-        charset = self.detect_charset(
-            headers=response.headers,
-            content=raw_content,
-            fallback_charset=self.fallback_charset
-        )
+    def request(self, url, method='GET', params=None, data=None, headers=None):
+        with self.rate_limiter.limit(url):
+            response = self.open(url, method=method, params=params, data=data, headers=headers)
+            raw_content = response.read()
+            response.close()
 
-        # decode response content by charset
-        if isinstance(charset, str):
-            return raw_content.decode(charset)
-        elif isinstance(charset, list):
-            for c in charset:
+        return self.decode_response(url, response.headers, raw_content)
+
+    def iter_text(self, url, method='GET', params=None, data=None, headers=None, chunk_size=8192):
+        """
+        Yields the decoded content in chunks, as it is received. Stop iterating, or close() the generator,
+         to stop reading the rest.
+
+        The charset is detected by the headers and the first chunk, or the first fallback charset decoding it.
+        """
+        with self.rate_limiter.limit(url):
+            response = self.open(url, method=method, params=params, data=data, headers=headers)
+            try:
+                raw_chunk = response.read(chunk_size)
+                decoder = FallbackDecoder(self.host_charset(url, response.headers, raw_chunk), chunk_size)
+                for text in decoder.iter_decode(chain([raw_chunk], iter_response(response, chunk_size))):
+                    yield text
+            finally:
+                response.close()
+
+    def get_stream(self, url, params=None, headers=None, chunk_size=None):
+        with self.rate_limiter.limit(url):
+            response = self.open(url, params=params, headers=headers)
+            try:
+                for chunk in iter_response(response, chunk_size or self.chunk_size):
+                    yield chunk
+            finally:
+                response.close()
+
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections by (scheme, host, port). Thread-safe.
+    """
+
+    def __init__(self, pool_size=4, idle_timeout=30):
+        """
+        :param pool_size:    maximum number of idle connections kept for a host.
+        :param idle_timeout: seconds. Connections idle longer than this are closed, not reused.
+        """
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = Lock()
+
+    def acquire(self, key, timeout=None):
+        """
+        Returns (connection, reused). An idle connection if any, or a new one.
+        """
+        now = monotonic()
+        stale = []
+        connection = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, released_at = idle.pop()
+                if now - released_at < self.idle_timeout:
+                    connection = conn
+                    break
+                stale.append(conn)
+        for conn in stale:
+            conn.close()
+
+        if connection:
+            connection.timeout = timeout
+            # the attribute is only for the next connect(). the socket is open already.
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            return connection, True
+
+        scheme, host, port = key
+        connection_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+        return connection_class(host, port, timeout=timeout), False
+
+    def release(self, key, connection, reusable=True):
+        if reusable:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.pool_size:
+                    idle.append((connection, monotonic()))
+                    return
+        connection.close()
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(x) for x in self._idle.values())
+
+
+class PooledResponse(object):
+    """
+    http.client response which goes back to its pool on close(), if it is fully read.
+    """
+
+    def __init__(self, url, response, release):
+        self.url = url
+        self._response = response
+        self._release = release
+
+    def __getattr__(self, item):
+        return getattr(self._response, item)
+
+    def geturl(self):
+        return self.url
+
+    # a rest of the body shorter than this is read out on close(), so that the connection is reused.
+    drain_limit = 64 * 1024
+
+    def close(self):
+        if self._release:
+            length = self._response.length
+            if not self._response.isclosed() and length is not None and length <= self.drain_limit:
+                # e.g. 304: nothing to read, but the connection is not done until read.
                 try:
-                    return raw_content.decode(c)
-                except UnicodeDecodeError:
+                    self._response.read()
+                except (HTTPException, OSError):
                     pass
+            # a connection in the middle of a body cannot serve the next request.
+            reusable = self._response.isclosed() and not self._response.will_close
+            self._response.close()
+            self._release(reusable)
+            self._release = None
+
+    def discard(self):
+        """
+        Close the response, and its connection as well, never to be reused.
+        """
+        if self._release:
+            self._response.close()
+            self._release(False)
+            self._release = None
 
-        raise UnicodeDecodeError()
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PooledConnector(BasicConnector):
+    """
+    BasicConnector over keep-alive connections. Successive requests to a host share a TCP (and TLS) connection.
+
+    Connections are kept in a ConnectionPool, shared_pool by default, so that every PooledConnector shares them.
+    """
+
+    shared_pool = ConnectionPool()
+
+    redirect_codes = (301, 302, 303, 307, 308)
+
+    # requests sent again on a new connection, when a reused one fails. The server may have processed others.
+    idempotent_methods = ('GET', 'HEAD')
+
+    def __init__(self, delay=0, extra_headers=None, fallback_charset='utf-8', **kwargs):
+        """
+        Keywords
+        --------
+         - pool:          ConnectionPool. Defaults to shared_pool.
+         - timeout:       socket timeout in seconds. Defaults to 30.
+         - max_redirects: defaults to 5.
+         - rate_limiter:  see BaseConnector.
+        """
+        super(PooledConnector, self).__init__(delay, extra_headers, fallback_charset, kwargs.pop('rate_limiter', None))
+        pool = kwargs.pop('pool', None)
+        self.pool = pool if pool is not None else self.shared_pool
+        self.timeout = kwargs.pop('timeout', 30) or 30
+        self.max_redirects = kwargs.pop('max_redirects', 5) or 5
+
+    def open(self, url, method='GET', params=None, data=None, headers=None):
+        """
+        Returns the response object, not read yet. Close it after use, so that its connection is reused.
+        Errors are raised like urlopen(): URLError, and HTTPError for 4xx, 5xx except 304 Not Modified.
+        """
+        headers = (headers or {})
+        headers.update(self._extra_headers)
+
+        if method.upper() == 'GET':
+            url = self.create_get_url(url, params)
+            body = None
+        elif method.upper() == 'POST':
+            body = bytes(urlencode(data), 'utf-8')
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        else:
+            raise AttributeError('GET or POST is allowed.')
+        method = method.upper()
+
+        for _ in range(self.max_redirects + 1):
+            response = self._send(url, method, body, headers)
+            if response.status not in self.redirect_codes or not response.getheader('Location'):
+                break
+            response.read()
+            response.close()
+            url = urljoin(url, response.getheader('Location'))
+            if response.status == 303 or (response.status in (301, 302) and method == 'POST'):
+                method, body = 'GET', None
+                headers.pop('Content-Type', None)
+        else:
+            raise HTTPError(url, response.status, 'too many redirects', response.headers, None)
+
+        if response.status >= 400:
+            # the error keeps the beginning of the body, as urlopen() does. The connection is not reused.
+            try:
+                content = response.read(PooledResponse.drain_limit)
+            except (HTTPException, OSError):
+                content = b''
+            response.discard()
+            raise HTTPError(url, response.status, response.reason, response.headers, BytesIO(content))
+
+        return response
+
+    def close(self):
+        self.pool.close()
+
+    def _send(self, url, method, body, headers):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise ValueError('unsupported url scheme \'%s\'' % scheme)
+        key = (scheme, parts.hostname, parts.port or (443 if scheme == 'https' else 80))
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+        while True:
+            connection, reused = self.pool.acquire(key, self.timeout)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+            except (HTTPException, OSError) as e:
+                connection.close()
+                if reused and method in self.idempotent_methods:
+                    # the server has closed the idle connection. Try once again with a new one.
+                    continue
+                # as urlopen() does.
+                raise URLError(e)
+            return PooledResponse(url, response, lambda reusable: self.pool.release(key, connection, reusable))
 
 
 class SimpleCookieConnector(ConnectorMixin, BaseConnector):
-    def __init__(self, cookie_file, delay=3, extra_headers=None):
+    def __init__(self, cookie_file, delay=3, extra_headers=None, rate_limiter=None):
         """
         Keywords
         --------
          - cookie_file
         """
-        super(SimpleCookieConnector, self).__init__(delay, extra_headers)
+        super(SimpleCookieConnector, self).__init__(delay, extra_headers, rate_limiter)
 
         self._cookie_file = cookie_file
         self._cookie_jar = LWPCookieJar(filename=self._cookie_file)
@@ -196,15 +681,23 @@ class SimpleCookieConnector(ConnectorMixin, BaseConnector):
 
     def resolve(self, request):
         self._last_request = request
-        self._last_response = self._opener.open(self._last_request)
-        content = self._last_response.read()
-        self._last_response.close()
-        sleep(self._delay)
+        with self.rate_limiter.limit(request.full_url):
+            self._last_response = self._opener.open(self._last_request)
+            content = self._last_response.read()
+            self._last_response.close()
 
         charset = self.detect_charset(headers=self._last_response.headers, content=content)
-        self._last_content = content.decode(charset)
+        return self._keep(content.decode(charset))
 
-        return self._last_content
+    def get_stream(self, url, params=None, headers=None, chunk_size=None):
+        request = Request(self.create_get_url(url, params), headers=dict(headers or {}, **self._extra_headers))
+        with self.rate_limiter.limit(url):
+            response = self._opener.open(request)
+            try:
+                for chunk in iter_response(response, chunk_size or self.chunk_size):
+                    yield chunk
+            finally:
+                response.close()
 
     def save_cookie(self):
         self._cookie_jar.save(self._cookie_file)
@@ -221,36 +714,61 @@ class RequestsConnector(BaseConnector):
     Connector implemented with requests library, more robust and advanced.
     """
 
-    def __init__(self, cookie_file, delay=3, extra_headers=None):
+    def __init__(self, cookie_file, delay=3, extra_headers=None, pool_size=4, rate_limiter=None):
         """
         Keywords
         --------
          - cookie_file
+         - pool_size: keep-alive connections kept for a host.
         """
-        super(RequestsConnector, self).__init__(delay, extra_headers)
+        super(RequestsConnector, self).__init__(delay, extra_headers, rate_limiter)
 
         self._cookie_file = cookie_file
         self._cookie_jar = requests.cookies.RequestsCookieJar()
         self._last_response = None
 
+        # a session reuses connections: a login flow does not pay for a handshake on each page.
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
         self.load_cookie()
 
     def request(self, url, method='GET', params=None, data=None, headers=None):
         headers = headers or {}
         headers.update(self._extra_headers)
-        self._last_response = requests.request(
-            url=url,
-            method=method,
-            params=params,
-            data=data,
-            headers=headers,
-            cookies=self._cookie_jar
-        )
-        self._last_content = self._last_response.text
-        self._cookie_jar.update(self._last_response.cookies)
-        sleep(self._delay)
+        with self.rate_limiter.limit(url):
+            response = self._session.request(
+                url=url,
+                method=method,
+                params=params,
+                data=data,
+                headers=headers,
+                cookies=self._cookie_jar
+            )
+            content = response.text
+        self._cookie_jar.update(response.cookies)
+        if self.keep_last_content:
+            # the response holds the body, too.
+            self._last_response = response
+
+        return self._keep(content)
+
+    def get_stream(self, url, params=None, headers=None, chunk_size=None):
+        headers = dict(headers or {}, **self._extra_headers)
+        with self.rate_limiter.limit(url):
+            response = self._session.get(url, params=params, headers=headers, cookies=self._cookie_jar, stream=True)
+            try:
+                response.raise_for_status()
+                self._cookie_jar.update(response.cookies)
+                for chunk in response.iter_content(chunk_size or self.chunk_size):
+                    yield chunk
+            finally:
+                response.close()
 
-        return self._last_content
+    def close(self):
+        self._session.close()
 
     def save_cookie(self, file_name=None, **kwargs):
         file_name = file_name or self._cookie_file
@@ -281,6 +799,194 @@ class RequestsConnector(BaseConnector):
         self._cookie_jar.set(name, value, **kwargs)
 
 
+class AsyncConnector(ConnectorMixin, BaseConnector):
+    """
+    Connector on asyncio streams. get(), post(), and request() are coroutines,
+     so that many requests are made concurrently on one thread.
+
+    The delay is kept between requests to the same host by the rate limiter, without blocking the event loop.
+    """
+
+    redirect_codes = (301, 302, 303, 307, 308)
+
+    def __init__(self, cookie_file=None, delay=3, extra_headers=None, fallback_charset='utf-8', **kwargs):
+        """
+        Keywords
+        --------
+         - cookie_file:      loaded if exists. Cookies are kept in memory if omitted.
+         - fallback_charset: a string or a list. Used when no charset hint is found.
+         - timeout:          seconds to connect and read each response, redirects each. Defaults to 30.
+                             The wait for the rate limiter is not counted: queued requests do not time out.
+         - max_redirects:    defaults to 5.
+         - rate_limiter:     see BaseConnector.
+        """
+        super(AsyncConnector, self).__init__(delay, extra_headers, kwargs.pop('rate_limiter', None))
+        self.fallback_charset = fallback_charset
+        self.timeout = kwargs.pop('timeout', 30) or 30
+        self.max_redirects = kwargs.pop('max_redirects', 5) or 5
+
+        self._cookie_file = cookie_file
+        self._cookie_jar = LWPCookieJar(filename=cookie_file)
+        if cookie_file:
+            self.load_cookie()
+
+    async def request(self, url, method='GET', params=None, data=None, headers=None):
+        headers = (headers or {})
+        headers.update(self._extra_headers)
+
+        if method.upper() == 'GET':
+            url = self.create_get_url(url, params)
+            body = None
+        elif method.upper() == 'POST':
+            body = bytes(urlencode(data), 'utf-8')
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        else:
+            raise AttributeError('GET or POST is allowed.')
+
+        response_headers, raw_content = await self._follow(url, method.upper(), body, headers)
+
+        return self._keep(self.decode_response(url, response_headers, raw_content))
+
+    async def _follow(self, url, method, body, headers):
+        for _ in range(self.max_redirects + 1):
+            status, reason, response_headers, raw_content = await self._exchange(url, method, body, headers)
+            if status not in self.redirect_codes or not response_headers.get('Location'):
+                break
+            url = urljoin(url, response_headers.get('Location'))
+            if status == 303 or (status in (301, 302) and method == 'POST'):
+                method, body = 'GET', None
+                headers.pop('Content-Type', None)
+        else:
+            raise HTTPError(url, status, 'too many redirects', response_headers, None)
+
+        if status >= 400:
+            raise HTTPError(url, status, reason, response_headers, None)
+
+        return response_headers, raw_content
+
+    async def _exchange(self, url, method, body, headers):
+        """
+        One HTTP/1.1 request on a new connection. Returns (status, reason, headers, raw content).
+        """
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise ValueError('unsupported url scheme \'%s\'' % scheme)
+        port = parts.port or (443 if scheme == 'https' else 80)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+        cookie_request = Request(url)
+        self._cookie_jar.add_cookie_header(cookie_request)
+
+        lines = [
+            '%s %s HTTP/1.1' % (method, path),
+            'Host: %s' % (parts.hostname if parts.port is None else '%s:%d' % (parts.hostname, port)),
+            'Connection: close',
+            'Accept-Encoding: identity',
+        ]
+        if cookie_request.has_header('Cookie'):
+            lines.append('Cookie: %s' % cookie_request.get_header('Cookie'))
+        if body is not None:
+            lines.append('Content-Length: %d' % len(body))
+        lines.extend('%s: %s' % (k, v) for k, v in headers.items())
+
+        message = ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1') + (body or b'')
+
+        # the token is taken before the timeout starts: a request queued behind others to the host does not time out.
+        async with self.rate_limiter.limit(url):
+            try:
+                status, reason, response_headers, raw_content = await asyncio.wait_for(
+                    self._transfer(parts, port, method, message),
+                    self.timeout
+                )
+            except asyncio.TimeoutError as e:
+                raise URLError(e)
+
+        self._cookie_jar.extract_cookies(addinfourl(None, response_headers, url), Request(url))
+
+        return status, reason, response_headers, raw_content
+
+    async def _transfer(self, parts, port, method, message):
+        """
+        Connects, sends the message, and reads the response. Returns (status, reason, headers, raw content).
+        """
+        try:
+            reader, writer = await asyncio.open_connection(
+                parts.hostname, port, ssl=True if parts.scheme.lower() == 'https' else None
+            )
+        except OSError as e:
+            raise URLError(e)
+
+        try:
+            writer.write(message)
+            await writer.drain()
+
+            head = (await reader.readuntil(b'\r\n\r\n')).decode('iso-8859-1')
+            status_line, _, header_block = head.partition('\r\n')
+            status_parts = status_line.split(' ', 2)
+            status = int(status_parts[1])
+            reason = status_parts[2] if len(status_parts) > 2 else ''
+            response_headers = Parser(_class=HTTPMessage).parsestr(header_block)
+
+            if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+                raw_content = b''
+            elif 'chunked' in response_headers.get('Transfer-Encoding', '').lower():
+                raw_content = await self._read_chunked(reader)
+            elif response_headers.get('Content-Length'):
+                raw_content = await reader.readexactly(int(response_headers.get('Content-Length')))
+            else:
+                raw_content = await reader.read()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, IndexError) as e:
+            raise URLError('malformed response from %s: %s' % (parts.netloc, e))
+        finally:
+            writer.close()
+
+        return status, reason, response_headers, raw_content
+
+    @staticmethod
+    async def _read_chunked(reader):
+        chunks = []
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b';')[0].strip(), 16)
+            if not size:
+                # trailers, until an empty line
+                while (await reader.readline()).strip():
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    def get_stream(self, url, params=None, headers=None, chunk_size=None):
+        """
+        Not supported: bodies are read as a whole. Use get(), or get_stream() of a blocking connector.
+        """
+        raise TypeError('AsyncConnector does not stream bodies: use get(), or PooledConnector.get_stream()')
+
+    def download_to(self, path, url, params=None, headers=None, chunk_size=None):
+        """
+        Not supported: see get_stream().
+        """
+        raise TypeError('AsyncConnector does not stream bodies: use PooledConnector.download_to()')
+
+    def save_cookie(self, file_name=None, **kwargs):
+        self._cookie_jar.save(file_name or self._cookie_file, **kwargs)
+
+    def load_cookie(self, file_name=None, **kwargs):
+        file_name = file_name or self._cookie_file
+        if path_exists(file_name):
+            self._cookie_jar.load(file_name, **kwargs)
+
+    def get_cookie(self, name, default=None):
+        for cookie in self._cookie_jar:
+            if cookie.name == name:
+                return cookie.value
+        return default
+
+    def set_cookie(self, name, value, **kwargs):
+        self._cookie_jar.set_cookie(requests.cookies.create_cookie(name, value, **kwargs))
+
+
 class UserAgents:
     """
     Sample user agent strings.
@@ -18,3 +18,19 @@ class AlreadyRecording(Exception):
 
 class InvalidChannelException(Exception):
     pass
+
+
+class UnsupportedTagLayoutException(Exception):
+    pass
+
+
+class InsufficientSpaceException(Exception):
+    def __init__(self, path, needed, available, label=''):
+        super(InsufficientSpaceException, self).__init__(
+            '%s%s: %d bytes needed, %d bytes available' % (
+                label + ': ' if label else '', path, needed, max(0, available)
+            )
+        )
+        self.path = path
+        self.needed = needed
+        self.available = available
@@ -0,0 +1,208 @@
+from atexit import register as atexit_register
+from json import dumps as json_dumps
+from os import replace
+from threading import Lock
+from time import (
+    monotonic,
+    time,
+)
+
+
+class _NullTimer(object):
+    """
+    Timer of disabled metrics: does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class Timer(object):
+    """
+    Observes the seconds spent in 'with' statement. An exception adds the 'error' label, its class name.
+    GeneratorExit, KeyboardInterrupt, and other exits which are not Exception are observed as normal ones.
+    """
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.begin = None
+
+    def __enter__(self):
+        self.begin = monotonic()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None and issubclass(exc_type, Exception):
+            labels = dict(self.labels, error=exc_type.__name__)
+        else:
+            labels = self.labels
+        self.metrics.observe(self.name, monotonic() - self.begin, **labels)
+
+
+class Metrics(object):
+    """
+    Timers and counters, written as JSON lines or Prometheus text.
+
+    Disabled by default. While disabled, count() and observe() return at once, and timer() returns a shared no-op
+     context manager, so instrumented code pays only for a call.
+    """
+
+    formats = ('jsonl', 'prometheus')
+
+    prefix = 'almond_'
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.format = 'jsonl'
+        self._lock = Lock()
+        self._counters = {}
+        self._timers = {}
+        self._file = None
+        self._flush_lock = Lock()
+        self._atexit_registered = False
+
+    def enable(self, path=None, output_format='jsonl'):
+        """
+        :param path:          jsonl: each observation is appended as a line, as it occurs.
+                              prometheus: the file is rewritten by flush(), and at exit. Long-running
+                               callers flush from time to time, e.g. RecordingScheduler after each job.
+                              None: metrics are only kept in memory. See snapshot().
+        :param output_format: 'jsonl', or 'prometheus'.
+        """
+        if output_format not in self.formats:
+            raise ValueError('invalid format \'%s\': supported: %s' % (output_format, ', '.join(self.formats)))
+        self.disable()
+        with self._lock:
+            self.path = path
+            self.format = output_format
+            if path and output_format == 'jsonl':
+                self._file = open(path, 'a', buffering=1)
+            if not self._atexit_registered:
+                atexit_register(self.disable)
+                self._atexit_registered = True
+            self.enabled = True
+
+    def disable(self):
+        """
+        Flush, and stop collecting. Collected metrics are kept until reset().
+        """
+        if not self.enabled:
+            return
+        self.flush()
+        with self._lock:
+            self.enabled = False
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._timers = {}
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._emit('counter', name, value, labels)
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            stats = self._timers.get(key)
+            if stats is None:
+                self._timers[key] = [1, seconds, seconds, seconds]
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = min(stats[2], seconds)
+                stats[3] = max(stats[3], seconds)
+            self._emit('timer', name, seconds, labels)
+
+    def timer(self, name, **labels):
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name, labels)
+
+    def snapshot(self):
+        """
+        Returns {'counters': [...], 'timers': [...]}. Each item has 'name' and 'labels',
+         with 'value' for a counter, or 'count', 'sum', 'min', 'max' for a timer.
+        """
+        with self._lock:
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            timers = [
+                {'name': name, 'labels': dict(labels), 'count': s[0], 'sum': s[1], 'min': s[2], 'max': s[3]}
+                for (name, labels), s in sorted(self._timers.items())
+            ]
+        return {'counters': counters, 'timers': timers}
+
+    def prometheus_text(self):
+        """
+        Counters as Prometheus counters, timers as summaries without quantiles.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for item in snapshot['counters']:
+            name = self.prefix + item['name']
+            if name not in typed:
+                lines.append('# TYPE %s counter' % name)
+                typed.add(name)
+            lines.append('%s%s %s' % (name, self._format_labels(item['labels']), item['value']))
+        for item in snapshot['timers']:
+            name = self.prefix + item['name']
+            if name not in typed:
+                lines.append('# TYPE %s summary' % name)
+                typed.add(name)
+            labels = self._format_labels(item['labels'])
+            lines.append('%s_count%s %d' % (name, labels, item['count']))
+            lines.append('%s_sum%s %.6f' % (name, labels, item['sum']))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """
+        Rewrite the Prometheus text file. JSON lines are written as they occur: nothing to do.
+        Thread-safe: the file is written to a temporary file, then renamed, one thread at a time.
+        """
+        if self.enabled and self.path and self.format == 'prometheus':
+            with self._flush_lock:
+                temp_path = self.path + '.tmp'
+                with open(temp_path, 'w') as f:
+                    f.write(self.prometheus_text())
+                replace(temp_path, self.path)
+
+    def _emit(self, kind, name, value, labels):
+        if self._file:
+            self._file.write(
+                json_dumps({'ts': time(), 'type': kind, 'name': name, 'value': value, 'labels': labels}) + '\n'
+            )
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in sorted(labels.items())
+        )
+
+
+# shared by all modules. Enabled by the scripts' --metrics option.
+metrics = Metrics()
@@ -1,26 +1,61 @@
+import asyncio
+from bisect import bisect_right
 from bs4 import BeautifulSoup
 from csv import reader as csv_reader
 from datetime import datetime
-from os import getcwd
+from html.parser import HTMLParser
+from itertools import chain
+from json import (
+    dump as json_dump,
+    load as json_load,
+)
+from os import (
+    getcwd,
+    getpid,
+    rename,
+    stat,
+    unlink,
+)
 from os.path import (
     abspath,
     exists as path_exists,
     join as path_join,
 )
+from marshal import (
+    dumps as marshal_dumps,
+    loads as marshal_loads,
+    version as marshal_version,
+)
 from re import compile as re_compile
-from .connectors import BasicConnector
+from .cache import PlaylistCache
+from .connectors import (
+    AsyncConnector,
+    FallbackDecoder,
+    PooledConnector,
+    iter_response,
+    write_atomic,
+)
+from .instrument import metrics
 
 
 class RadioProgramItem(object):
-    id = None
-    start_time = ''
-    show_title = ''
+    __slots__ = ('id', 'start_time', 'show_title', )
+
+    def __init__(self, id=None, start_time='', show_title=''):
+        self.id = id
+        self.start_time = start_time
+        self.show_title = show_title
 
 
 class MBCRadioProgramItem(RadioProgramItem):
-    channel = ''
-    homepage_slug = ''
-    playlist_slug = ''
+    __slots__ = ('channel', 'homepage_slug', 'playlist_slug', 'day', )
+
+    def __init__(self, id=None, start_time='', show_title='', channel='', homepage_slug='', playlist_slug='', day=''):
+        super(MBCRadioProgramItem, self).__init__(id, start_time, show_title)
+        self.channel = channel
+        self.homepage_slug = homepage_slug
+        self.playlist_slug = playlist_slug
+        self.day = day
 
     url_prefix = 'http://mini.imbc.com/manager/'
 
@@ -54,75 +89,425 @@ class MBCRadioProgramTable(object):
 
     programs = None
 
-    def __init__(self, table_path=None):
+    # bump this when the snapshot layout, or the program item classes change.
+    snapshot_format = 3
+
+    weekdays = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+    # bit mask of weekdays, Monday as bit 0.
+    every_day = 0x7f
+
+    def __init__(self, table_path=None, use_snapshot=True):
+        """
+        :param table_path:   CSV file path.
+        :param use_snapshot: keep a snapshot of the parsed table and its index next to the CSV file, at snapshot_path.
+        """
+        self._by_id = {}
+        self._by_channel = {}
+
         self.table_path = table_path or self.default_imbc_table_path
+        self.use_snapshot = use_snapshot
+        self.connector = PooledConnector()
 
         if not path_exists(self.table_path):
             self.download()
 
         self.load()
 
+    @property
+    def snapshot_path(self):
+        return self.table_path + '.snapshot'
+
     def load(self):
         with open(self.table_path, 'r') as f:
-            version_line = f.readline().strip()
-            self.version = int(version_line.split(':')[1].strip())
-            self.programs = []
-            reader = csv_reader(f)
-            for cols in reader:
-                item = MBCRadioProgramItem()
-                item.id = int(cols[0])
-                item.channel = cols[2]
-                item.start_time = cols[3]
-                item.show_title = cols[4]
-                item.homepage_slug = cols[5]
-                item.playlist_slug = cols[6]
-                self.programs.append(item)
+            self.version = self.parse_version(f.readline())
+
+            key = self.snapshot_key(f)
+            snapshot = self.load_snapshot(key) if self.use_snapshot else None
+            if snapshot is None:
+                # fields in the order of MBCRadioProgramItem arguments.
+                rows = [
+                    (int(cols[0]), cols[3], cols[4], cols[2], cols[5], cols[6], cols[1]) for cols in csv_reader(f)
+                ]
+                self.programs = [MBCRadioProgramItem(*x) for x in rows]
+                self.build_index()
+                if self.use_snapshot:
+                    self.save_snapshot(key, rows)
+            else:
+                rows, self._by_id, self._by_channel = snapshot
+                self.programs = [MBCRadioProgramItem(*x) for x in rows]
 
         return self.version, self.programs
 
-    def get_remote_version(self):
-        conn = BasicConnector()
-        content = conn.get(self.url)
-        version_line = content.split('\n')[0].strip()
+    def snapshot_key(self, f):
+        """
+        A snapshot is valid while the table's version header, mtime, and size are the same.
+        """
+        st = stat(f.fileno())
+        return self.snapshot_format, marshal_version, self.version, st.st_mtime_ns, st.st_size
+
+    def load_snapshot(self, key):
+        """
+        Returns (rows, id index, channel index) of the snapshot, or None if it is missing, stale, or unreadable.
+        """
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot_key, rows, by_id, by_channel = marshal_loads(f.read())
+        except Exception:
+            return None
+        if snapshot_key != key:
+            return None
+        return rows, by_id, by_channel
+
+    def save_snapshot(self, key, rows):
+        """
+        Write the snapshot atomically. A failure is not an error: the CSV file is parsed next time again.
+        Rows are plain tuples, and the indices hold positions of programs: marshal loads them faster than
+         the CSV reader, or pickle of the program items.
+        """
+        temp_path = '%s.%d.tmp' % (self.snapshot_path, getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(marshal_dumps((key, rows, self._by_id, self._by_channel)))
+            rename(temp_path, self.snapshot_path)
+        except OSError:
+            if path_exists(temp_path):
+                unlink(temp_path)
+
+    def build_index(self):
+        """
+        Index positions of programs by id, and by channel in order of their start times.
+        """
+        self._by_id = {}
+        by_channel = {}
+
+        for pos, item in enumerate(self.programs):
+            # the first one wins, as the linear scan used to do.
+            self._by_id.setdefault(item.id, pos)
+            minutes = self.parse_start_time(item.start_time)
+            if minutes is not None:
+                by_channel.setdefault(item.channel, []).append((minutes, pos, self.parse_days(item.day)))
+
+        self._by_channel = {}
+        for channel, entries in by_channel.items():
+            # sort is stable, so programs starting at the same time keep the table order.
+            entries.sort(key=lambda x: x[0])
+            self._by_channel[channel] = tuple([x[i] for x in entries] for i in range(3))
+
+    def get(self, program_id):
+        """
+        Returns the program of the id, or None.
+        """
+        pos = self._by_id.get(program_id)
+        return self.programs[pos] if pos is not None else None
+
+    def channel_programs(self, channel):
+        """
+        Returns programs of the channel, ordered by their start times.
+        """
+        return [self.programs[x] for x in self._by_channel.get(channel, ([], [], []))[1]]
+
+    def on_air(self, channel, when=None):
+        """
+        Returns the program on air at the channel, or None if the channel has no program.
+
+        :param channel: channel name, e.g. 'mfm'
+        :param when:    datetime, timestamp, or 'HH:MM' string. Defaults to now.
+                        A datetime or a timestamp chooses among the programs of its weekday.
+                        An 'HH:MM' string ignores the weekdays of the programs.
+        """
+        index = self._by_channel.get(channel)
+        if not index:
+            return None
+
+        if when is None:
+            when = datetime.now()
+        elif isinstance(when, (int, float)):
+            when = datetime.fromtimestamp(when)
+
+        if isinstance(when, str):
+            minutes = self.parse_start_time(when)
+            if minutes is None:
+                raise ValueError('invalid time \'%s\': expected HH:MM' % when)
+            weekday = None
+        else:
+            minutes = when.hour * 60 + when.minute
+            weekday = when.weekday()
+
+        starts, positions, days = index
+        pos = self._find_on_air(starts, days, bisect_right(starts, minutes), weekday)
+        if pos is None:
+            # before the first program of the day, the last one of the previous day is still on air.
+            previous_day = None if weekday is None else (weekday - 1) % 7
+            pos = self._find_on_air(starts, days, len(starts), previous_day)
+        return self.programs[positions[pos]] if pos is not None else None
+
+    def _find_on_air(self, starts, days, end, weekday):
+        """
+        Position of the latest program starting before 'end' on the weekday, or None.
+        Of programs sharing the start time, the first one in the table order.
+        """
+        bit = self.every_day if weekday is None else 1 << weekday
+        found = None
+        for pos in range(end - 1, -1, -1):
+            if found is not None and starts[pos] != starts[found]:
+                break
+            if days[pos] & bit:
+                found = pos
+        return found
+
+    @classmethod
+    def parse_days(cls, day):
+        """
+        'mon-fri', 'sat-sun', 'sat', or 'mon,wed' to a bit mask of weekdays. Every day if malformed.
+        """
+        mask = 0
+        try:
+            for token in day.lower().replace(' ', '').split(','):
+                first, _, last = token.partition('-')
+                pos = cls.weekdays.index(first[:3])
+                end = cls.weekdays.index((last or first)[:3])
+                # a range may wrap around the week, e.g. 'sat-mon'.
+                mask |= 1 << pos
+                while pos != end:
+                    pos = (pos + 1) % 7
+                    mask |= 1 << pos
+        except (AttributeError, ValueError):
+            return cls.every_day
+        return mask
+
+    @staticmethod
+    def parse_start_time(start_time):
+        """
+        'HH:MM' to minutes from midnight. None if malformed.
+        """
+        try:
+            hour, minute = start_time.split(':')
+            return int(hour) * 60 + int(minute)
+        except (AttributeError, ValueError):
+            return None
+
+    @staticmethod
+    def parse_version(version_line):
+        """
+        'version: 12' to 12.
+        """
         return int(version_line.split(':')[1].strip())
 
+    @property
+    def validators_path(self):
+        return self.table_path + '.validators'
+
+    def load_validators(self):
+        """
+        ETag and Last-Modified of the remote table, when the local one was downloaded or checked.
+        """
+        try:
+            with open(self.validators_path, 'r') as f:
+                return json_load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_validators(self, headers):
+        validators = {
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        }
+        with open(self.validators_path, 'w') as f:
+            json_dump(validators, f)
+
+    def get_remote_version(self):
+        response = self.connector.open(self.url)
+        try:
+            charset = response.headers.get_content_charset() or 'utf-8'
+            return self.parse_version(response.readline().decode(charset))
+        finally:
+            response.close()
+
     def download(self):
-        conn = BasicConnector()
-        content = conn.get(self.url)
-        with open(self.table_path, 'w') as f:
-            f.write(content)
+        response = self.connector.open(self.url)
+        try:
+            self.write_table(response)
+        finally:
+            response.close()
+        self.save_validators(response.headers)
+
+    def write_table(self, response, head=''):
+        """
+        Stream the table to the file, replacing it atomically. Readers never see a partial file.
+
+        :param head: text already read from the response.
+        """
+        decoder = FallbackDecoder(response.headers.get_content_charset() or 'utf-8')
+        write_atomic(self.table_path, chain([head], decoder.iter_decode(iter_response(response))), 'w')
 
     def update(self):
-        remote_version = self.get_remote_version()
-        if remote_version > self.version:
-            self.download()
-            self.load()
+        """
+        Download the remote table if its version is newer. Returns True if the table is updated.
+
+        This is a conditional GET with validators of the last download: an unchanged table costs a 304 response.
+         A changed one is read up to the version line, and the rest is read only if the version is newer.
+        """
+        validators = self.load_validators()
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        response = self.connector.open(self.url, headers=headers)
+        try:
+            if response.getcode() == 304:
+                return False
+            charset = response.headers.get_content_charset() or 'utf-8'
+            version_line = response.readline().decode(charset)
+            if self.parse_version(version_line) <= self.version:
+                # remember this one is not newer.
+                self.save_validators(response.headers)
+                return False
+            self.write_table(response, head=version_line)
+        finally:
+            response.close()
+
+        self.save_validators(response.headers)
+        self.load()
+        return True
 
 
 class MBCRadioPlaylistCrawler(object):
     date_expr = re_compile(r'^\d{4}-\d{2}-\d{2}$')
 
     def __init__(self, **kwargs):
+        """
+        Keywords
+        --------
+         - cache_path: PlaylistCache file path. Playlists are not cached if omitted.
+         - table_path: see MBCRadioProgramTable
+        """
+        cache_path = kwargs.pop('cache_path', None)
+        self.cache = PlaylistCache(cache_path) if cache_path else None
         self.program_table = MBCRadioProgramTable(**kwargs)
-        self.connector = BasicConnector(fallback_charset=['euc-kr', 'utf-8', ])
+        self.connector = PooledConnector(fallback_charset=['euc-kr', 'utf-8', ])
 
     def get_playlist(self, program_id, program_date=None):
+        program_date, program, playlist = self.lookup(program_id, program_date)
+        if program is None:
+            return playlist
+
+        with metrics.timer('playlist_crawl_seconds', hop='list'):
+            view_url = self.get_view_url(program, program_date)
+        with metrics.timer('playlist_crawl_seconds', hop='view'):
+            playlist = self.extract_playlist(view_url) or []
+        self.store(program_id, program_date, playlist)
+        return playlist
+
+    def lookup(self, program_id, program_date=None):
+        """
+        The part of get_playlist() before any request. Blocking: the cache and the program table are files.
+
+        :return: (program date, program, playlist). The program is None if no request is needed, and the playlist
+                  is the answer: None for an invalid date, the cached one, or [] for an unknown program.
+        """
         if not program_date:
             program_date = datetime.today().strftime('%Y-%m-%d')
         if not self.date_expr.match(program_date):
-            return
+            return program_date, None, None
+
+        if self.cache is not None:
+            playlist = self.cache.get(program_id, program_date)
+            metrics.count('playlist_cache_total', result='miss' if playlist is None else 'hit')
+            if playlist is not None:
+                return program_date, None, playlist
+
+        program = self.program_table.get(program_id)
+        if not program:
+            return program_date, None, []
+        return program_date, program, None
+
+    def store(self, program_id, program_date, playlist):
+        """
+        Caches a crawled playlist, if there is a cache.
+        """
+        if self.cache is not None:
+            self.cache.put(program_id, program_date, playlist)
 
-        for program in self.program_table.programs:
-            if program.id == program_id:
-                view_url = self.get_view_url(program, program_date)
-                return self.extract_playlist(view_url)
+    def get_view_url(self, program: MBCRadioProgramItem, program_date: str):
+        playlist_list_url = program.playlist_list_url
+        if playlist_list_url:
+            # the rest of the page is not read after the table.
+            chunks = self.connector.iter_text(
+                url=playlist_list_url,
+                params={
+                    'txtstart': program_date,
+                    'txtend': program_date
+                }
+            )
+            parser = MBCRadioPlaylistListParser().feed_chunks(chunks)
+            if parser.rel_href:
+                return program.url_prefix + parser.rel_href
 
-        return []
+    def extract_playlist(self, playlist_view_url):
+        if playlist_view_url:
+            chunks = self.connector.iter_text(
+                url=playlist_view_url
+            )
+            parser = MBCRadioPlaylistViewParser().feed_chunks(chunks)
+            return parser.playlist
 
-    def get_view_url(self, program: MBCRadioProgramItem, program_date: str):
+
+class AsyncMBCRadioPlaylistCrawler(MBCRadioPlaylistCrawler):
+    """
+    MBCRadioPlaylistCrawler whose get_playlist() is a coroutine. Many playlists are crawled concurrently on a thread,
+     by get_playlists(), still 'delay' seconds apart for the host.
+
+    lookup() and store() run in the default executor, so the event loop does not wait for the cache file.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        Keywords
+        --------
+         - delay:       seconds between requests to the host. Defaults to 1.
+         - concurrency: maximum number of playlists crawled at the same time by get_playlists(). Defaults to 8.
+         - see MBCRadioPlaylistCrawler
+        """
+        delay = kwargs.pop('delay', 1)
+        self.concurrency = kwargs.pop('concurrency', 8) or 8
+        super(AsyncMBCRadioPlaylistCrawler, self).__init__(**kwargs)
+        self.connector = AsyncConnector(delay=delay, fallback_charset=['euc-kr', 'utf-8', ])
+
+    async def get_playlist(self, program_id, program_date=None):
+        loop = asyncio.get_running_loop()
+        program_date, program, playlist = await loop.run_in_executor(None, self.lookup, program_id, program_date)
+        if program is None:
+            return playlist
+
+        with metrics.timer('playlist_crawl_seconds', hop='list'):
+            view_url = await self.get_view_url(program, program_date)
+        with metrics.timer('playlist_crawl_seconds', hop='view'):
+            playlist = await self.extract_playlist(view_url) or []
+        await loop.run_in_executor(None, self.store, program_id, program_date, playlist)
+        return playlist
+
+    async def get_playlists(self, items):
+        """
+        :param items: iterable of (program id, date).
+        :return:      dict of (program id, date): playlist, or the exception raised for it.
+        """
+        items = list(dict.fromkeys(items))
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def crawl(program_id, program_date):
+            async with semaphore:
+                return await self.get_playlist(program_id, program_date)
+
+        results = await asyncio.gather(*[crawl(*item) for item in items], return_exceptions=True)
+        return dict(zip(items, results))
+
+    async def get_view_url(self, program: MBCRadioProgramItem, program_date: str):
         playlist_list_url = program.playlist_list_url
         if playlist_list_url:
-            content = self.connector.get(
+            content = await self.connector.get(
                 url=playlist_list_url,
                 params={
                     'txtstart': program_date,
@@ -134,9 +519,9 @@ class MBCRadioPlaylistCrawler(object):
             if parser.rel_href:
                 return program.url_prefix + parser.rel_href
 
-    def extract_playlist(self, playlist_view_url):
+    async def extract_playlist(self, playlist_view_url):
         if playlist_view_url:
-            content = self.connector.get(
+            content = await self.connector.get(
                 url=playlist_view_url
             )
             parser = MBCRadioPlaylistViewParser()
@@ -144,7 +529,167 @@ class MBCRadioPlaylistCrawler(object):
             return parser.playlist
 
 
-class MBCRadioPlaylistListParser(object):
+# noinspection PyAbstractClass
+class TableParser(HTMLParser):
+    """
+    Parses the first <table> of table_class, and nothing after it. Feed content at once, or in chunks.
+    """
+
+    table_class = ''
+
+    def __init__(self):
+        super(TableParser, self).__init__()
+        self.done = False
+        self._table_depth = 0
+        self._in_tbody = False
+
+    def feed(self, data):
+        if not self.done:
+            super(TableParser, self).feed(data)
+
+    def feed_chunks(self, chunks):
+        """
+        Feed chunks until the table is parsed. The rest of chunks is not consumed, and closed if it can be.
+        """
+        try:
+            for chunk in chunks:
+                self.feed(chunk)
+                if self.done:
+                    break
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        return self
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'table':
+            if self._table_depth:
+                self._table_depth += 1
+            elif self.table_class in (dict(attrs).get('class') or '').split():
+                self._table_depth = 1
+        elif self._table_depth:
+            if tag == 'tbody':
+                self._in_tbody = True
+            elif self._in_tbody:
+                self.handle_table_starttag(tag, dict(attrs))
+
+    def handle_endtag(self, tag):
+        if self.done or not self._table_depth:
+            return
+        if tag == 'table':
+            self._table_depth -= 1
+            if not self._table_depth:
+                self.finish()
+        elif tag == 'tbody' and self._table_depth == 1:
+            # only the first tbody counts.
+            self.finish()
+        elif self._in_tbody:
+            self.handle_table_endtag(tag)
+
+    def handle_data(self, data):
+        if self._in_tbody and not self.done:
+            self.handle_table_data(data)
+
+    def handle_table_starttag(self, tag, attrs):
+        pass
+
+    def handle_table_endtag(self, tag):
+        pass
+
+    def handle_table_data(self, data):
+        pass
+
+    def finish(self):
+        self.done = True
+        self._in_tbody = False
+
+
+# noinspection PyAbstractClass
+class MBCRadioPlaylistListParser(TableParser):
+    """
+    Finds the first link of the 'select_tb' table.
+    """
+
+    table_class = 'select_tb'
+
+    def __init__(self):
+        super(MBCRadioPlaylistListParser, self).__init__()
+        self.rel_href = ''
+
+    def handle_table_starttag(self, tag, attrs):
+        if tag == 'a':
+            self.rel_href = attrs.get('href') or ''
+            self.finish()
+
+
+# noinspection PyAbstractClass
+class MBCRadioPlaylistViewParser(TableParser):
+    """
+    Rows of the 'list_tb' table. A row whose first cell spans columns is a title, e.g. a part of the show.
+    """
+
+    table_class = 'list_tb'
+
+    def __init__(self):
+        super(MBCRadioPlaylistViewParser, self).__init__()
+        self.playlist = []
+        self._cells = None
+        self._open_cells = []
+
+    def handle_table_starttag(self, tag, attrs):
+        if tag == 'tr' and self._cells is None:
+            self._cells = []
+        elif tag in ('td', 'th') and self._cells is not None:
+            cell = [tag, attrs, []]
+            self._cells.append(cell)
+            self._open_cells.append(cell)
+
+    def handle_table_endtag(self, tag):
+        if tag in ('td', 'th') and self._open_cells:
+            self._open_cells.pop()
+        elif tag == 'tr' and self._cells is not None:
+            cells, self._cells, self._open_cells = self._cells, None, []
+            self.add_row(cells)
+
+    def handle_table_data(self, data):
+        for cell in self._open_cells:
+            cell[2].append(data)
+
+    def add_row(self, cells):
+        th = [x for x in cells if x[0] == 'th']
+        td = [x for x in cells if x[0] == 'td']
+        one_col = (th or td or [None])[0]
+        if one_col is None:
+            # the soup parser stops at a row without cells.
+            self.finish()
+            return
+
+        if 'colspan' in one_col[1]:
+            self.playlist.append(
+                {
+                    'seq': None,
+                    'title': ''.join(one_col[2]).strip(),
+                    'artist': None,
+                }
+            )
+        elif len(td) >= 5:
+            seq = ''.join(td[1][2]).strip()
+            self.playlist.append(
+                {
+                    'seq': int(seq) if seq.isnumeric() else seq,
+                    'title': ''.join(td[2][2]).strip(),
+                    'artist': ''.join(td[3][2]).strip(),
+                }
+            )
+
+
+class MBCRadioPlaylistListSoupParser(object):
+    """
+    BeautifulSoup version of MBCRadioPlaylistListParser. Slower, kept as a reference.
+    """
+
     def __init__(self):
         self.rel_href = ''
 
@@ -158,7 +703,11 @@ class MBCRadioPlaylistListParser(object):
             pass
 
 
-class MBCRadioPlaylistViewParser(object):
+class MBCRadioPlaylistViewSoupParser(object):
+    """
+    BeautifulSoup version of MBCRadioPlaylistViewParser. Slower, kept as a reference.
+    """
+
     def __init__(self):
         self.playlist = []
 
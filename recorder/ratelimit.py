@@ -0,0 +1,191 @@
+import asyncio
+from threading import Lock
+from time import (
+    monotonic,
+    sleep,
+)
+from urllib.parse import urlsplit
+
+from .instrument import metrics
+
+
+class TokenBucket(object):
+    """
+    'rate' tokens a second, up to 'burst' tokens saved. Thread-safe.
+
+    A request takes a token when it starts, so the time spent by the request itself counts for the next one.
+    """
+
+    def __init__(self, rate, burst=1, clock=monotonic):
+        """
+        :param rate:  tokens per second.
+        :param burst: bucket capacity. This many requests may start at once after an idle time.
+        :param clock: callable() returns seconds.
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive: %s' % rate)
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.clock = clock
+        self._tokens = float(self.burst)
+        self._updated = clock()
+        self._lock = Lock()
+
+    def reserve(self, tokens=1):
+        """
+        Take tokens now, even if they are not there yet. Returns seconds to wait before using them.
+        """
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self, tokens=1):
+        """
+        Block until the tokens are available. Returns seconds waited.
+        """
+        wait = self.reserve(tokens)
+        if wait:
+            sleep(wait)
+        return wait
+
+
+class RateLimiter(object):
+    """
+    Token buckets by host, with statistics of time spent waiting and in flight. Thread-safe, so connectors
+     in many threads may share one.
+
+    Use limit() in 'with' statement around a request, or in 'async with' statement in a coroutine.
+    """
+
+    def __init__(self, rate=None, burst=1, per_host=None, clock=monotonic):
+        """
+        :param rate:     requests per second for a host. None or 0 means no limit, and only statistics are kept.
+        :param burst:    see TokenBucket.
+        :param per_host: dict of host: (rate, burst), overriding rate and burst for the hosts.
+        :param clock:    callable() returns seconds.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.per_host = per_host or {}
+        self.clock = clock
+        self._buckets = {}
+        self._stats = {}
+        self._lock = Lock()
+
+    @classmethod
+    def from_delay(cls, delay):
+        """
+        A request per 'delay' seconds for a host, which is what the connectors' delay argument used to mean.
+        """
+        return cls(rate=1.0 / delay if delay else None)
+
+    def bucket(self, host):
+        """
+        TokenBucket of the host, or None if the host is not limited.
+        """
+        with self._lock:
+            if host not in self._buckets:
+                rate, burst = self.per_host.get(host, (self.rate, self.burst))
+                self._buckets[host] = TokenBucket(rate, burst, self.clock) if rate else None
+            return self._buckets[host]
+
+    def reserve(self, host):
+        """
+        Take a token of the host. Returns seconds to wait before the request.
+        """
+        bucket = self.bucket(host)
+        return bucket.reserve() if bucket else 0.0
+
+    def acquire(self, host):
+        """
+        Block until a request to the host is allowed. Returns seconds waited.
+        """
+        wait = self.reserve(host)
+        if wait:
+            sleep(wait)
+        return wait
+
+    async def acquire_async(self, host):
+        """
+        acquire() without blocking the event loop.
+        """
+        wait = self.reserve(host)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+    def limit(self, url_or_host):
+        return _LimitedRequest(self, host_of(url_or_host))
+
+    def record(self, host, waited, in_flight):
+        with self._lock:
+            stats = self._stats.setdefault(host, {'requests': 0, 'waited': 0.0, 'in_flight': 0.0})
+            stats['requests'] += 1
+            stats['waited'] += waited
+            stats['in_flight'] += in_flight
+
+    def stats(self, host=None):
+        """
+        Returns {'requests': count, 'waited': seconds, 'in_flight': seconds} of the host, or summed up for all hosts.
+        """
+        with self._lock:
+            if host is not None:
+                return dict(self._stats.get(host, {'requests': 0, 'waited': 0.0, 'in_flight': 0.0}))
+            total = {'requests': 0, 'waited': 0.0, 'in_flight': 0.0}
+            for stats in self._stats.values():
+                for key in total:
+                    total[key] += stats[key]
+            return total
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {}
+
+
+class _LimitedRequest(object):
+    """
+    Waits for its turn on enter, and records the times on exit.
+    """
+
+    def __init__(self, limiter, host):
+        self.limiter = limiter
+        self.host = host
+        self.waited = 0.0
+        self.started = None
+
+    def __enter__(self):
+        self.waited = self.limiter.acquire(self.host)
+        self.started = self.limiter.clock()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        in_flight = self.limiter.clock() - self.started
+        self.limiter.record(self.host, self.waited, in_flight)
+        if metrics.enabled:
+            # GeneratorExit of a stream closed early, or a cancellation, is not an error of the request.
+            if exc_type is not None and issubclass(exc_type, Exception):
+                labels = {'host': self.host, 'error': exc_type.__name__}
+            else:
+                labels = {'host': self.host}
+            metrics.observe('http_wait_seconds', self.waited, **labels)
+            metrics.observe('http_request_seconds', in_flight, **labels)
+
+    async def __aenter__(self):
+        self.waited = await self.limiter.acquire_async(self.host)
+        self.started = self.limiter.clock()
+        return self
+
+    async def __aexit__(self, exc_type, *args):
+        self.__exit__(exc_type, *args)
+
+
+def host_of(url_or_host):
+    """
+    'http://example.com:8080/a' to 'example.com:8080'. A host is returned as it is.
+    """
+    if '://' in url_or_host:
+        return urlsplit(url_or_host).netloc.rpartition('@')[2].lower()
+    return url_or_host.lower()
@@ -0,0 +1,272 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from heapq import (
+    heappop,
+    heappush,
+)
+from json import load as json_load
+from os.path import (
+    exists as path_exists,
+    expanduser,
+)
+from threading import Lock
+
+from time import (
+    sleep,
+    time,
+)
+
+from . import AudioStreamRecorder, MetadataPostProcess
+from .backends import WaitReason
+from .instrument import metrics
+from .urls import MbcRadioUrl
+
+
+class SystemClock(object):
+    """
+    Wall clock. RecordingScheduler takes any object with time() and sleep_until(), so tests can fake it.
+    """
+
+    @staticmethod
+    def time():
+        return time()
+
+    @staticmethod
+    def sleep_until(timestamp):
+        remaining = timestamp - time()
+        while remaining > 0:
+            sleep(remaining)
+            remaining = timestamp - time()
+
+
+class RecordingJob(object):
+    """
+    One recording: a channel, a start time and a duration.
+    """
+
+    date_format = '%Y-%m-%d %H:%M:%S'
+
+    day_in_sec = 3600 * 24
+
+    def __init__(self, channel, start, duration, output_path, metadata=None, program_id=None, repeat=None):
+        """
+        :param channel:     channel name, e.g. 'mfm'
+        :param start:       timestamp, or a string formatted as date_format in local time.
+        :param duration:    seconds.
+        :param output_path: output file path. strftime() directives are expanded by the start time.
+        :param metadata:    dict of tags. Added after recording.
+        :param program_id:  program id of the program table.
+        :param repeat:      None, or 'daily'.
+        """
+        if repeat not in (None, 'daily'):
+            raise ValueError('invalid repeat \'%s\': supported: \'daily\'' % repeat)
+        if isinstance(start, str):
+            start = datetime.strptime(start, self.date_format).timestamp()
+        self.channel = channel
+        self.start = float(start)
+        self.duration = int(duration)
+        self.output_path = output_path
+        self.metadata = metadata or {}
+        self.program_id = program_id
+        self.repeat = repeat
+
+    @classmethod
+    def from_dict(cls, dict_obj):
+        return cls(
+            channel=dict_obj['channel'],
+            start=dict_obj['start'],
+            duration=dict_obj['duration'],
+            output_path=dict_obj['output'],
+            metadata=dict_obj.get('metadata'),
+            program_id=dict_obj.get('program_id'),
+            repeat=dict_obj.get('repeat'),
+        )
+
+    def next_start(self, now):
+        """
+        The first start time whose recording has not ended yet at now. None if there is no such occurrence.
+        """
+        start = self.start
+        if self.repeat == 'daily':
+            while start + self.duration <= now:
+                start += self.day_in_sec
+        elif start + self.duration <= now:
+            return None
+        return start
+
+    def output_path_at(self, start):
+        return datetime.fromtimestamp(start).strftime(expanduser(self.output_path))
+
+
+def load_jobs(path):
+    """
+    Load jobs from a JSON file, which is a list of objects like:
+        {
+            "channel": "mfm",
+            "start": "2016-12-01 07:00:00",
+            "duration": 7200,
+            "output": "~/radio/fm4u_%Y%m%d.m4a",
+            "metadata": {"artist": "...", "album": "..."},
+            "program_id": 1234,
+            "repeat": "daily"
+        }
+    'metadata', 'program_id', and 'repeat' are optional.
+    """
+    with open(path, 'r') as f:
+        return [RecordingJob.from_dict(x) for x in json_load(f)]
+
+
+class RecordingScheduler(object):
+    """
+    Runs recording jobs on time, overlapping ones at the same time, by a bounded worker pool.
+
+    Each job is handed to a worker lead_time seconds before its start. The worker resolves the stream url
+     in advance, sleeps until the start time, then records.
+    """
+
+    def __init__(self, jobs=None, workers=4, lead_time=5, clock=None, url_resolver=None, url_invalidator=None,
+                 recorder_factory=None, archive=None, admission=None, **kwargs):
+        """
+        :param jobs:             list of RecordingJob.
+        :param workers:          maximum number of simultaneous recordings.
+        :param lead_time:        seconds. Stream urls are resolved this much earlier than the start time.
+        :param clock:            SystemClock, or a compatible object.
+        :param url_resolver:     callable(channel) returns a stream url. Defaults to MbcRadioUrl.resolve().
+        :param url_invalidator:  callable(channel) called when a capture fails. Defaults to MbcRadioUrl.invalidate().
+        :param recorder_factory: callable() returns an AudioStreamRecorder-like object. One per recording.
+        :param archive:          ArchiveIndex. Recordings under its root are indexed as they are finished.
+        :param admission:        DiskSpaceAdmission. A job fails in its lead time if its space is not free.
+        :param kwargs:           passed to AudioStreamRecorder and MetadataPostProcess.
+        """
+        self.workers = workers
+        self.lead_time = lead_time
+        self.clock = clock or SystemClock()
+        if url_resolver is None:
+            radio_url = MbcRadioUrl()
+            url_resolver = radio_url.resolve
+            url_invalidator = url_invalidator or radio_url.invalidate
+        self.url_resolver = url_resolver
+        self.url_invalidator = url_invalidator
+        self.recorder_factory = recorder_factory or (lambda: AudioStreamRecorder(**kwargs))
+        self.post_process = MetadataPostProcess(**kwargs)
+        self.archive = archive
+        self.admission = admission
+        self.history = []
+
+        self._queue = []
+        self._sequence = 0
+        self._lock = Lock()
+        self._active = set()
+        self._stopped = False
+
+        for job in (jobs or []):
+            self.add(job)
+
+    def add(self, job: RecordingJob, now=None):
+        start = job.next_start(self.clock.time() if now is None else now)
+        if start is not None:
+            # sequence number keeps the heap away from comparing jobs
+            heappush(self._queue, (start, self._sequence, job))
+            self._sequence += 1
+
+    def run(self):
+        """
+        Block until every job has been recorded. Daily jobs keep it running forever.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                while self._queue and not self._stopped:
+                    start, _, job = heappop(self._queue)
+                    self.clock.sleep_until(start - self.lead_time)
+                    executor.submit(self._run_job, job, start)
+                    if job.repeat:
+                        self.add(job, now=start + job.duration)
+            except KeyboardInterrupt:
+                self.stop()
+
+    def stop(self):
+        """
+        Stop all recordings in progress. Jobs waiting for their start time are cancelled.
+        Backends are interrupted only: each worker stops its own backend, then tags and archives its recording.
+        """
+        with self._lock:
+            self._stopped = True
+            for recorder in self._active:
+                recorder.backend.interrupt()
+
+    def _run_job(self, job, start):
+        record = {
+            'channel': job.channel,
+            'program_id': job.program_id,
+            'start': start,
+            'output': job.output_path_at(start),
+            'resolved_at': None,
+            'started_at': None,
+            'ended_at': None,
+            'reason': None,
+            'error': None,
+        }
+
+        recorder = self.recorder_factory()
+        reservation = None
+        with self._lock:
+            self._active.add(recorder)
+
+        try:
+            url = self.url_resolver(job.channel)
+            record['resolved_at'] = self.clock.time()
+
+            if self.admission is not None:
+                # in the lead time: probing and eviction must not delay the start.
+                post_process = job.metadata and not recorder.tags_while_recording
+                reservation = self.admission.admit(
+                    self.admission.needs_of(
+                        job.channel,
+                        job.duration,
+                        record['output'],
+                        work_path=recorder.work_path if post_process else None,
+                        url=url
+                    ),
+                    label=record['output']
+                )
+
+            self.clock.sleep_until(start)
+            if self._stopped:
+                return record
+            record['started_at'] = self.clock.time()
+
+            # a late start still ends on time.
+            duration = max(1, int(round(start + job.duration - record['started_at'])))
+
+            if job.metadata and recorder.tags_while_recording:
+                recorder.record(url=url, duration=duration, destination=record['output'], metadata=job.metadata)
+            elif job.metadata:
+                temporary_path = recorder.record(url=url, duration=duration)
+                self.post_process.process(temporary_path, metadata=job.metadata, output_path=record['output'])
+            else:
+                recorder.record(url=url, duration=duration, destination=record['output'])
+
+            record['reason'] = recorder.wait_reason
+            if self.archive is not None and path_exists(record['output']):
+                self.archive.add(
+                    record['output'],
+                    channel=job.channel,
+                    program_id=job.program_id,
+                    air_date=datetime.fromtimestamp(start).strftime('%Y-%m-%d')
+                )
+        except Exception as e:
+            record['error'] = e
+        finally:
+            if self.url_invalidator and (record['error'] or record['reason'] == WaitReason.EXITED):
+                # the stream has ended before the deadline. Do not hand the url to the next job.
+                self.url_invalidator(job.channel)
+            if reservation:
+                reservation.release()
+            record['ended_at'] = self.clock.time()
+            with self._lock:
+                self._active.discard(recorder)
+                self.history.append(record)
+            # the daemon may never exit: a Prometheus text file would be written only at exit otherwise.
+            metrics.flush()
+
+        return record
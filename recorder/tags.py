@@ -0,0 +1,519 @@
+"""
+In-place tag writers for the formats we produce: ID3v2 for MP3, and iTunes style 'ilst' atoms for MP4/M4A.
+
+Only the tag bytes at the head (ID3v2) or in the moov atom (MP4) are rewritten; audio data stays where it is.
+Both writers leave padding behind, so that the next update fits in place as well.
+"""
+
+from os import (
+    fdopen,
+    replace,
+    unlink,
+)
+from os.path import dirname
+from shutil import (
+    copyfileobj,
+    copymode,
+)
+from struct import (
+    pack,
+    unpack,
+)
+from tempfile import mkstemp
+
+from .exceptions import UnsupportedTagLayoutException
+from .metadata import FFMpegMetadata
+
+# padding reserved when a tag has to grow
+TAG_PADDING = 4096
+
+
+def normalize_metadata(metadata):
+    """
+    dict or FFMpegMetadata to a dict of non-empty values. Keys are the same as FFMpeg.insert_metadata() takes.
+    """
+    if isinstance(metadata, dict):
+        metadata = FFMpegMetadata(**metadata)
+    if not isinstance(metadata, FFMpegMetadata):
+        return {}
+    return dict((key, val) for key, val in metadata.items() if val)
+
+
+def tag_writer(path):
+    """
+    Returns a writer class for the file, or None if the format is not supported.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(12)
+
+    if head[:3] == b'ID3':
+        return ID3v2Writer
+    if head[4:8] == b'ftyp':
+        return MP4TagWriter
+    if len(head) > 1 and head[0] == 0xff and (head[1] & 0xe6) in (0xe2, 0xe4, 0xe6):
+        # MPEG audio frame sync, layer I/II/III. An untagged MP3.
+        return ID3v2Writer
+    return None
+
+
+def write_tags(path, metadata):
+    """
+    Update tags of the file without remuxing.
+    Returns False if the file cannot be handled here. Use FFMpeg.insert_metadata() then.
+    """
+    writer = tag_writer(path)
+    if writer is None:
+        return False
+    try:
+        writer.write(path, normalize_metadata(metadata))
+    except UnsupportedTagLayoutException:
+        return False
+    return True
+
+
+def read_tags(path):
+    """
+    Tags of the file as a dict, using the same keys as write_tags(). Empty if the format is not supported.
+    """
+    writer = tag_writer(path)
+    if writer is None:
+        return {}
+    return writer.read(path)
+
+
+def _rewrite_head(path, head, data_offset):
+    """
+    Write head followed by the data of the file from data_offset, then replace the file.
+    Used only when a tag cannot grow in place.
+    """
+    temp_fd, temp_path = mkstemp(dir=dirname(path) or '.')
+    try:
+        with fdopen(temp_fd, 'wb') as out, open(path, 'rb') as f:
+            out.write(head)
+            f.seek(data_offset)
+            copyfileobj(f, out, 1024 * 1024)
+        copymode(path, temp_path)
+        replace(temp_path, path)
+    except BaseException:
+        unlink(temp_path)
+        raise
+
+
+class ID3v2Writer(object):
+    """
+    ID3v2.3/2.4 tag at the head of an MP3 file.
+    Text frames are replaced, others are kept untouched. A tag which does not fit in its padding
+     is written once with TAG_PADDING bytes of room.
+    """
+
+    text_frames = {
+        'album': 'TALB',
+        'album_artist': 'TPE2',
+        'artist': 'TPE1',
+        'copyright': 'TCOP',
+        'genre': 'TCON',
+        'title': 'TIT2',
+    }
+
+    # 'comment' goes to COMM, other keys go to TXXX frames with the key as their description.
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            header = cls._read_header(f)
+            if not header:
+                return {}
+            major, size = header
+            frames = cls._parse_frames(f.read(size), major)
+
+        reverse = dict((val, key) for key, val in cls.text_frames.items())
+        tags = {}
+        for frame_id, _, body in frames:
+            if not body:
+                continue
+            key = cls._frame_key(frame_id, body)
+            if frame_id in reverse:
+                tags[reverse[frame_id]] = cls._decode(body[0], body[1:])
+            elif key == ('COMM', ''):
+                tags['comment'] = cls._split_text(body[0], body[4:])[1]
+            elif frame_id == 'TXXX':
+                tags[key[1]] = cls._split_text(body[0], body[1:])[1]
+        return tags
+
+    @classmethod
+    def write(cls, path, metadata):
+        with open(path, 'rb') as f:
+            header = cls._read_header(f)
+            if header:
+                major, size = header
+                frames = cls._parse_frames(f.read(size), major)
+            else:
+                major, size, frames = 4, 0, []
+
+        new_frames = [cls._build_frame(key, val, major) for key, val in sorted(metadata.items())]
+        new_keys = dict((cls._frame_key(x[0], x[2]), x) for x in new_frames)
+
+        # replace frames where they are, drop their duplicates, then append the new ones.
+        merged = []
+        replaced = set()
+        for frame in frames:
+            key = cls._frame_key(frame[0], frame[2])
+            if key not in new_keys:
+                merged.append(frame)
+            elif key not in replaced:
+                merged.append(new_keys[key])
+                replaced.add(key)
+        merged += [x for x in new_frames if cls._frame_key(x[0], x[2]) not in replaced]
+
+        body = b''.join(cls._pack_frame(frame_id, flags, data, major) for frame_id, flags, data in merged)
+
+        if header and len(body) <= size:
+            # fits in the current tag. Fill the rest with padding.
+            with open(path, 'r+b') as f:
+                f.write(cls._pack_header(major, size) + body + b'\x00' * (size - len(body)))
+        else:
+            head = cls._pack_header(major, len(body) + TAG_PADDING) + body + b'\x00' * TAG_PADDING
+            _rewrite_head(path, head, 10 + size if header else 0)
+
+    @classmethod
+    def _read_header(cls, f):
+        data = f.read(10)
+        if len(data) < 10 or data[:3] != b'ID3':
+            return None
+        major, flags = data[3], data[5]
+        if major not in (3, 4) or flags:
+            # unsynchronisation, extended header, footer: not worth handling here.
+            raise UnsupportedTagLayoutException('ID3v2.%d tag with flags 0x%02x' % (major, flags))
+        return major, cls._syncsafe_to_int(data[6:10])
+
+    @staticmethod
+    def _pack_header(major, size):
+        return b'ID3' + bytes([major, 0, 0]) + ID3v2Writer._int_to_syncsafe(size)
+
+    @classmethod
+    def _parse_frames(cls, data, major):
+        frames = []
+        pos = 0
+        while pos + 10 <= len(data) and data[pos] != 0:
+            frame_id = data[pos:pos + 4].decode('latin-1')
+            if major == 4:
+                size = cls._syncsafe_to_int(data[pos + 4:pos + 8])
+            else:
+                size = unpack('>I', data[pos + 4:pos + 8])[0]
+            if pos + 10 + size > len(data):
+                raise UnsupportedTagLayoutException('broken frame %s' % frame_id)
+            frames.append((frame_id, data[pos + 8:pos + 10], data[pos + 10:pos + 10 + size]))
+            pos += 10 + size
+        return frames
+
+    @classmethod
+    def _pack_frame(cls, frame_id, flags, data, major):
+        size = cls._int_to_syncsafe(len(data)) if major == 4 else pack('>I', len(data))
+        return frame_id.encode('latin-1') + size + flags + data
+
+    @classmethod
+    def _build_frame(cls, key, val, major):
+        # v2.4: UTF-8, v2.3: UTF-16 with BOM.
+        encoding = 3 if major == 4 else 1
+        text = cls._encode(encoding, val)
+        if key in cls.text_frames:
+            return cls.text_frames[key], b'\x00\x00', bytes([encoding]) + text
+        terminator = cls._terminator(encoding)
+        if key == 'comment':
+            return 'COMM', b'\x00\x00', bytes([encoding]) + b'XXX' + cls._encode(encoding, '') + terminator + text
+        return 'TXXX', b'\x00\x00', bytes([encoding]) + cls._encode(encoding, key) + terminator + text
+
+    @classmethod
+    def _frame_key(cls, frame_id, body):
+        """
+        Frames with the same key replace each other.
+        """
+        if frame_id == 'TXXX' and body:
+            return frame_id, cls._split_text(body[0], body[1:])[0]
+        if frame_id == 'COMM' and len(body) >= 4:
+            return frame_id, cls._split_text(body[0], body[4:])[0]
+        return frame_id, None
+
+    @staticmethod
+    def _terminator(encoding):
+        return b'\x00\x00' if encoding in (1, 2) else b'\x00'
+
+    @classmethod
+    def _split_text(cls, encoding, data):
+        """
+        Description and value of TXXX, COMM frames.
+        """
+        terminator = cls._terminator(encoding)
+        idx = data.find(terminator)
+        while len(terminator) == 2 and idx > -1 and idx % 2:
+            idx = data.find(terminator, idx + 1)
+        if idx == -1:
+            return cls._decode(encoding, data), ''
+        return cls._decode(encoding, data[:idx]), cls._decode(encoding, data[idx + len(terminator):])
+
+    @staticmethod
+    def _encode(encoding, text):
+        if encoding == 1:
+            return text.encode('utf-16')
+        return text.encode('utf-8' if encoding == 3 else 'latin-1')
+
+    @staticmethod
+    def _decode(encoding, data):
+        codec = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}.get(encoding, 'latin-1')
+        return data.decode(codec, 'replace').rstrip('\x00')
+
+    @staticmethod
+    def _syncsafe_to_int(data):
+        val = 0
+        for b in data:
+            val = (val << 7) | (b & 0x7f)
+        return val
+
+    @staticmethod
+    def _int_to_syncsafe(val):
+        return bytes([(val >> 21) & 0x7f, (val >> 14) & 0x7f, (val >> 7) & 0x7f, val & 0x7f])
+
+
+class MP4TagWriter(object):
+    """
+    moov/udta/meta/ilst atoms of an MP4/M4A file.
+
+    If moov is the last atom, as ffmpeg writes it by default, moov is rewritten in place with TAG_PADDING
+     bytes of 'free' reserve. If moov comes before mdat, the new moov must fit in the old one plus
+     the following 'free' atoms, so that no chunk offset moves.
+    """
+
+    items = {
+        'album': b'\xa9alb',
+        'album_artist': b'aART',
+        'artist': b'\xa9ART',
+        'comment': b'\xa9cmt',
+        'copyright': b'cprt',
+        'description': b'desc',
+        'genre': b'\xa9gen',
+        'title': b'\xa9nam',
+    }
+
+    # other keys go to freeform '----' items, named under 'com.apple.iTunes'.
+    freeform_mean = b'com.apple.iTunes'
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            moov = cls._read_moov(f)[2]
+
+        ilst = cls._find(moov, [b'udta', b'meta', b'ilst'])
+        if ilst is None:
+            return {}
+
+        reverse = dict((val, key) for key, val in cls.items.items())
+        tags = {}
+        for item_type, item in cls._children(ilst):
+            key, val = cls._parse_item(item_type, item)
+            key = reverse.get(item_type, key)
+            if key and val is not None:
+                tags[key] = val
+        return tags
+
+    @classmethod
+    def write(cls, path, metadata):
+        with open(path, 'r+b') as f:
+            offset, room, moov, at_end = cls._read_moov(f)
+
+            if at_end:
+                new_moov = cls._build_moov(moov, metadata, TAG_PADDING)
+            else:
+                base = len(cls._build_moov(moov, metadata, 0))
+                if base != room and room - base < 8:
+                    raise UnsupportedTagLayoutException('not enough room in moov')
+                new_moov = cls._build_moov(moov, metadata, room - base)
+
+            f.seek(offset)
+            f.write(new_moov)
+            if at_end:
+                f.truncate()
+
+    @classmethod
+    def _read_moov(cls, f):
+        """
+        Returns moov offset, bytes available for a new moov, moov payload, and whether moov ends the file.
+        """
+        f.seek(0, 2)
+        file_size = f.tell()
+
+        top = []
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            atom_type, size, header_size = cls._read_atom_header(f, file_size - offset)
+            top.append((atom_type, offset, size, header_size))
+            offset += size
+
+        moov = [x for x in top if x[0] == b'moov']
+        if len(moov) != 1 or any(x[0] == b'moof' for x in top):
+            raise UnsupportedTagLayoutException('no moov, or a fragmented file')
+
+        idx = top.index(moov[0])
+        _, moov_offset, moov_size, header_size = moov[0]
+
+        # free atoms right after moov are ours to use.
+        room = moov_size
+        for atom_type, _, size, _ in top[idx + 1:]:
+            if atom_type not in (b'free', b'skip'):
+                break
+            room += size
+        at_end = moov_offset + room == file_size
+
+        f.seek(moov_offset + header_size)
+        return moov_offset, room, f.read(moov_size - header_size), at_end
+
+    @staticmethod
+    def _read_atom_header(f, remaining):
+        data = f.read(8)
+        if len(data) < 8:
+            raise UnsupportedTagLayoutException('truncated atom')
+        size, atom_type = unpack('>I4s', data)
+        header_size = 8
+        if size == 1:
+            size = unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = remaining
+        if size < header_size or size > remaining:
+            raise UnsupportedTagLayoutException('broken atom %r' % atom_type)
+        return atom_type, size, header_size
+
+    @staticmethod
+    def _children(data, start=0):
+        """
+        (type, payload) of the atoms in data.
+        """
+        children = []
+        pos = start
+        while pos + 8 <= len(data):
+            size, atom_type = unpack('>I4s', data[pos:pos + 8])
+            header_size = 8
+            if size == 1:
+                size = unpack('>Q', data[pos + 8:pos + 16])[0]
+                header_size = 16
+            elif size == 0:
+                size = len(data) - pos
+            if size < header_size or pos + size > len(data):
+                raise UnsupportedTagLayoutException('broken atom %r' % atom_type)
+            children.append((atom_type, data[pos + header_size:pos + size]))
+            pos += size
+        return children
+
+    @staticmethod
+    def _atom(atom_type, payload):
+        return pack('>I4s', 8 + len(payload), atom_type) + payload
+
+    @classmethod
+    def _find(cls, data, path):
+        for atom_type, payload in cls._children(data):
+            if atom_type == path[0]:
+                if len(path) == 1:
+                    return payload
+                # meta is a full atom: version and flags first.
+                return cls._find(payload[4:] if atom_type == b'meta' else payload, path[1:])
+        return None
+
+    @classmethod
+    def _build_moov(cls, moov, metadata, padding):
+        """
+        New moov atom with the metadata merged. padding: size of the 'free' atom in meta, 0 or >= 8.
+        """
+        children = cls._children(moov)
+        udta = [x[1] for x in children if x[0] == b'udta']
+        new_udta = cls._build_udta(udta[0] if udta else b'', metadata, padding)
+
+        payload = b''
+        for atom_type, child in children:
+            if atom_type == b'udta':
+                payload += new_udta
+            else:
+                payload += cls._atom(atom_type, child)
+        if not udta:
+            payload += new_udta
+        return cls._atom(b'moov', payload)
+
+    @classmethod
+    def _build_udta(cls, udta, metadata, padding):
+        children = cls._children(udta)
+        meta = [x[1] for x in children if x[0] == b'meta']
+        new_meta = cls._build_meta(meta[0] if meta else b'\x00' * 4, metadata, padding)
+
+        payload = b''
+        for atom_type, child in children:
+            if atom_type == b'meta':
+                payload += new_meta
+            else:
+                payload += cls._atom(atom_type, child)
+        if not meta:
+            payload += new_meta
+        return cls._atom(b'udta', payload)
+
+    @classmethod
+    def _build_meta(cls, meta, metadata, padding):
+        version_flags, children = meta[:4], cls._children(meta, 4)
+        ilst = [x[1] for x in children if x[0] == b'ilst']
+        new_ilst = cls._build_ilst(ilst[0] if ilst else b'', metadata)
+
+        payload = version_flags
+        if not any(x[0] == b'hdlr' for x in children):
+            payload += cls._atom(b'hdlr', b'\x00' * 8 + b'mdirappl' + b'\x00' * 10)
+        for atom_type, child in children:
+            if atom_type == b'ilst':
+                payload += new_ilst
+            elif atom_type not in (b'free', b'skip'):
+                payload += cls._atom(atom_type, child)
+        if not ilst:
+            payload += new_ilst
+        if padding:
+            payload += cls._atom(b'free', b'\x00' * (padding - 8))
+        return cls._atom(b'meta', payload)
+
+    @classmethod
+    def _build_ilst(cls, ilst, metadata):
+        new_items = {}
+        for key, val in metadata.items():
+            if key in cls.items:
+                new_items[(cls.items[key], None)] = cls._atom(cls.items[key], cls._data_atom(val))
+            else:
+                new_items[(b'----', key)] = cls._atom(b'----', (
+                    cls._atom(b'mean', b'\x00' * 4 + cls.freeform_mean) +
+                    cls._atom(b'name', b'\x00' * 4 + key.encode('utf-8')) +
+                    cls._data_atom(val)
+                ))
+
+        payload = b''
+        replaced = set()
+        for item_type, item in cls._children(ilst):
+            name = cls._parse_item(item_type, item)[0] if item_type == b'----' else None
+            key = (item_type, name)
+            if key not in new_items:
+                payload += cls._atom(item_type, item)
+            elif key not in replaced:
+                payload += new_items[key]
+                replaced.add(key)
+        for key in sorted(set(new_items) - replaced, key=lambda x: (x[0], x[1] or '')):
+            payload += new_items[key]
+        return cls._atom(b'ilst', payload)
+
+    @classmethod
+    def _data_atom(cls, val):
+        # type 1: UTF-8 text, locale 0
+        return cls._atom(b'data', pack('>II', 1, 0) + val.encode('utf-8'))
+
+    @classmethod
+    def _parse_item(cls, item_type, item):
+        """
+        (freeform name or None, text value or None) of an ilst item.
+        """
+        name, val = None, None
+        for atom_type, payload in cls._children(item):
+            if atom_type == b'name':
+                name = payload[4:].decode('utf-8', 'replace')
+            elif atom_type == b'data' and len(payload) >= 8 and unpack('>I', payload[:4])[0] == 1:
+                val = payload[8:].decode('utf-8', 'replace')
+        return name, val
@@ -1,23 +1,39 @@
 from argparse import Namespace
+import asyncio
 
 from datetime import (
     datetime,
     timedelta,
 )
 
+from functools import partial
+from hashlib import md5
+from json import loads as json_loads
+
 from http.client import HTTPMessage
+from http.server import (
+    SimpleHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
 
 from operator import itemgetter
 
 from os import (
+    chmod,
+    close,
     getcwd,
     listdir,
+    makedirs,
+    mkdir,
     stat,
     unlink,
+    utime,
+    walk,
 )
 
 from os.path import (
     abspath,
+    devnull,
     dirname,
     exists,
     isfile,
@@ -26,9 +42,26 @@ from os.path import (
 
 from random import randint
 from re import compile as re_compile
-from shutil import copy as shutil_copy
+from struct import pack
+
+from shutil import (
+    copy as shutil_copy,
+    rmtree,
+)
+from socket import SHUT_RDWR
+from sys import executable as python_path
+
+from tempfile import mkdtemp, mkstemp
+from threading import (
+    Condition,
+    Lock,
+    Thread,
+    current_thread,
+    main_thread,
+)
 
 from time import (
+    monotonic,
     sleep,
     time,
 )
@@ -40,16 +73,29 @@ from unittest.mock import (
     patch,
 )
 
+from urllib.error import (
+    HTTPError,
+    URLError,
+)
 from urllib.parse import (
     urlparse,
     parse_qsl
 )
 
 from . import (
+    AudioStreamRecorder,
+    admission,
+    archive,
     backends,
+    cache,
     connectors,
+    exceptions,
+    instrument,
     metadata,
     playlist,
+    ratelimit,
+    scheduler,
+    tags,
     urls,
     utils,
 )
@@ -57,6 +103,35 @@ from . import (
 import mbc_playlist
 
 
+class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class LocalHttpServer(object):
+    """
+    Serves a directory on localhost in a background thread. Use in 'with' statement.
+    A thread per connection, so that idle keep-alive clients do not block others.
+    """
+
+    def __init__(self, directory, handler_class=QuietHTTPRequestHandler):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), partial(handler_class, directory=directory))
+        self.server.daemon_threads = True
+        self.server.block_on_close = False
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, path=''):
+        return 'http://127.0.0.1:%d/%s' % (self.server.server_port, path)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
 class TestBackends(TestCase):
 
     project_path = ''
@@ -111,6 +186,576 @@ class TestBackends(TestCase):
         unlink(output)
 
 
+class TestWaitEngine(TestCase):
+    """
+    PopenBasedBackend.wait_for() and AudioStreamRecorder.record() test, using python itself as a child process.
+    """
+
+    @staticmethod
+    def sleeper(seconds):
+        return [python_path, '-c', 'import time; time.sleep(%f)' % seconds]
+
+    def test_child_exits_first(self):
+        backend = backends.PopenBasedBackend()
+        begin = monotonic()
+        reason = backend.start(self.sleeper(0.2)).wait_for(10)
+        self.assertEqual(reason, backends.WaitReason.EXITED)
+        self.assertLess(monotonic() - begin, 5)
+        self.assertEqual(backend.communicate(), 0)
+
+    def test_deadline_first(self):
+        backend = backends.PopenBasedBackend()
+        begin = monotonic()
+        reason = backend.start(self.sleeper(10)).wait_for(0.3)
+        elapsed = monotonic() - begin
+        self.assertEqual(reason, backends.WaitReason.DEADLINE)
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 5)
+        backend.stop()
+
+    def test_not_started(self):
+        self.assertEqual(backends.PopenBasedBackend().wait_for(1), backends.WaitReason.NOT_STARTED)
+
+    def test_recorder_returns_when_backend_dies(self):
+        def fake_record(mplayer, source_path, dump_file):
+            return mplayer.start(self.sleeper(0.2))
+
+        with patch('recorder.backends.MPlayer.record', autospec=True, side_effect=fake_record):
+            r = AudioStreamRecorder()
+            begin = monotonic()
+            destination = r.record('http://localhost/stream', duration=0)
+
+        self.assertLess(monotonic() - begin, 5)
+        self.assertEqual(r.wait_reason, backends.WaitReason.EXITED)
+        self.assertTrue(r.is_stopped)
+        unlink(destination)
+
+
+class TestResilientRecording(TestCase):
+    """
+    AudioStreamRecorder.record_resilient() test with a fake backend which drops the stream once.
+    """
+
+    def setUp(self):
+        self.recorder = AudioStreamRecorder(retry_backoff=2, retry_backoff_max=5)
+        self.recorder.backend = MagicMock()
+        self.recorder.backend.is_recording = False
+        self.recorder.backend.record.side_effect = self.fake_record
+        self.recorder.backend.wait_for.side_effect = [
+            backends.WaitReason.EXITED,    # dropped
+            backends.WaitReason.EXITED,    # reconnection fails immediately, empty segment
+            backends.WaitReason.DEADLINE,  # goes well until the end
+        ]
+        self.urls = ['rtmp://first', 'rtmp://second', 'rtmp://third']
+        self.resolved = []
+
+    def fake_record(self, url, dump_file):
+        with open(dump_file, 'wb') as f:
+            f.write(b'' if url == 'rtmp://second' else url.encode('ascii'))
+        return self.recorder.backend
+
+    def url_resolver(self):
+        self.resolved.append(self.urls[len(self.resolved)])
+        return self.resolved[-1]
+
+    @staticmethod
+    def fake_concat(input_paths, output_path):
+        with open(output_path, 'wb') as f:
+            for path in input_paths:
+                with open(path, 'rb') as i:
+                    f.write(i.read())
+        return 0
+
+    @patch('recorder.sleep')
+    def test_record_resilient(self, mocked_sleep):
+        from json import load as json_load
+
+        with patch.object(self.recorder.ffmpeg, 'concat', side_effect=self.fake_concat) as mocked_concat:
+            destination = self.recorder.record_resilient(self.url_resolver, duration=3600)
+
+        self.assertEqual(self.resolved, self.urls)
+        # exponential backoff: the empty segment does not reset the delay
+        self.assertEqual([x[0][0] for x in mocked_sleep.call_args_list], [2, 4])
+        self.assertEqual(len(mocked_concat.call_args[0][0]), 2)
+
+        with open(destination, 'rb') as f:
+            self.assertEqual(f.read(), b'rtmp://firstrtmp://third')
+
+        with open(destination + '.gaps.json') as f:
+            report = json_load(f)
+        self.assertEqual(report['reason'], backends.WaitReason.DEADLINE)
+        self.assertEqual(report['unjoined_segments'], [])
+        self.assertEqual(len(report['gaps']), 1)
+        self.assertEqual(report['gaps'][0]['attempts'], 2)
+        self.assertGreaterEqual(report['gaps'][0]['length'], 0)
+
+        unlink(destination)
+        unlink(destination + '.gaps.json')
+
+
+class TestFFMpegCapture(TestCase):
+    """
+    Single pass record-and-tag test. A fake ffmpeg writes its arguments to the output, and quits on 'q'.
+    """
+
+    fake_ffmpeg = '''#!{python}
+import sys
+with open(sys.argv[-1], 'w') as f:
+    f.write('\\n'.join(sys.argv[1:]))
+sys.exit(0 if sys.stdin.read(1) == 'q' else 1)
+'''
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.ffmpeg_path = join(self.temp_dir, 'ffmpeg')
+        with open(self.ffmpeg_path, 'w') as f:
+            f.write(self.fake_ffmpeg.format(python=python_path))
+        chmod(self.ffmpeg_path, 0o755)
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_record_with_metadata(self):
+        output = join(self.temp_dir, 'out.m4a')
+        r = AudioStreamRecorder(backend='ffmpeg', ffmpeg_path=self.ffmpeg_path)
+        self.assertTrue(r.tags_while_recording)
+
+        r.record('http://localhost/stream', duration=0.5, destination=output, metadata={'title': 'My Show'})
+
+        self.assertEqual(r.wait_reason, backends.WaitReason.DEADLINE)
+        self.assertEqual(r.backend.return_val, 0)  # quit by 'q', not killed
+        with open(output) as f:
+            arguments = f.read().split('\n')
+        self.assertEqual(arguments[arguments.index('-i') + 1], 'http://localhost/stream')
+        self.assertIn('title=My Show', arguments)
+        self.assertEqual(arguments[-3:], ['-codec', 'copy', output])
+
+    def test_metadata_not_supported(self):
+        with self.assertRaises(ValueError):
+            AudioStreamRecorder(backend='mplayer').record('http://localhost', 1, 'out.m4a', metadata={'title': 'x'})
+
+
+class TestHttpStreamCapture(TestCase):
+    """
+    HttpStreamCapture backend test against a local http server.
+    """
+
+    def setUp(self):
+        self.resource_dir = join(dirname(__file__), 'resources')
+        with open(join(self.resource_dir, 'sample.mp3'), 'rb') as f:
+            self.sample = f.read()
+        temp_fd, self.dump_file = mkstemp()
+        close(temp_fd)
+        self.temp_dir = mkdtemp()
+
+    def tearDown(self):
+        unlink(self.dump_file)
+        rmtree(self.temp_dir)
+
+    def test_http(self):
+        capture = backends.HttpStreamCapture(capture_buffer_size=4096)
+        with LocalHttpServer(self.resource_dir) as server:
+            reason = capture.record(server.url('sample.mp3'), self.dump_file).wait_for(10)
+            self.assertEqual(reason, backends.WaitReason.EXITED)
+            self.assertEqual(capture.stop(), 0)
+
+        self.assertTrue(capture.is_stopped)
+        self.assertEqual(capture.bytes_written, len(self.sample))
+        with open(self.dump_file, 'rb') as f:
+            self.assertEqual(f.read(), self.sample)
+
+    def test_hls(self):
+        # split the sample into three segments, under a master playlist
+        third = len(self.sample) // 3
+        chunks = [self.sample[:third], self.sample[third:third * 2], self.sample[third * 2:]]
+        for idx, chunk in enumerate(chunks):
+            with open(join(self.temp_dir, 'seg%d.mp3' % idx), 'wb') as f:
+                f.write(chunk)
+        with open(join(self.temp_dir, 'media.m3u8'), 'w') as f:
+            f.write('#EXTM3U\n#EXT-X-TARGETDURATION:10\n#EXT-X-MEDIA-SEQUENCE:7\n')
+            for idx in range(len(chunks)):
+                f.write('#EXTINF:10,\nseg%d.mp3\n' % idx)
+            f.write('#EXT-X-ENDLIST\n')
+        with open(join(self.temp_dir, 'master.m3u8'), 'w') as f:
+            f.write('#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1000\nlow.m3u8\n')
+            f.write('#EXT-X-STREAM-INF:BANDWIDTH=128000\nmedia.m3u8\n')
+
+        capture = backends.HttpStreamCapture()
+        with LocalHttpServer(self.temp_dir) as server:
+            reason = capture.record(server.url('master.m3u8'), self.dump_file).wait_for(10)
+            self.assertEqual(reason, backends.WaitReason.EXITED)
+            self.assertEqual(capture.stop(), 0)
+
+        with open(self.dump_file, 'rb') as f:
+            self.assertEqual(f.read(), self.sample)
+
+    def test_live_stream(self):
+        class EndlessStreamHandler(QuietHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'audio/aac')
+                self.end_headers()
+                try:
+                    while True:
+                        self.wfile.write(b'\xff' * 1024)
+                        sleep(0.01)
+                except OSError:
+                    pass
+
+        capture = backends.HttpStreamCapture()
+        with LocalHttpServer(self.temp_dir, EndlessStreamHandler) as server:
+            reason = capture.record(server.url('live'), self.dump_file).wait_for(0.5)
+            self.assertEqual(reason, backends.WaitReason.DEADLINE)
+            self.assertTrue(capture.is_recording)
+            begin = monotonic()
+            self.assertEqual(capture.stop(), 0)
+            self.assertLess(monotonic() - begin, 2)
+
+        self.assertGreater(capture.bytes_written, 0)
+
+    def test_stop_stalled_stream(self):
+        class StalledStreamHandler(QuietHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'audio/aac')
+                self.end_headers()
+                self.wfile.write(b'\xff' * 1024)
+                self.wfile.flush()
+                sleep(5)
+
+        capture = backends.HttpStreamCapture(capture_timeout=30)
+        with LocalHttpServer(self.temp_dir, StalledStreamHandler) as server:
+            reason = capture.record(server.url('live'), self.dump_file).wait_for(0.5)
+            self.assertEqual(reason, backends.WaitReason.DEADLINE)
+            begin = monotonic()
+            self.assertEqual(capture.stop(timeout=1), 0)
+            self.assertLess(monotonic() - begin, 1)
+            # the capture thread has exited, not abandoned while writing.
+            self.assertTrue(capture.is_stopped)
+
+        self.assertEqual(1024, capture.bytes_written)
+        self.assertIsNone(capture.error)
+
+    def test_failure(self):
+        capture = backends.HttpStreamCapture()
+        with LocalHttpServer(self.resource_dir) as server:
+            reason = capture.record(server.url('not-found.mp3'), self.dump_file).wait_for(10)
+        self.assertEqual(reason, backends.WaitReason.EXITED)
+        self.assertEqual(capture.stop(), 1)
+        self.assertIsNotNone(capture.error)
+
+
+class FakeClock(object):
+    """
+    Time passes only when advance() is called. sleep_until() blocks until then.
+    """
+
+    def __init__(self, now):
+        self.now = now
+        self.targets = []
+        self.condition = Condition()
+
+    def time(self):
+        with self.condition:
+            return self.now
+
+    def sleep_until(self, timestamp):
+        with self.condition:
+            self.targets.append(timestamp)
+            self.condition.wait_for(lambda: self.now >= timestamp, timeout=10)
+
+    def advance(self, seconds):
+        with self.condition:
+            self.now += seconds
+            self.condition.notify_all()
+
+
+class FakeCaptureBackend(object):
+    """
+    Records nothing, but takes the fake clock's time.
+    """
+    lock = Lock()
+    active = 0
+    max_active = 0
+
+    def __init__(self, clock, log):
+        self.clock = clock
+        self.log = log
+        self.is_recording = False
+        self.is_stopped = True
+
+    def record(self, url, dump_file):
+        with self.lock:
+            FakeCaptureBackend.active += 1
+            FakeCaptureBackend.max_active = max(FakeCaptureBackend.active, FakeCaptureBackend.max_active)
+        self.log.append((url, dump_file, self.clock.time()))
+        return self
+
+    def wait_for(self, timeout=None):
+        self.clock.sleep_until(self.clock.time() + timeout)
+        return backends.WaitReason.DEADLINE
+
+    def interrupt(self):
+        pass
+
+    def stop(self):
+        with self.lock:
+            FakeCaptureBackend.active -= 1
+
+
+class TestRecordingScheduler(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(100000)
+        self.log = []
+        self.resolved = []
+        self.temp_dir = mkdtemp()
+        FakeCaptureBackend.active = FakeCaptureBackend.max_active = 0
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def recorder_factory(self):
+        recorder = AudioStreamRecorder(work_path=self.temp_dir)
+        recorder.backend = FakeCaptureBackend(self.clock, self.log)
+        return recorder
+
+    def url_resolver(self, channel):
+        self.resolved.append((channel, self.clock.time()))
+        return 'rtmp://' + channel
+
+    def test_run(self):
+        jobs = [
+            scheduler.RecordingJob('mfm', 100010, 20, join(self.temp_dir, 'mfm.m4a'), program_id=1),
+            scheduler.RecordingJob('sfm', 100015, 10, join(self.temp_dir, 'sfm.m4a'), program_id=2),
+            scheduler.RecordingJob('chm', 100040, 5, join(self.temp_dir, 'chm_%H%M%S.m4a'), program_id=3),
+            scheduler.RecordingJob('chm', 99000, 5, join(self.temp_dir, 'past.m4a')),  # already ended, dropped
+        ]
+        s = scheduler.RecordingScheduler(
+            jobs=jobs,
+            workers=2,
+            lead_time=3,
+            clock=self.clock,
+            url_resolver=self.url_resolver,
+            recorder_factory=self.recorder_factory
+        )
+        runner = Thread(target=s.run, daemon=True)
+        runner.start()
+        for _ in range(60):
+            sleep(0.01)
+            self.clock.advance(1)
+        runner.join(10)
+        self.assertFalse(runner.is_alive())
+
+        self.assertEqual(len(s.history), 3)
+        self.assertEqual(FakeCaptureBackend.max_active, 2)
+        for record in s.history:
+            self.assertIsNone(record['error'])
+            # dispatched at lead time, then waits for the exact start
+            self.assertIn(record['start'] - 3, self.clock.targets)
+            self.assertIn(record['start'], self.clock.targets)
+            self.assertLess(record['resolved_at'], record['start'])
+            self.assertGreaterEqual(record['started_at'], record['start'])
+
+        self.assertEqual([x[0] for x in self.resolved], ['mfm', 'sfm', 'chm'])
+        self.assertEqual([x[0] for x in self.log], ['rtmp://mfm', 'rtmp://sfm', 'rtmp://chm'])
+        self.assertEqual(self.log[2][1], datetime.fromtimestamp(100040).strftime(join(self.temp_dir, 'chm_%H%M%S.m4a')))
+
+    def test_metrics_flush(self):
+        metrics_path = join(self.temp_dir, 'metrics.prom')
+        instrument.metrics.enable(metrics_path, 'prometheus')
+        try:
+            jobs = [scheduler.RecordingJob('mfm', 100010, 5, join(self.temp_dir, 'mfm.m4a'))]
+            s = scheduler.RecordingScheduler(
+                jobs=jobs, clock=self.clock, url_resolver=self.url_resolver, recorder_factory=self.recorder_factory
+            )
+            runner = Thread(target=s.run, daemon=True)
+            runner.start()
+            for _ in range(20):
+                sleep(0.01)
+                self.clock.advance(1)
+            runner.join(10)
+
+            # written after the job, not only at exit.
+            with open(metrics_path) as f:
+                self.assertIn('almond_recordings_total{', f.read())
+        finally:
+            instrument.metrics.disable()
+            instrument.metrics.reset()
+
+    def test_admission(self):
+        """
+        A job whose space is not free fails in its lead time, before its start, without recording.
+        """
+        disk = admission.DiskSpaceAdmission(headroom=0, usage=lambda path: (0, 0, 1000))
+        jobs = [scheduler.RecordingJob('mfm', 100010, 20, join(self.temp_dir, 'mfm.m4a'))]
+        s = scheduler.RecordingScheduler(
+            jobs=jobs,
+            clock=self.clock,
+            url_resolver=self.url_resolver,
+            recorder_factory=self.recorder_factory,
+            admission=disk
+        )
+        runner = Thread(target=s.run, daemon=True)
+        runner.start()
+        # up to the lead time, 5 seconds before the start.
+        for _ in range(5):
+            sleep(0.01)
+            self.clock.advance(1)
+        runner.join(10)
+
+        self.assertFalse(runner.is_alive())
+        self.assertIsInstance(s.history[0]['error'], exceptions.InsufficientSpaceException)
+        self.assertIsNone(s.history[0]['started_at'])
+        self.assertLess(s.history[0]['ended_at'], 100010)
+        self.assertEqual([], self.log)
+        self.assertEqual(1000, disk.available(self.temp_dir))
+
+    def test_stop(self):
+        """
+        stop() interrupts the backends, and each worker stops its own, then finishes the job as usual.
+        """
+        mplayer_path = join(self.temp_dir, 'mplayer')
+        with open(mplayer_path, 'w') as f:
+            f.write('#!/bin/sh\nexec sleep 30\n')
+        chmod(mplayer_path, 0o755)
+        recorders = []
+
+        def recorder_factory():
+            recorder = AudioStreamRecorder(work_path=self.temp_dir, mplayer_path=mplayer_path)
+            recorders.append(recorder)
+            return recorder
+
+        jobs = [scheduler.RecordingJob('mfm', 100010, 20, join(self.temp_dir, 'mfm.m4a'))]
+        s = scheduler.RecordingScheduler(
+            jobs=jobs, clock=self.clock, url_resolver=self.url_resolver, recorder_factory=recorder_factory
+        )
+        runner = Thread(target=s.run, daemon=True)
+        runner.start()
+        for _ in range(10):
+            sleep(0.01)
+            self.clock.advance(1)
+        for _ in range(500):
+            if recorders and recorders[0].backend.is_recording:
+                break
+            sleep(0.01)
+        self.assertTrue(recorders[0].backend.is_recording)
+
+        begin = monotonic()
+        s.stop()
+        runner.join(10)
+        self.assertFalse(runner.is_alive())
+        self.assertLess(monotonic() - begin, 5)
+
+        self.assertIsNone(s.history[0]['error'])
+        self.assertEqual(backends.WaitReason.INTERRUPTED, s.history[0]['reason'])
+        self.assertTrue(recorders[0].backend.is_stopped)
+
+    def test_daily_job(self):
+        job = scheduler.RecordingJob('mfm', '2016-12-01 07:00:00', 3600, 'out.m4a', repeat='daily')
+        now = datetime(2016, 12, 3, 7, 30).timestamp()
+        self.assertEqual(job.next_start(now), datetime(2016, 12, 3, 7, 0).timestamp())
+        now = datetime(2016, 12, 3, 8, 0).timestamp()
+        self.assertEqual(job.next_start(now), datetime(2016, 12, 4, 7, 0).timestamp())
+
+
+class TestTags(TestCase):
+    """
+    In-place tag writer test: ID3v2 on the sample, and MP4 on synthetic files.
+    """
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.mp3 = join(self.temp_dir, 'sample.mp3')
+        shutil_copy(join(dirname(__file__), 'resources', 'sample.mp3'), self.mp3)
+        with open(self.mp3, 'rb') as f:
+            data = f.read()
+        self.tag_size = 10 + tags.ID3v2Writer._syncsafe_to_int(data[6:10])
+        self.audio = data[self.tag_size:]
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def read_audio(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        return data[10 + tags.ID3v2Writer._syncsafe_to_int(data[6:10]):]
+
+    def test_id3(self):
+        self.assertEqual(tags.read_tags(self.mp3)['album'], 'Farther Than All The Stars')
+
+        # the sample has only 10 bytes of padding: grows once.
+        self.assertTrue(tags.write_tags(self.mp3, {'title': 'New Title', 'comment': '#01/02 a - b\n#02/02 c - d'}))
+        self.assertEqual(self.read_audio(self.mp3), self.audio)
+        size = stat(self.mp3).st_size
+        self.assertGreater(size, self.tag_size + len(self.audio))
+
+        # now it fits in place
+        self.assertTrue(tags.write_tags(self.mp3, {'comment': 'replaced', 'description': '설명'}))
+        self.assertEqual(stat(self.mp3).st_size, size)
+        self.assertEqual(self.read_audio(self.mp3), self.audio)
+
+        t = tags.read_tags(self.mp3)
+        self.assertEqual(t['title'], 'New Title')
+        self.assertEqual(t['comment'], 'replaced')
+        self.assertEqual(t['description'], '설명')
+        self.assertEqual(t['album'], 'Farther Than All The Stars')
+        self.assertEqual(t['TDAT'], '2016-10-02 16:43:03')
+
+    def test_id3_untagged(self):
+        with open(self.mp3, 'wb') as f:
+            f.write(self.audio)
+        self.assertTrue(tags.write_tags(self.mp3, {'title': 'Untagged'}))
+        self.assertEqual(tags.read_tags(self.mp3), {'title': 'Untagged'})
+        self.assertEqual(self.read_audio(self.mp3), self.audio)
+
+    @staticmethod
+    def atom(atom_type, payload):
+        return pack('>I4s', 8 + len(payload), atom_type) + payload
+
+    def make_mp4(self, moov_first, moov_extra=b''):
+        ftyp = self.atom(b'ftyp', b'M4A \x00\x00\x02\x00isomiso2')
+        mdat = self.atom(b'mdat', bytes(range(256)) * 64)
+        moov = self.atom(b'moov', self.atom(b'mvhd', b'\x00' * 100) + moov_extra)
+        path = join(self.temp_dir, 'sample.m4a')
+        with open(path, 'wb') as f:
+            f.write(ftyp + (moov + mdat if moov_first else mdat + moov))
+        return path, mdat
+
+    def test_mp4_moov_at_end(self):
+        path, mdat = self.make_mp4(moov_first=False)
+        self.assertTrue(tags.write_tags(path, {'title': 'Title', 'comment': 'Comment', 'rating': '5'}))
+        self.assertEqual(tags.read_tags(path), {'title': 'Title', 'comment': 'Comment', 'rating': '5'})
+
+        self.assertTrue(tags.write_tags(path, {'title': 'Title 2'}))
+        self.assertEqual(tags.read_tags(path), {'title': 'Title 2', 'comment': 'Comment', 'rating': '5'})
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read()[24:24 + len(mdat)], mdat)
+
+    def test_mp4_moov_first(self):
+        # faststart layout: moov must not move mdat. Room is given by a free atom.
+        free = self.atom(b'free', b'\x00' * 200)
+        meta = self.atom(b'meta', b'\x00' * 4 + self.atom(b'ilst', b'') + free)
+        path, mdat = self.make_mp4(moov_first=True, moov_extra=self.atom(b'udta', meta))
+        size = stat(path).st_size
+
+        self.assertTrue(tags.write_tags(path, {'title': 'Title', 'artist': 'Artist'}))
+        self.assertEqual(stat(path).st_size, size)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read()[-len(mdat):], mdat)
+        self.assertEqual(tags.read_tags(path), {'title': 'Title', 'artist': 'Artist'})
+
+        # too large to fit: left to ffmpeg
+        self.assertFalse(tags.write_tags(path, {'comment': 'x' * 1000}))
+        self.assertEqual(tags.read_tags(path), {'title': 'Title', 'artist': 'Artist'})
+
+    def test_unsupported(self):
+        path = join(self.temp_dir, 'raw.aac')
+        with open(path, 'wb') as f:
+            f.write(b'\xff\xf1' + b'\x00' * 100)
+        self.assertFalse(tags.write_tags(path, {'title': 'x'}))
+
+
 class TestDirectoryCleaner(TestCase):
     """
     DirectoryCleaner class test
@@ -128,7 +773,7 @@ class TestDirectoryCleaner(TestCase):
         # Mocking _grab_files() method
         self.patch = patch('recorder.utils.DirectoryCleaner._grab_files')
         self.mock = self.patch.start()
-        self.mock.return_value = [
+        self.items = [
             ('/home/tester/foo.txt', self.now - (self.day_in_sec * 8)),
             ('/home/tester/bar.txt', self.now - (self.day_in_sec * 55)),
             ('/home/tester/foobar.m4a', self.now - (self.day_in_sec * 60)),
@@ -136,6 +781,10 @@ class TestDirectoryCleaner(TestCase):
             ('/home/tester/IMG_2039.jpg', self.now - (self.day_in_sec * 20)),
             ('/home/tester/IMG_5040.png', self.now - (self.day_in_sec * 2)),
         ]
+        # ext and pattern are applied by _grab_files(), as a predicate.
+        self.mock.side_effect = lambda target_dir, recursive, accept=None: [
+            x for x in self.items if accept is None or accept(x[0])
+        ]
 
     def tearDown(self):
         self.patch.stop()
@@ -222,6 +871,306 @@ class TestDirectoryCleaner(TestCase):
         for item in filtered:
             self.assertTrue(item[0].endswith(ext))
 
+    def test_top_k(self):
+        """
+        reserve() and limit() select the same files as a full sort, ties included
+        """
+        self.items = [('/home/tester/%03d.m4a' % randint(0, 50), float(randint(0, 30))) for _ in range(200)]
+        for order_by in utils.DirectoryCleaner.supported_orders:
+            key = itemgetter(utils.DirectoryCleaner.supported_orders.index(order_by))
+            for order in ('asc', 'desc'):
+                ordered = sorted(self.items, key=key, reverse=(order == 'desc'))
+                for number in (1, 7, 199, 200, 300):
+                    self.dc.reset().order_by(order_by)
+                    getattr(self.dc, order)()
+
+                    self.assertEqual(ordered[:number], self.dc.limit(number).files())
+                    self.assertEqual(ordered[number:], self.dc.reserve(number).files())
+                    self.assertEqual(sorted(ordered[number:]), sorted(self.dc.iter_files()))
+
+    def test_clean(self):
+        """
+        clean() removes files while crawling
+        """
+        self.patch.stop()
+        temp_dir = mkdtemp()
+        try:
+            for i in range(5):
+                path = join(temp_dir, '%d.m4a' % i)
+                with open(path, 'wb'):
+                    pass
+                utime(path, (self.now - i * 60, self.now - i * 60))
+
+            summary = self.dc.dir(temp_dir).order_by('mtime').desc().reserve(2).clean(workers=1)
+            self.assertEqual(['0.m4a', '1.m4a'], sorted(listdir(temp_dir)))
+            self.assertEqual(3, summary['removed'])
+            self.assertEqual([], summary['errors'])
+        finally:
+            rmtree(temp_dir)
+            self.patch.start()
+
+    def test_clean_parallel(self):
+        """
+        clean() dry run, and removal in threads of the files listed before
+        """
+        self.patch.stop()
+        temp_dir = mkdtemp()
+        try:
+            for i in range(20):
+                with open(join(temp_dir, '%02d.m4a' % i), 'wb') as f:
+                    f.write(b'0' * i)
+
+            summary = self.dc.dir(temp_dir).clean(dry_run=True, workers=4)
+            self.assertEqual(20, len(listdir(temp_dir)))
+            self.assertEqual((20, sum(range(20)), [], True), (
+                summary['removed'], summary['bytes'], summary['errors'], summary['dry_run']
+            ))
+
+            listed = self.dc.order_by('name').asc().limit(10).files(exclude_mtime=True)
+            unlink(listed[0])
+            with patch('recorder.utils.DirectoryCleaner._grab_files') as mocked_grab_files:
+                summary = self.dc.clean(workers=4, reuse_target=True)
+                mocked_grab_files.assert_not_called()
+
+            self.assertEqual(['%02d.m4a' % i for i in range(10, 20)], sorted(listdir(temp_dir)))
+            self.assertEqual((9, sum(range(1, 10))), (summary['removed'], summary['bytes']))
+            self.assertEqual([listed[0]], [path for path, _ in summary['errors']])
+            self.assertIsInstance(summary['errors'][0][1], FileNotFoundError)
+            self.assertEqual([listed[0]], [x[0] for x in self.dc.target])
+        finally:
+            rmtree(temp_dir)
+            self.patch.start()
+
+    def test_grab_files(self):
+        """
+        _grab_files() test on a real tree
+        """
+        self.patch.stop()
+        temp_dir = mkdtemp()
+        try:
+            makedirs(join(temp_dir, 'sub', 'deeper'))
+            for path in ('a.m4a', 'b.mp3', join('sub', 'c.m4a'), join('sub', 'deeper', 'd.m4a')):
+                with open(join(temp_dir, path), 'wb'):
+                    pass
+
+            flat = list(self.dc._grab_files(temp_dir, False))
+            self.assertEqual({join(temp_dir, 'a.m4a'), join(temp_dir, 'b.mp3')}, {x[0] for x in flat})
+            self.assertEqual(stat(join(temp_dir, 'a.m4a')).st_mtime, dict(flat)[join(temp_dir, 'a.m4a')])
+
+            expected = []
+            for dir_path, _, file_names in walk(temp_dir):
+                expected += [join(dir_path, x) for x in file_names if x.endswith('.m4a')]
+            filtered = self.dc.dir(temp_dir).recursive(True).ext('m4a').files(exclude_mtime=True)
+            self.assertEqual(sorted(expected), sorted(filtered))
+
+            # every file is offered to the predicate, and the rejected ones are not yielded.
+            seen = []
+            self.assertEqual([], list(self.dc._grab_files(temp_dir, True, lambda path: seen.append(path) or False)))
+            self.assertEqual(4, len(seen))
+
+            with self.assertRaises(FileNotFoundError):
+                list(self.dc._grab_files(join(temp_dir, 'missing'), False))
+        finally:
+            rmtree(temp_dir)
+            self.patch.start()
+
+
+class TestArchiveIndex(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.index = archive.ArchiveIndex(self.temp_dir)
+        self.now = time()
+
+    def tearDown(self):
+        self.index.close()
+        rmtree(self.temp_dir)
+
+    def write(self, path, days_ago=0, size=1):
+        path = join(self.temp_dir, path)
+        if not exists(dirname(path)):
+            makedirs(dirname(path))
+        with open(path, 'wb') as f:
+            f.write(b'0' * size)
+        mtime = self.now - days_ago * 3600 * 24
+        utime(path, (mtime, mtime))
+        return path
+
+    def test_add(self):
+        path = self.write('mfm_2016-12-01.m4a')
+        self.assertTrue(self.index.add(path, program_id=7))
+        self.assertFalse(self.index.add(join(dirname(self.temp_dir), 'elsewhere.m4a')))
+        self.assertEqual(
+            {'path': path, 'size': 1, 'mtime': stat(path).st_mtime, 'channel': 'mfm', 'program_id': 7,
+             'air_date': '2016-12-01', 'tagged': 0},
+            self.index.get(path)
+        )
+
+        # known values are kept, and the file is taken again.
+        self.write('mfm_2016-12-01.m4a', size=10)
+        self.index.mark_tagged(path)
+        self.assertEqual((10, 7, 1), tuple(self.index.get(path)[x] for x in ('size', 'program_id', 'tagged')))
+
+        self.index.remove([path])
+        self.assertIsNone(self.index.get(path))
+
+    def test_query(self):
+        old = self.write('a/sfm_2016-11-01.m4a', days_ago=40)
+        new = self.write('a/b/sfm_2016-12-01.m4a', days_ago=1)
+        self.write('a0/sfm_2016-12-01.m4a', days_ago=40)
+        for path in (old, new):
+            self.index.add(path, program_id=7)
+        self.index.reconcile()
+
+        older = self.index.query(program_id=7, before=datetime.now() - timedelta(days=30))
+        self.assertEqual([old], [x['path'] for x in older])
+        self.assertEqual(3, len(self.index.query(channel='sfm')))
+        self.assertEqual([old, new], [x['path'] for x in self.index.query(under=join(self.temp_dir, 'a'))])
+        self.assertEqual([old], [x['path'] for x in self.index.query(under=join(self.temp_dir, 'a'), recursive=False)])
+        latest = self.index.query(program_id=7, order_by='air_date', desc=True, limit=1)
+        self.assertEqual([new], [x['path'] for x in latest])
+        with self.assertRaises(ValueError):
+            self.index.query(order_by='size')
+
+    def test_reconcile(self):
+        first = self.write('a/1.m4a')
+        self.write('b/c/2.m4a')
+        self.assertEqual(
+            {'scanned': 4, 'skipped': 0, 'added': 2, 'updated': 0, 'removed': 0},
+            self.index.reconcile()
+        )
+        # the index itself is not indexed.
+        self.assertEqual(2, len(self.index))
+        self.assertEqual(4, self.index.reconcile()['skipped'])
+
+        # only the changed directories are scanned.
+        self.write('b/c/3.m4a')
+        unlink(first)
+        summary = self.index.reconcile()
+        self.assertEqual((2, 2, 1, 1), (summary['scanned'], summary['skipped'], summary['added'], summary['removed']))
+
+        rmtree(join(self.temp_dir, 'b'))
+        self.assertEqual(2, self.index.reconcile()['removed'])
+        self.assertEqual(0, len(self.index))
+
+        # modified in place: found by a full scan.
+        path = self.write('a/4.m4a')
+        self.index.reconcile()
+        self.write('a/4.m4a', size=5)
+        self.assertEqual(0, self.index.reconcile()['updated'])
+        self.assertEqual(1, self.index.reconcile(full=True)['updated'])
+        self.assertEqual(5, self.index.get(path)['size'])
+
+    def test_directory_cleaner(self):
+        for i in range(6):
+            self.write('%d/mfm_%d.m4a' % (i % 2, i), days_ago=i)
+        self.write('notes.txt')
+
+        cleaner = utils.DirectoryCleaner().dir(self.temp_dir).recursive(True).ext('m4a').index(self.index)
+        with patch('recorder.utils.DirectoryCleaner._grab_files') as mocked_grab_files:
+            self.assertEqual(
+                [join(self.temp_dir, '%d/mfm_%d.m4a' % (i % 2, i)) for i in range(6)],
+                cleaner.files(exclude_mtime=True)
+            )
+            summary = cleaner.reserve(2).clean()
+            mocked_grab_files.assert_not_called()
+
+        self.assertEqual(4, summary['removed'])
+        self.assertEqual(
+            [join(self.temp_dir, x) for x in ('0/mfm_0.m4a', '1/mfm_1.m4a', 'notes.txt')],
+            [x['path'] for x in self.index.query(order_by='path')]
+        )
+
+
+class TestDiskSpaceAdmission(TestCase):
+
+    mb = 1024 * 1024
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.free = 10 * self.mb
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def usage(self, path):
+        return 0, 0, self.free
+
+    def test_estimate(self):
+        disk = admission.DiskSpaceAdmission(channel_bitrates={'mfm': 80000})
+        self.assertEqual(1100000, disk.estimate('mfm', 100))
+        self.assertEqual(int(128000 / 8 * 100 * 1.1), disk.estimate('sfm', 100))
+        self.assertEqual(disk.estimate('mfm', 3600), disk.estimate('mfm', 0))
+
+        # the metadata pass needs another copy
+        output_path = join(self.temp_dir, 'out', 'mfm.m4a')
+        needs = disk.needs_of('mfm', 100, output_path, work_path=self.temp_dir)
+        self.assertEqual([(self.temp_dir, 1100000, None), (join(self.temp_dir, 'out'), 1100000, output_path)], needs)
+
+    def test_reservations(self):
+        disk = admission.DiskSpaceAdmission(headroom=self.mb, usage=self.usage)
+        output_path = join(self.temp_dir, 'first.m4a')
+        first = disk.admit([(self.temp_dir, 5 * self.mb, output_path)])
+        self.assertEqual(4 * self.mb, disk.available(self.temp_dir))
+
+        with self.assertRaises(exceptions.InsufficientSpaceException) as cm:
+            disk.admit([(self.temp_dir, 5 * self.mb, None)], label='second')
+        self.assertEqual((5 * self.mb, 4 * self.mb), (cm.exception.needed, cm.exception.available))
+        self.assertIn('second', str(cm.exception))
+
+        # written bytes are no longer outstanding, as they are taken from the free space.
+        with open(output_path, 'wb') as f:
+            f.write(b'0' * self.mb)
+        self.assertEqual(5 * self.mb, disk.available(self.temp_dir))
+
+        first.release()
+        with disk.admit([(self.temp_dir, 5 * self.mb, None)]):
+            self.assertEqual(4 * self.mb, disk.available(self.temp_dir))
+        self.assertEqual(9 * self.mb, disk.available(self.temp_dir))
+
+    def test_eviction(self):
+        for i in range(5):
+            path = join(self.temp_dir, 'mfm_%d.m4a' % i)
+            with open(path, 'wb') as f:
+                f.write(b'0' * self.mb)
+            mtime = time() - (5 - i) * 3600
+            utime(path, (mtime, mtime))
+
+        def usage(path):
+            return 0, 0, 10 * self.mb - sum(stat(join(self.temp_dir, x)).st_size for x in listdir(self.temp_dir))
+
+        cleaner = utils.DirectoryCleaner().dir(self.temp_dir).ext('m4a')
+        disk = admission.DiskSpaceAdmission(headroom=0, usage=usage, cleaner=cleaner)
+
+        # the oldest one is still being recorded.
+        disk.admit([(self.temp_dir, self.mb, join(self.temp_dir, 'mfm_0.m4a'))])
+
+        # 5 MB free: the two oldest, but the one in progress, are removed for 7 MB.
+        disk.admit([(join(self.temp_dir, 'new'), 7 * self.mb, None)])
+        self.assertEqual(['mfm_0.m4a', 'mfm_3.m4a', 'mfm_4.m4a'], sorted(listdir(self.temp_dir)))
+
+        # not enough even after eviction: nothing is removed.
+        with self.assertRaises(exceptions.InsufficientSpaceException):
+            disk.admit([(self.temp_dir, 20 * self.mb, None)])
+        self.assertEqual(3, len(listdir(self.temp_dir)))
+
+
+    def test_probe_timeout(self):
+        """
+        A stream that does not answer gets the default bitrate, and is not remembered.
+        """
+        ffprobe_path = join(self.temp_dir, 'ffprobe')
+        with open(ffprobe_path, 'w') as f:
+            f.write('#!/bin/sh\nexec sleep 10\n')
+        chmod(ffprobe_path, 0o755)
+
+        disk = admission.DiskSpaceAdmission(probe=True, ffprobe_path=ffprobe_path)
+        disk.probe_timeout = 0.2
+        begin = time()
+        self.assertEqual(disk.default_bitrate, disk.bitrate('mfm', url='http://127.0.0.1:9/live'))
+        self.assertLess(time() - begin, 5)
+        self.assertNotIn('mfm', disk.channel_bitrates)
+
 
 class TestConnectorMixin(TestCase):
     def test_create_get_url(self):
@@ -286,6 +1235,410 @@ class TestConnectorMixin(TestCase):
         self.assertEqual('fallback-encoding', charset)
 
 
+class TestCharsetDetection(TestCase):
+
+    def setUp(self):
+        self.korean = '<html><body>%s</body></html>' % ('한글 문서 ' * 1000)
+
+    def test_sniff_size(self):
+        late_meta = b' ' * connectors.ConnectorMixin.charset_sniff_size + b'<meta charset="euc-kr">'
+        self.assertEqual('fallback', connectors.ConnectorMixin.detect_charset(None, late_meta, 'fallback'))
+        self.assertEqual('utf-8', connectors.ConnectorMixin.detect_charset(None, b'\xef\xbb\xbf<html>', 'fallback'))
+
+    def test_decode_content(self):
+        content = self.korean.encode('euc-kr')
+        self.assertEqual(self.korean, connectors.ConnectorMixin.decode_content(None, content, ['utf-8', 'euc-kr']))
+
+        with patch.object(connectors.FallbackDecoder, 'decodes', return_value=False):
+            with self.assertRaises(UnicodeDecodeError):
+                connectors.ConnectorMixin.decode_content(None, content, ['utf-8', 'euc-kr'])
+
+    def test_fallback_decoder(self):
+        content = self.korean.encode('euc-kr')
+        decoder = connectors.FallbackDecoder(['utf-8', 'euc-kr'], sample_size=100)
+        # odd chunks split multibyte characters.
+        text = ''.join(decoder.decode(content[i:i + 33]) for i in range(0, len(content), 33))
+        text += decoder.decode(b'', final=True)
+        self.assertEqual('euc-kr', decoder.charset)
+        self.assertEqual(self.korean, text)
+
+        # a short content settles on final.
+        decoder = connectors.FallbackDecoder(['utf-8', 'euc-kr'], sample_size=100)
+        self.assertEqual('', decoder.decode('한'.encode('utf-8')))
+        self.assertEqual('한', decoder.decode(b'', final=True))
+        self.assertEqual('utf-8', decoder.charset)
+
+    def test_host_charset(self):
+        temp_dir = mkdtemp()
+        with open(join(temp_dir, 'page.html'), 'wb') as f:
+            f.write(self.korean.encode('euc-kr'))
+        with open(join(temp_dir, 'utf8.html'), 'wb') as f:
+            f.write(self.korean.encode('utf-8'))
+
+        connector = connectors.BasicConnector(fallback_charset=['euc-kr', 'utf-8'])
+        try:
+            with LocalHttpServer(temp_dir) as server, \
+                    patch.object(connectors.BasicConnector, 'detect_charset', wraps=connector.detect_charset) as mocked:
+                self.assertEqual(self.korean, connector.get(server.url('page.html')))
+                self.assertEqual(self.korean, connector.get(server.url('page.html')))
+                self.assertEqual(1, mocked.call_count)
+                self.assertEqual('euc-kr', connector._host_charsets[ratelimit.host_of(server.url())])
+
+                # a page in another charset: the host's charset is forgotten, and detected again.
+                self.assertEqual(self.korean, connector.get(server.url('utf8.html')))
+                self.assertEqual('utf-8', connector._host_charsets[ratelimit.host_of(server.url())])
+                self.assertEqual(self.korean, ''.join(connector.iter_text(server.url('utf8.html'))))
+
+                # the same while streaming, which never decodes the whole content again.
+                self.assertEqual(self.korean, ''.join(connector.iter_text(server.url('page.html'))))
+                self.assertEqual('euc-kr', connector._host_charsets[ratelimit.host_of(server.url())])
+        finally:
+            rmtree(temp_dir)
+
+
+class TestStreamingDownload(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.served_dir = join(self.temp_dir, 'served')
+        mkdir(self.served_dir)
+        self.content = bytes(range(256)) * 1000
+        with open(join(self.served_dir, 'data.bin'), 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_download_to(self):
+        output_path = join(self.temp_dir, 'data.bin')
+        cookie_path = join(self.temp_dir, 'test.cookie')
+        with LocalHttpServer(self.served_dir) as server:
+            for connector in (connectors.BasicConnector(), connectors.PooledConnector(),
+                              connectors.RequestsConnector(cookie_path, delay=0)):
+                written = connector.download_to(output_path, server.url('data.bin'), chunk_size=1000)
+                self.assertEqual(len(self.content), written)
+                with open(output_path, 'rb') as f:
+                    self.assertEqual(self.content, f.read())
+                self.assertEqual(['data.bin', 'served'], sorted(listdir(self.temp_dir)))
+
+    def test_get_stream(self):
+        with LocalHttpServer(self.served_dir) as server:
+            stream = connectors.BasicConnector().get_stream(server.url('data.bin'), chunk_size=1000)
+            self.assertEqual(self.content[:1000], next(stream))
+            stream.close()
+
+    def test_atomic(self):
+        output_path = join(self.temp_dir, 'data.bin')
+        with open(output_path, 'wb') as f:
+            f.write(b'old')
+
+        def chunks():
+            yield b'new'
+            raise IOError('connection lost')
+
+        with self.assertRaises(IOError):
+            connectors.write_atomic(output_path, chunks())
+        with open(output_path, 'rb') as f:
+            self.assertEqual(b'old', f.read())
+        self.assertEqual(['data.bin', 'served'], sorted(listdir(self.temp_dir)))
+
+    def test_file_mode(self):
+        output_path = join(self.temp_dir, 'data.bin')
+        connectors.write_atomic(output_path, [b'new'])
+        self.assertEqual(connectors.new_file_mode, stat(output_path).st_mode & 0o777)
+
+        # the mode of the file replaced is kept.
+        chmod(output_path, 0o640)
+        connectors.write_atomic(output_path, [b'newer'])
+        self.assertEqual(0o640, stat(output_path).st_mode & 0o777)
+
+    def test_async_stream(self):
+        connector = connectors.AsyncConnector(delay=0)
+        with self.assertRaises(TypeError):
+            connector.get_stream('http://127.0.0.1/data.bin')
+        with self.assertRaises(TypeError):
+            connector.download_to(join(self.temp_dir, 'data.bin'), 'http://127.0.0.1/data.bin')
+
+    def test_last_content(self):
+        with open(join(self.served_dir, 'page.html'), 'w') as f:
+            f.write('page')
+        cookie_path = join(self.temp_dir, 'test.cookie')
+        with LocalHttpServer(self.served_dir) as server:
+            connector = connectors.RequestsConnector(cookie_path, delay=0)
+            self.assertEqual('page', connector.get(server.url('page.html')))
+            self.assertEqual('', connector._last_content)
+            self.assertIsNone(connector._last_response)
+
+            connector.keep_last_content = True
+            connector.get(server.url('page.html'))
+            self.assertEqual('page', connector._last_content)
+
+
+class KeepAliveHandler(QuietHTTPRequestHandler):
+    """
+    HTTP/1.1 file server. Keeps the client port of each request.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    client_ports = []
+
+    def do_GET(self):
+        self.client_ports.append(self.client_address[1])
+        if self.path.startswith('/moved'):
+            self.send_response(302)
+            self.send_header('Location', self.path.replace('/moved', '', 1))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        super(KeepAliveHandler, self).do_GET()
+
+
+class TestPooledConnector(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        with open(join(self.temp_dir, 'page.html'), 'wb') as f:
+            f.write('<html><head><meta charset="euc-kr"></head><body>안녕</body></html>'.encode('euc-kr'))
+        KeepAliveHandler.client_ports = []
+        self.pool = connectors.ConnectionPool(pool_size=2, idle_timeout=30)
+        self.connector = connectors.PooledConnector(pool=self.pool)
+
+    def tearDown(self):
+        self.connector.close()
+        rmtree(self.temp_dir)
+
+    def test_keep_alive(self):
+        with LocalHttpServer(self.temp_dir, KeepAliveHandler) as server:
+            for _ in range(3):
+                self.assertIn('안녕', self.connector.get(server.url('page.html')))
+            self.assertEqual(1, len(set(KeepAliveHandler.client_ports)))
+            self.assertEqual(1, len(self.pool))
+
+            # redirects are followed on the same connection.
+            self.assertIn('안녕', self.connector.get(server.url('moved/page.html'), params={'a': 1}))
+            self.assertEqual(1, len(set(KeepAliveHandler.client_ports)))
+
+            # an error response does not keep its connection.
+            with patch.object(self.pool, 'release', wraps=self.pool.release) as mocked_release:
+                with self.assertRaises(HTTPError) as cm:
+                    self.connector.get(server.url('missing.html'))
+                mocked_release.assert_called_once()
+                self.assertFalse(mocked_release.call_args[0][2])
+            self.assertEqual(404, cm.exception.code)
+            self.assertIn(b'404', cm.exception.read())
+            cm.exception.close()
+
+    def test_partial_read(self):
+        with open(join(self.temp_dir, 'large.bin'), 'wb') as f:
+            f.write(b'0' * connectors.PooledResponse.drain_limit * 2)
+
+        with LocalHttpServer(self.temp_dir, KeepAliveHandler) as server:
+            # a short rest is read out, and the connection is reused.
+            response = self.connector.open(server.url('page.html'))
+            response.read(10)
+            response.close()
+            self.assertEqual(1, len(self.pool))
+
+            # a long one is not.
+            response = self.connector.open(server.url('large.bin'))
+            response.read(10)
+            response.close()
+            self.assertEqual(0, len(self.pool))
+
+            self.connector.get(server.url('page.html'))
+            self.assertEqual(2, len(set(KeepAliveHandler.client_ports)))
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = 0
+        with LocalHttpServer(self.temp_dir, KeepAliveHandler) as server:
+            self.connector.get(server.url('page.html'))
+            self.connector.get(server.url('page.html'))
+            self.assertEqual(2, len(set(KeepAliveHandler.client_ports)))
+
+    def test_stale_connection(self):
+        with LocalHttpServer(self.temp_dir, KeepAliveHandler) as server:
+            self.connector.get(server.url('page.html'))
+            # the server drops the idle connection.
+            for connections in self.pool._idle.values():
+                for conn, _ in connections:
+                    conn.sock.shutdown(SHUT_RDWR)
+            self.assertIn('안녕', self.connector.get(server.url('page.html')))
+            self.assertEqual(2, len(set(KeepAliveHandler.client_ports)))
+
+            # a POST is not sent again: the server may have processed it.
+            for connections in self.pool._idle.values():
+                for conn, _ in connections:
+                    conn.sock.shutdown(SHUT_RDWR)
+            with self.assertRaises(URLError) as cm:
+                self.connector.post(server.url('page.html'), data={'a': 1})
+            # not an answer of the server to a request sent again.
+            self.assertNotIsInstance(cm.exception, HTTPError)
+
+    def test_reused_timeout(self):
+        with LocalHttpServer(self.temp_dir, KeepAliveHandler) as server:
+            self.connector.get(server.url('page.html'))
+            key = next(iter(self.pool._idle))
+            connection, reused = self.pool.acquire(key, timeout=7)
+            self.assertTrue(reused)
+            self.assertEqual(7, connection.sock.gettimeout())
+            connection.close()
+
+
+class TestRateLimiter(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(100.0)
+
+    def test_token_bucket(self):
+        bucket = ratelimit.TokenBucket(rate=2, burst=2, clock=self.clock.time)
+        self.assertEqual([0, 0, 0.5, 1.0], [bucket.reserve() for _ in range(4)])
+        self.clock.advance(1.5)
+        self.assertEqual(0, bucket.reserve())
+
+        with self.assertRaises(ValueError):
+            ratelimit.TokenBucket(rate=0)
+
+    def test_time_spent(self):
+        bucket = ratelimit.TokenBucket(rate=1, clock=self.clock.time)
+        self.assertEqual(0, bucket.reserve())
+        # the request took 0.7 seconds: only the rest is waited.
+        self.clock.advance(0.7)
+        self.assertAlmostEqual(0.3, bucket.reserve())
+
+    def test_per_host(self):
+        limiter = ratelimit.RateLimiter(rate=1, per_host={'fast.com': (10, 1)}, clock=self.clock.time)
+        self.assertEqual(0, limiter.reserve('slow.com'))
+        self.assertEqual(1, limiter.reserve('slow.com'))
+        self.assertEqual(0, limiter.reserve('fast.com'))
+        self.assertAlmostEqual(0.1, limiter.reserve('fast.com'))
+
+        unlimited = ratelimit.RateLimiter()
+        self.assertEqual([0, 0, 0], [unlimited.reserve('a.com') for _ in range(3)])
+        self.assertIsNone(ratelimit.RateLimiter.from_delay(0).rate)
+
+    def test_stats(self):
+        limiter = ratelimit.RateLimiter(clock=self.clock.time)
+        for _ in range(2):
+            with limiter.limit('http://a.com:8080/path?q=1'):
+                self.clock.advance(0.5)
+        with limiter.limit('b.com'):
+            self.clock.advance(2)
+
+        self.assertEqual({'requests': 2, 'waited': 0, 'in_flight': 1.0}, limiter.stats('a.com:8080'))
+        self.assertEqual({'requests': 3, 'waited': 0, 'in_flight': 3.0}, limiter.stats())
+        limiter.reset_stats()
+        self.assertEqual(0, limiter.stats()['requests'])
+
+    def test_shared_by_connectors(self):
+        temp_dir = mkdtemp()
+        with open(join(temp_dir, 'page.html'), 'w') as f:
+            f.write('page')
+        limiter = ratelimit.RateLimiter(rate=10)
+        try:
+            with LocalHttpServer(temp_dir) as server:
+                threads = [
+                    Thread(target=connectors.BasicConnector(rate_limiter=limiter).get, args=(server.url('page.html'),))
+                    for _ in range(4)
+                ]
+                begin = monotonic()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = monotonic() - begin
+        finally:
+            rmtree(temp_dir)
+
+        stats = limiter.stats()
+        self.assertEqual(4, stats['requests'])
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertGreaterEqual(stats['waited'], 0.6 - 0.01)
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.metrics = instrument.metrics
+
+    def tearDown(self):
+        self.metrics.disable()
+        self.metrics.reset()
+        rmtree(self.temp_dir)
+
+    def test_disabled(self):
+        self.assertIs(instrument.NULL_TIMER, self.metrics.timer('anything'))
+        self.metrics.count('anything')
+        self.metrics.observe('anything', 1.0)
+        self.assertEqual({'counters': [], 'timers': []}, self.metrics.snapshot())
+
+        with self.assertRaises(ValueError):
+            self.metrics.enable(None, 'csv')
+
+    def test_json_lines(self):
+        path = join(self.temp_dir, 'metrics.jsonl')
+        self.metrics.enable(path)
+        self.metrics.count('things_total', 2, kind='a')
+        self.metrics.count('things_total', kind='a')
+        with self.assertRaises(KeyError):
+            with self.metrics.timer('work_seconds', step='x'):
+                raise KeyError('x')
+        self.metrics.disable()
+
+        with open(path) as f:
+            lines = [json_loads(line) for line in f]
+        self.assertEqual(['counter', 'counter', 'timer'], [line['type'] for line in lines])
+        self.assertEqual({'step': 'x', 'error': 'KeyError'}, lines[2]['labels'])
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(3, snapshot['counters'][0]['value'])
+        self.assertEqual(1, snapshot['timers'][0]['count'])
+
+    def test_prometheus(self):
+        path = join(self.temp_dir, 'metrics.prom')
+        self.metrics.enable(path, 'prometheus')
+        self.metrics.count('things_total', kind='say "hi"')
+        self.metrics.observe('work_seconds', 0.5)
+        self.metrics.observe('work_seconds', 1.5)
+        self.metrics.flush()
+
+        with open(path) as f:
+            text = f.read()
+        self.assertIn('# TYPE almond_things_total counter\n', text)
+        self.assertIn('almond_things_total{kind="say \\"hi\\""} 1\n', text)
+        self.assertIn('# TYPE almond_work_seconds summary\n', text)
+        self.assertIn('almond_work_seconds_count 2\n', text)
+        self.assertIn('almond_work_seconds_sum 2.000000\n', text)
+
+    def test_instrumented(self):
+        self.metrics.enable()
+
+        with open(join(self.temp_dir, 'page.html'), 'w') as f:
+            f.write('<html></html>')
+        with LocalHttpServer(self.temp_dir) as server:
+            connectors.BasicConnector().get(server.url('page.html'))
+            # a parser stops reading early: the stream generator is closed by GeneratorExit.
+            chunks = connectors.BasicConnector().iter_text(server.url('page.html'), chunk_size=4)
+            next(chunks)
+            chunks.close()
+
+        recorder = AudioStreamRecorder(work_path=self.temp_dir)
+        recorder.backend = MagicMock()
+        recorder.backend.is_recording = False
+        recorder.backend.wait_for.return_value = backends.WaitReason.DEADLINE
+        recorder.record('rtmp://somewhere', 1, join(self.temp_dir, 'out.mp3'))
+
+        snapshot = self.metrics.snapshot()
+        timers = {item['name']: item for item in snapshot['timers']}
+        self.assertEqual({'host': '127.0.0.1:%d' % server.server.server_port}, timers['http_request_seconds']['labels'])
+        self.assertEqual(2, timers['http_request_seconds']['count'])
+        self.assertEqual(1, timers['record_seconds']['count'])
+        self.assertEqual(
+            [{'name': 'recordings_total', 'labels': {'backend': 'MagicMock', 'reason': 'deadline'}, 'value': 1}],
+            snapshot['counters']
+        )
+
+
 class TestRequestsConnector(TestCase):
 
     cookie_file = 'test.cookie'
@@ -353,6 +1706,533 @@ class TestUrls(TestCase):
             sleep(3)
 
 
+class TestStreamUrlCache(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.lock = Lock()
+
+    def resolver(self, channel):
+        sleep(0.05)
+        with self.lock:
+            self.calls.append(channel)
+            return 'rtmp://%s/%d' % (channel, len(self.calls))
+
+    def test_reuse_and_ttl(self):
+        cache = urls.StreamUrlCache(ttl=0.3, refresh_ahead=1)
+        self.assertEqual(cache.get('mfm', self.resolver), 'rtmp://mfm/1')
+        self.assertEqual(cache.get('mfm', self.resolver), 'rtmp://mfm/1')
+        self.assertEqual(cache.get('sfm', self.resolver), 'rtmp://sfm/2')
+        sleep(0.35)
+        self.assertEqual(cache.get('mfm', self.resolver), 'rtmp://mfm/3')
+
+    def test_invalidate(self):
+        cache = urls.StreamUrlCache(ttl=60)
+        cache.get('mfm', self.resolver)
+        cache.invalidate('mfm')
+        self.assertEqual(cache.get('mfm', self.resolver), 'rtmp://mfm/2')
+
+    def test_disabled(self):
+        cache = urls.StreamUrlCache(ttl=0)
+        cache.get('mfm', self.resolver)
+        cache.get('mfm', self.resolver)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_concurrent_lookups(self):
+        cache = urls.StreamUrlCache(ttl=60)
+        results = []
+        threads = [Thread(target=lambda: results.append(cache.get('chm', self.resolver))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.calls, ['chm'])
+        self.assertEqual(results, ['rtmp://chm/1'] * 5)
+
+    def test_background_refresh(self):
+        cache = urls.StreamUrlCache(ttl=5, refresh_ahead=0.01)
+        cache.get('mfm', self.resolver)
+        sleep(0.1)
+        # served from the cache, while refreshing
+        self.assertEqual(cache.get('mfm', self.resolver), 'rtmp://mfm/1')
+        begin = monotonic()
+        while len(self.calls) < 2 and monotonic() - begin < 5:
+            sleep(0.01)
+        self.assertEqual(cache.get('mfm', self.resolver), 'rtmp://mfm/2')
+
+    def test_invalidate_while_refreshing(self):
+        cache = urls.StreamUrlCache(ttl=5, refresh_ahead=0.01)
+        cache.get('mfm', self.resolver)
+        sleep(0.1)
+        cache.get('mfm', self.resolver)
+        # the stream has ended while the refresh is resolving.
+        cache.invalidate('mfm')
+        begin = monotonic()
+        while len(self.calls) < 2 and monotonic() - begin < 5:
+            sleep(0.01)
+        sleep(0.05)
+        self.assertEqual(cache.get('mfm', self.resolver), 'rtmp://mfm/3')
+
+    @patch('recorder.urls.MbcRadioUrl._request')
+    def test_mbc_radio_url(self, mocked_request):
+        mocked_request.side_effect = lambda channel: 'rtmp://' + channel
+        url = urls.MbcRadioUrl(cache=urls.StreamUrlCache())
+        self.assertEqual(url.mfm(), 'rtmp://mfm')
+        self.assertEqual(urls.MbcRadioUrl(cache=url.cache).mfm(), 'rtmp://mfm')
+        self.assertEqual(mocked_request.call_count, 1)
+        url.refresh('mfm')
+        self.assertEqual(mocked_request.call_count, 2)
+        with self.assertRaises(exceptions.InvalidChannelException):
+            url.resolve('xfm')
+
+
+def write_program_table(path, version=1, rows=None):
+    """
+    A small local program table, in the same format as the remote one.
+    """
+    rows = rows or [
+        (1, 'mon-fri', 'mfm', '07:00', 'Morning Show', 'morning', 'morningplay'),
+        (2, 'mon-fri', 'mfm', '09:00', 'Late Morning', 'late', 'lateplay'),
+        (3, 'mon-fri', 'sfm', '08:00', 'Standard Morning', 'standard', ''),
+    ]
+    with open(path, 'w') as f:
+        f.write('version: %d\n' % version)
+        for row in rows:
+            f.write(','.join(str(x) for x in row) + '\n')
+
+
+class TestProgramTableIndex(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.table_path = join(self.temp_dir, 'imbc_table.csv')
+        write_program_table(self.table_path, rows=[
+            (1, 'mon-fri', 'mfm', '07:00', 'Morning Show', 'morning', 'morningplay'),
+            (2, 'mon-fri', 'mfm', '09:00', 'Late Morning', 'late', 'lateplay'),
+            (3, 'mon-fri', 'sfm', '08:00', 'Standard Morning', 'standard', ''),
+            (4, 'mon-fri', 'mfm', '22:00', 'Night Show', 'night', ''),
+            (5, 'sat-sun', 'mfm', '09:00', 'Weekend Morning', 'weekend', ''),
+            (6, 'mon-fri', 'mfm', '', 'Unknown Hour', '', ''),
+        ])
+        self.table = playlist.MBCRadioProgramTable(table_path=self.table_path)
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_get(self):
+        self.assertEqual('Late Morning', self.table.get(2).show_title)
+        self.assertEqual('Unknown Hour', self.table.get(6).show_title)
+        self.assertIsNone(self.table.get(100))
+
+    def test_channel_programs(self):
+        self.assertEqual([1, 2, 5, 4], [x.id for x in self.table.channel_programs('mfm')])
+        self.assertEqual([], self.table.channel_programs('chm'))
+
+    def test_on_air(self):
+        self.assertEqual(1, self.table.on_air('mfm', '07:00').id)
+        self.assertEqual(1, self.table.on_air('mfm', datetime(2016, 12, 1, 8, 59)).id)
+        self.assertEqual(2, self.table.on_air('mfm', '09:30').id)
+        self.assertEqual(4, self.table.on_air('mfm', '23:59').id)
+        self.assertEqual(4, self.table.on_air('mfm', '03:00').id)  # from the previous night
+        self.assertEqual(3, self.table.on_air('sfm', '03:00').id)
+        self.assertIsNone(self.table.on_air('chm', '03:00'))
+        self.assertIsNotNone(self.table.on_air('mfm'))
+
+    def test_on_air_weekend(self):
+        # 2016-12-03 is a Saturday.
+        self.assertEqual(5, self.table.on_air('mfm', datetime(2016, 12, 3, 9, 30)).id)
+        self.assertEqual(5, self.table.on_air('mfm', datetime(2016, 12, 3, 23, 0).timestamp()).id)
+        self.assertEqual(4, self.table.on_air('mfm', datetime(2016, 12, 3, 8, 0)).id)  # from Friday night
+        self.assertEqual(5, self.table.on_air('mfm', datetime(2016, 12, 5, 3, 0)).id)  # from Sunday
+        self.assertEqual(2, self.table.on_air('mfm', datetime(2016, 12, 5, 9, 30)).id)
+        self.assertIsNone(self.table.on_air('sfm', datetime(2016, 12, 4, 9, 0)))
+
+    def test_parse_days(self):
+        parse_days = playlist.MBCRadioProgramTable.parse_days
+        self.assertEqual(0b0011111, parse_days('mon-fri'))
+        self.assertEqual(0b1100000, parse_days('Sat-Sun'))
+        self.assertEqual(0b1100101, parse_days('sat-mon, wed'))
+        self.assertEqual(0b1111111, parse_days(''))
+        self.assertEqual(0b1111111, parse_days('daily'))
+
+        with self.assertRaises(ValueError):
+            self.table.on_air('mfm', '7 o\'clock')
+
+    def test_reload(self):
+        write_program_table(self.table_path, version=2, rows=[
+            (7, 'mon-fri', 'mfm', '06:00', 'Dawn', '', ''),
+        ])
+        self.table.load()
+        self.assertIsNone(self.table.get(1))
+        self.assertEqual(7, self.table.on_air('mfm', '09:00').id)
+
+
+class TestProgramTableSnapshot(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.table_path = join(self.temp_dir, 'imbc_table.csv')
+        write_program_table(self.table_path)
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_slots(self):
+        item = playlist.MBCRadioProgramItem(id=1, channel='mfm', playlist_slug='morningplay')
+        self.assertFalse(hasattr(item, '__dict__'))
+        self.assertEqual('', item.show_title)
+        self.assertTrue(item.playlist_list_url.endswith('PROG_CD=morningplay'))
+
+    def test_snapshot(self):
+        table = playlist.MBCRadioProgramTable(table_path=self.table_path)
+        self.assertTrue(exists(table.snapshot_path))
+
+        with patch('recorder.playlist.csv_reader') as mocked_reader, \
+                patch.object(playlist.MBCRadioProgramTable, 'build_index') as mocked_build_index:
+            snapshot_table = playlist.MBCRadioProgramTable(table_path=self.table_path)
+            mocked_reader.assert_not_called()
+            mocked_build_index.assert_not_called()
+
+        self.assertEqual(table.version, snapshot_table.version)
+        self.assertEqual(
+            [(x.id, x.channel, x.start_time, x.show_title, x.playlist_slug) for x in table.programs],
+            [(x.id, x.channel, x.start_time, x.show_title, x.playlist_slug) for x in snapshot_table.programs],
+        )
+        self.assertEqual('Late Morning', snapshot_table.get(2).show_title)
+        self.assertEqual([1, 2], [x.id for x in snapshot_table.channel_programs('mfm')])
+        self.assertEqual(2, snapshot_table.on_air('mfm', datetime(2016, 12, 1, 9, 30)).id)
+
+    def test_stale_snapshot(self):
+        playlist.MBCRadioProgramTable(table_path=self.table_path)
+        write_program_table(self.table_path, version=2, rows=[
+            (7, 'mon-fri', 'mfm', '06:00', 'Dawn', '', ''),
+        ])
+        table = playlist.MBCRadioProgramTable(table_path=self.table_path)
+        self.assertEqual(2, table.version)
+        self.assertEqual([7], [x.id for x in table.programs])
+
+    def test_broken_snapshot(self):
+        table = playlist.MBCRadioProgramTable(table_path=self.table_path)
+        with open(table.snapshot_path, 'wb') as f:
+            f.write(b'broken')
+        table = playlist.MBCRadioProgramTable(table_path=self.table_path)
+        self.assertEqual(3, len(table.programs))
+
+    def test_without_snapshot(self):
+        table = playlist.MBCRadioProgramTable(table_path=self.table_path, use_snapshot=False)
+        self.assertEqual(3, len(table.programs))
+        self.assertFalse(exists(table.snapshot_path))
+
+
+class ETagHandler(QuietHTTPRequestHandler):
+    """
+    Serves files with an ETag, and answers 304 to a matching If-None-Match. Keeps request headers.
+    """
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers.items()))
+        with open(self.translate_path(self.path), 'rb') as f:
+            content = f.read()
+        etag = '"%s"' % md5(content).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class TestProgramTableUpdate(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.remote_dir = join(self.temp_dir, 'remote')
+        mkdir(self.remote_dir)
+        self.remote_path = join(self.remote_dir, 'imbc_table')
+        self.table_path = join(self.temp_dir, 'imbc_table.csv')
+        write_program_table(self.remote_path, version=1)
+        ETagHandler.requests = []
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_update(self):
+        with LocalHttpServer(self.remote_dir, ETagHandler) as server, \
+                patch.object(playlist.MBCRadioProgramTable, 'url', server.url('imbc_table')):
+            table = playlist.MBCRadioProgramTable(table_path=self.table_path)
+            self.assertEqual(1, table.version)
+            self.assertTrue(exists(table.validators_path))
+
+            # unchanged: 304
+            self.assertFalse(table.update())
+            self.assertEqual(2, len(ETagHandler.requests))
+            self.assertIn('If-None-Match', ETagHandler.requests[-1])
+
+            # changed, but not newer
+            write_program_table(self.remote_path, version=1, rows=[(9, 'mon-fri', 'mfm', '05:00', 'Dawn', '', '')])
+            self.assertFalse(table.update())
+            self.assertEqual(3, len(table.programs))
+
+            # newer: fetched once, and loaded
+            write_program_table(self.remote_path, version=2, rows=[(9, 'mon-fri', 'mfm', '05:00', 'Dawn', '', '')])
+            self.assertTrue(table.update())
+            self.assertEqual(4, len(ETagHandler.requests))
+            self.assertEqual(2, table.version)
+            self.assertEqual('Dawn', table.get(9).show_title)
+            self.assertFalse(table.update())
+
+        self.assertEqual(['imbc_table.csv', 'imbc_table.csv.snapshot', 'imbc_table.csv.validators', 'remote'],
+                         sorted(listdir(self.temp_dir)))
+
+    def test_get_remote_version(self):
+        write_program_table(self.table_path, version=1)
+        write_program_table(self.remote_path, version=5)
+        with LocalHttpServer(self.remote_dir, ETagHandler) as server:
+            table = playlist.MBCRadioProgramTable(table_path=self.table_path)
+            table.url = server.url('imbc_table')
+            self.assertEqual(5, table.get_remote_version())
+
+
+class TestAsyncPlaylistCrawler(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        resource_dir = join(dirname(__file__), 'resources')
+        shutil_copy(join(resource_dir, 'playlist_list.html'), join(self.temp_dir, 'SelectList.asp'))
+        shutil_copy(join(resource_dir, 'playlist_view.html'), join(self.temp_dir, 'SelectView.asp'))
+        self.table_path = join(self.temp_dir, 'imbc_table.csv')
+        write_program_table(self.table_path)
+        KeepAliveHandler.client_ports = []
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_get_playlist(self):
+        with LocalHttpServer(self.temp_dir, KeepAliveHandler) as server, \
+                patch.object(playlist.MBCRadioProgramItem, 'url_prefix', server.url()):
+            crawler = playlist.MBCRadioPlaylistCrawler(table_path=self.table_path)
+            expected = crawler.get_playlist(1, '2016-12-01')
+            self.assertEqual(5, len(expected))
+            self.assertEqual({'seq': 1, 'title': '첫 번째 노래', 'artist': '첫 번째 가수'}, expected[1])
+
+            async_crawler = playlist.AsyncMBCRadioPlaylistCrawler(table_path=self.table_path, delay=0)
+            self.assertEqual(expected, asyncio.run(async_crawler.get_playlist(1, '2016-12-01')))
+            self.assertEqual([], asyncio.run(async_crawler.get_playlist(100, '2016-12-01')))
+            self.assertIsNone(asyncio.run(async_crawler.get_playlist(1, '2016/12/01')))
+
+    def test_cache(self):
+        threads = []
+
+        def on_thread(method):
+            def wrapper(*args):
+                threads.append(current_thread())
+                return method(*args)
+            return wrapper
+
+        cache_path = join(self.temp_dir, 'playlists.sqlite')
+        with LocalHttpServer(self.temp_dir, KeepAliveHandler) as server, \
+                patch.object(playlist.MBCRadioProgramItem, 'url_prefix', server.url()), \
+                patch.object(cache.PlaylistCache, 'get', on_thread(cache.PlaylistCache.get)), \
+                patch.object(cache.PlaylistCache, 'put', on_thread(cache.PlaylistCache.put)):
+            crawler = playlist.AsyncMBCRadioPlaylistCrawler(table_path=self.table_path, cache_path=cache_path, delay=0)
+            crawled = asyncio.run(crawler.get_playlist(1, '2016-12-01'))
+            self.assertEqual(5, len(crawled))
+            self.assertEqual(crawled, asyncio.run(crawler.get_playlist(1, '2016-12-01')))
+            crawler.cache.close()
+
+        # the second one is cached, and the cache is not used on the event loop.
+        self.assertEqual(2, len(KeepAliveHandler.client_ports))
+        self.assertEqual(3, len(threads))
+        self.assertNotIn(main_thread(), threads)
+
+    def test_get_playlists(self):
+        items = [(1, '2016-12-0%d' % x) for x in range(1, 4)] + [(1, '2016-12-01')]
+        with LocalHttpServer(self.temp_dir, KeepAliveHandler) as server, \
+                patch.object(playlist.MBCRadioProgramItem, 'url_prefix', server.url()):
+            crawler = playlist.AsyncMBCRadioPlaylistCrawler(table_path=self.table_path, delay=0.1, concurrency=3)
+            begin = monotonic()
+            playlists = asyncio.run(crawler.get_playlists(items))
+            elapsed = monotonic() - begin
+
+        self.assertEqual(3, len(playlists))
+        self.assertTrue(all(len(x) == 5 for x in playlists.values()))
+        # two requests for each, 0.1 seconds apart.
+        self.assertEqual(6, len(KeepAliveHandler.client_ports))
+        self.assertGreaterEqual(elapsed, 0.5)
+
+    def test_host_delay(self):
+        rate_limiter = ratelimit.RateLimiter.from_delay(0.1)
+
+        async def wait_all(hosts):
+            begin = monotonic()
+            await asyncio.gather(*[rate_limiter.acquire_async(x) for x in hosts])
+            return monotonic() - begin
+
+        self.assertLess(asyncio.run(wait_all(['a', 'b', 'c'])), 0.1)
+        self.assertGreaterEqual(asyncio.run(wait_all(['d', 'd', 'd'])), 0.2)
+
+    def test_queued_timeout(self):
+        with open(join(self.temp_dir, 'page.html'), 'w') as f:
+            f.write('ok')
+        connector = connectors.AsyncConnector(delay=0.2, timeout=0.5)
+
+        async def get_all(url):
+            return await asyncio.gather(*[connector.get(url) for _ in range(6)], return_exceptions=True)
+
+        # the last one waits 1 second for its turn: longer than the timeout, which counts the exchange only.
+        with LocalHttpServer(self.temp_dir) as server:
+            self.assertEqual(['ok'] * 6, asyncio.run(get_all(server.url('page.html'))))
+
+    def test_cookie(self):
+        cookie_path = join(self.temp_dir, 'test.cookie')
+        connector = connectors.AsyncConnector(cookie_file=cookie_path, delay=0)
+        connector.set_cookie('test', 'val', domain='127.0.0.1', path='/', expires=time() + 3600, discard=False)
+        self.assertEqual('val', connector.get_cookie('test'))
+        self.assertIsNone(connector.get_cookie('none'))
+        connector.save_cookie()
+
+        self.assertEqual('val', connectors.AsyncConnector(cookie_file=cookie_path).get_cookie('test'))
+
+
+class TestPlaylistParsers(TestCase):
+
+    def setUp(self):
+        resource_dir = join(dirname(__file__), 'resources')
+        with open(join(resource_dir, 'playlist_list.html'), 'r', encoding='euc-kr') as f:
+            self.list_page = f.read()
+        with open(join(resource_dir, 'playlist_view.html'), 'r', encoding='euc-kr') as f:
+            self.view_page = f.read()
+
+    @staticmethod
+    def parse(parser_class, content, chunk_size=None):
+        parser = parser_class()
+        if chunk_size:
+            parser.feed_chunks(content[i:i + chunk_size] for i in range(0, len(content), chunk_size))
+        else:
+            parser.feed(content)
+        return parser
+
+    def test_same_as_soup(self):
+        pages = [
+            self.view_page,
+            self.view_page.replace('<td colspan="5">1부</td>', '<th colspan="5"><b>1</b>부</th>'),
+            self.view_page.replace('<tbody>', '').replace('</tbody>', ''),
+            '<html><body>no table</body></html>',
+        ]
+        for page in pages:
+            expected = self.parse(playlist.MBCRadioPlaylistViewSoupParser, page).playlist
+            self.assertEqual(expected, self.parse(playlist.MBCRadioPlaylistViewParser, page).playlist)
+            self.assertEqual(expected, self.parse(playlist.MBCRadioPlaylistViewParser, page, 1).playlist)
+
+        pages = [
+            self.list_page,
+            self.list_page.replace(' href="SelectView.asp?PROG_CD=morningplay&amp;SEQ_NO=12345"', ''),
+            '<table class="other"><tbody><a href="x">x</a></tbody></table>' + self.list_page,
+            '<html><body>no table</body></html>',
+        ]
+        for page in pages:
+            expected = self.parse(playlist.MBCRadioPlaylistListSoupParser, page).rel_href
+            self.assertEqual(expected, self.parse(playlist.MBCRadioPlaylistListParser, page).rel_href)
+            self.assertEqual(expected, self.parse(playlist.MBCRadioPlaylistListParser, page, 7).rel_href)
+
+    def test_stop_after_table(self):
+        consumed = []
+
+        def chunks():
+            for i in range(0, len(self.view_page), 100):
+                consumed.append(i)
+                yield self.view_page[i:i + 100]
+            for _ in range(100):
+                consumed.append(None)
+                yield '<table class="list_tb"><tbody><tr><td colspan="5">more</td></tr></tbody></table>'
+
+        parser = playlist.MBCRadioPlaylistViewParser().feed_chunks(chunks())
+        self.assertTrue(parser.done)
+        self.assertEqual(5, len(parser.playlist))
+        self.assertNotIn(None, consumed)
+
+    def test_iter_text(self):
+        temp_dir = mkdtemp()
+        try:
+            shutil_copy(join(dirname(__file__), 'resources', 'playlist_view.html'), join(temp_dir, 'view.asp'))
+            connector = connectors.BasicConnector(fallback_charset=['utf-8', 'euc-kr'])
+            with LocalHttpServer(temp_dir) as server:
+                # a multibyte character is split by chunks.
+                chunks = list(connector.iter_text(server.url('view.asp'), chunk_size=101))
+        finally:
+            rmtree(temp_dir)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(self.view_page, ''.join(chunks))
+
+
+class TestPlaylistCache(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.cache = cache.PlaylistCache(join(self.temp_dir, 'cache.sqlite'), revalidate=60)
+        self.playlist = [{'seq': 1, 'title': '제목', 'artist': '가수'}]
+
+    def tearDown(self):
+        self.cache.close()
+        rmtree(self.temp_dir)
+
+    def test_final(self):
+        self.cache.put(1, '2016-12-01', self.playlist)
+        with patch('recorder.cache.time', return_value=time() + 3600 * 24 * 365):
+            self.assertEqual(self.cache.get(1, '2016-12-01'), self.playlist)
+        self.assertIsNone(self.cache.get(1, '2016-12-02'))
+        self.assertIsNone(self.cache.get(2, '2016-12-01'))
+
+    def test_revalidate(self):
+        today = datetime.today().strftime('%Y-%m-%d')
+        self.cache.put(1, today, self.playlist)
+        self.cache.put(1, '2016-12-01', [])  # empty: may be filled later
+        self.assertEqual(self.cache.get(1, today), self.playlist)
+        self.assertEqual(self.cache.get(1, '2016-12-01'), [])
+        with patch('recorder.cache.time', return_value=time() + 61):
+            self.assertIsNone(self.cache.get(1, today))
+            self.assertIsNone(self.cache.get(1, '2016-12-01'))
+
+    def test_evict(self):
+        self.cache.max_entries = 3
+        for day in range(1, 6):
+            self.cache.put(1, '2016-12-%02d' % day, self.playlist)
+        self.assertEqual(len(self.cache), 3)
+        self.assertIsNone(self.cache.get(1, '2016-12-01'))
+        self.assertEqual(self.cache.get(1, '2016-12-05'), self.playlist)
+
+        self.cache.max_age = 60
+        with patch('recorder.cache.time', return_value=time() + 61):
+            self.cache.put(2, '2016-12-01', self.playlist)
+        self.assertEqual(len(self.cache), 1)
+
+    @patch('recorder.playlist.MBCRadioPlaylistCrawler.extract_playlist')
+    @patch('recorder.playlist.MBCRadioPlaylistCrawler.get_view_url')
+    def test_crawler(self, mocked_get_view_url, mocked_extract_playlist):
+        table_path = join(self.temp_dir, 'table.csv')
+        write_program_table(table_path)
+        mocked_get_view_url.return_value = 'http://localhost/view'
+        mocked_extract_playlist.return_value = self.playlist
+
+        cache_path = join(self.temp_dir, 'crawler.sqlite')
+        crawler = playlist.MBCRadioPlaylistCrawler(table_path=table_path, cache_path=cache_path)
+        self.assertEqual(crawler.get_playlist(1, '2016-12-01'), self.playlist)
+        crawler.cache.close()
+
+        # another process: no requests
+        crawler = playlist.MBCRadioPlaylistCrawler(table_path=table_path, cache_path=cache_path)
+        self.assertEqual(crawler.get_playlist(1, '2016-12-01'), self.playlist)
+        self.assertEqual(mocked_get_view_url.call_count, 1)
+        self.assertEqual(mocked_extract_playlist.call_count, 1)
+        crawler.cache.close()
+
+
 def get_yesterday():
     return (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
 
@@ -411,6 +2291,73 @@ class TestPlaylist(TestCase):
                 self.assertTrue('artist' in first_item)
 
 
+class TestMBCPlaylistBatch(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        sample = join(dirname(__file__), 'resources', 'sample.mp3')
+        self.files = [join(self.temp_dir, 'show_2016-12-0%d.mp3' % x) for x in (1, 2)]
+        self.files.append(join(self.temp_dir, 'show_20161202_rerun.mp3'))
+        for path in self.files:
+            shutil_copy(sample, path)
+        with open(join(self.temp_dir, 'notes.txt'), 'w') as f:
+            f.write('not a recording')
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_from_directory(self):
+        items = mbc_playlist.MBCPlaylistBatch.from_directory(self.temp_dir, 7)
+        self.assertEqual(items, [
+            (self.files[0], 7, '2016-12-01'),
+            (self.files[1], 7, '2016-12-02'),
+            (self.files[2], 7, '2016-12-02'),
+        ])
+
+    def test_from_manifest(self):
+        manifest = join(self.temp_dir, 'manifest.csv')
+        with open(manifest, 'w') as f:
+            f.write('show_2016-12-01.mp3,7,2016-12-01\n%s,8,2016-12-02\n' % self.files[1])
+        items = mbc_playlist.MBCPlaylistBatch.from_manifest(manifest)
+        self.assertEqual(items, [(self.files[0], 7, '2016-12-01'), (self.files[1], 8, '2016-12-02')])
+
+    def test_run(self):
+        fake = MagicMock()
+        fake.get_metadata.side_effect = lambda program_id, date: {'comment': '%d %s' % (program_id, date)}
+        batch = mbc_playlist.MBCPlaylistBatch(fake, workers=2, processes=2, rate=0)
+        with open(devnull, 'w') as out:
+            summary = batch.run(mbc_playlist.MBCPlaylistBatch.from_directory(self.temp_dir, 7), out=out)
+
+        # one fetch per (program, date) pair
+        self.assertEqual(fake.get_metadata.call_count, 2)
+        self.assertEqual(summary['files'], 3)
+        self.assertEqual(summary['playlists'], 2)
+        self.assertEqual(summary['errors'], 0)
+        self.assertEqual(summary['bytes'], sum(stat(x).st_size for x in self.files))
+        self.assertEqual(tags.read_tags(self.files[0])['comment'], '7 2016-12-01')
+        self.assertEqual(tags.read_tags(self.files[2])['comment'], '7 2016-12-02')
+
+    def test_archive(self):
+        index = archive.ArchiveIndex(self.temp_dir)
+        index.reconcile()
+        items = mbc_playlist.MBCPlaylistBatch.from_archive(index, self.temp_dir, 7)
+        self.assertEqual(mbc_playlist.MBCPlaylistBatch.from_directory(self.temp_dir, 7), items)
+
+        fake = MagicMock()
+        fake.get_metadata.return_value = {'comment': 'playlist'}
+        batch = mbc_playlist.MBCPlaylistBatch(fake, workers=2, processes=2, rate=0, archive=index)
+        with open(devnull, 'w') as out:
+            batch.run(items, out=out)
+
+        row = index.get(self.files[0])
+        self.assertEqual((7, '2016-12-01', 1), (row['program_id'], row['air_date'], row['tagged']))
+        self.assertEqual(stat(self.files[0]).st_size, row['size'])
+        self.assertEqual([], mbc_playlist.MBCPlaylistBatch.from_archive(index, self.temp_dir, 7, untagged_only=True))
+        # indexed as another program's
+        self.assertEqual([], mbc_playlist.MBCPlaylistBatch.from_archive(index, self.temp_dir, 8))
+        index.close()
+
+
 class TestMBCPlaylistScript(TestCase):
 
     def setUp(self):
@@ -440,10 +2387,19 @@ class TestMBCPlaylistScript(TestCase):
             program_id=random_program.id,
             table_path=self.table_path,
             ffmpeg_path=None,
+            cache_path=None,
+            no_cache=True,
             list_programs=False,
             update_table=False,
             version=False,
             print_only=False,
+            batch=None,
+            workers=4,
+            processes=None,
+            rate=1.0,
+            archive=None,
+            metrics=None,
+            metrics_format='jsonl',
             replace=False
         )
 
@@ -494,10 +2450,19 @@ class TestMBCPlaylistScript(TestCase):
             program_id=random_program.id,
             table_path=self.table_path,
             ffmpeg_path=None,
+            cache_path=None,
+            no_cache=True,
             list_programs=False,
             update_table=False,
             version=False,
             print_only=False,
+            batch=None,
+            workers=4,
+            processes=None,
+            rate=1.0,
+            archive=None,
+            metrics=None,
+            metrics_format='jsonl',
             replace=True  # replace
         )
 
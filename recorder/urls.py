@@ -6,7 +6,124 @@ from re import (
     DOTALL
 )
 
-from recorder.connectors import BasicConnector
+from threading import (
+    Lock,
+    Thread,
+)
+
+from time import monotonic
+
+from recorder.connectors import PooledConnector
+from recorder.exceptions import InvalidChannelException
+from recorder.instrument import metrics
+
+
+class StreamUrlCache(object):
+    """
+    Resolved stream urls by channel, reused for ttl seconds.
+
+    Concurrent lookups of the same channel share one resolution. Once an entry gets older than
+     ttl * refresh_ahead, it is still served while a background thread resolves a new one.
+    invalidate() bumps the generation of the channel: a background refresh begun before it drops its url.
+    """
+
+    def __init__(self, ttl=60, refresh_ahead=0.75):
+        """
+        :param ttl:           seconds. 0 disables caching.
+        :param refresh_ahead: fraction of ttl. Background refresh starts after this.
+        """
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self._entries = {}
+        self._lock = Lock()
+        self._channel_locks = {}
+        self._refreshing = set()
+        # generations by channel, and of all channels, for invalidate(None).
+        self._generations = {}
+        self._epoch = 0
+
+    def get(self, channel, resolver):
+        """
+        :param channel:  cache key.
+        :param resolver: callable(channel) returns a url. Called on a cache miss.
+        """
+        if not self.ttl:
+            return resolver(channel)
+
+        url = self._lookup(channel, resolver)
+        if url:
+            return url
+
+        with self._channel_lock(channel):
+            # another thread may have resolved it while we were waiting.
+            url = self._lookup(channel, resolver)
+            if not url:
+                url = self._resolve(channel, resolver)
+        return url
+
+    def invalidate(self, channel=None):
+        """
+        Forget the url of the channel, e.g. when the capture has failed. None forgets all.
+        """
+        with self._lock:
+            if channel is None:
+                self._entries.clear()
+                self._epoch += 1
+            else:
+                self._entries.pop(channel, None)
+                self._generations[channel] = self._generations.get(channel, 0) + 1
+
+    def _generation(self, channel):
+        # call with self._lock held.
+        return self._epoch, self._generations.get(channel, 0)
+
+    def _lookup(self, channel, resolver):
+        with self._lock:
+            entry = self._entries.get(channel)
+        if not entry:
+            return None
+
+        url, resolved_at = entry
+        age = monotonic() - resolved_at
+        if age >= self.ttl:
+            return None
+        if age >= self.ttl * self.refresh_ahead:
+            self._refresh_in_background(channel, resolver)
+        return url
+
+    def _resolve(self, channel, resolver, generation=None):
+        """
+        :param generation: stored only if the channel has not been invalidated since this generation.
+        """
+        url = resolver(channel)
+        with self._lock:
+            if generation is None or generation == self._generation(channel):
+                self._entries[channel] = (url, monotonic())
+        return url
+
+    def _refresh_in_background(self, channel, resolver):
+        with self._lock:
+            if channel in self._refreshing:
+                return
+            self._refreshing.add(channel)
+            generation = self._generation(channel)
+
+        def refresh():
+            try:
+                with self._channel_lock(channel):
+                    self._resolve(channel, resolver, generation)
+            except (OSError, KeyError, ValueError):
+                # keep serving the current one until it expires
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing.discard(channel)
+
+        Thread(target=refresh, daemon=True).start()
+
+    def _channel_lock(self, channel):
+        with self._lock:
+            return self._channel_locks.setdefault(channel, Lock())
 
 
 class MbcRadioUrl(object):
@@ -17,21 +134,49 @@ class MbcRadioUrl(object):
 
     channels = ('mfm', 'sfm', 'chm')
 
-    def __init__(self):
-        self.connector = BasicConnector()
+    # shared by all instances, so that simultaneous recordings of a channel resolve its url only once.
+    shared_cache = StreamUrlCache()
+
+    def __init__(self, cache=None):
+        """
+        :param cache: StreamUrlCache. Defaults to shared_cache.
+        """
+        self.connector = PooledConnector()
+        self.cache = cache if cache is not None else self.shared_cache
 
     def sfm(self):
-        return self._request('sfm')
+        return self.resolve('sfm')
 
     def mfm(self):
-        return self._request('mfm')
+        return self.resolve('mfm')
 
     def chm(self):
-        return self._request('chm')
+        return self.resolve('chm')
+
+    def resolve(self, channel):
+        """
+        Stream url of the channel, from the cache if fresh enough.
+        """
+        if channel not in self.channels:
+            raise InvalidChannelException(
+                'Invalid channel: \'%s\'. Supported channels are %s' % (channel, ', '.join(self.channels))
+            )
+        return self.cache.get(channel, self._request)
+
+    def refresh(self, channel):
+        """
+        Stream url of the channel, newly acquired.
+        """
+        self.invalidate(channel)
+        return self.resolve(channel)
+
+    def invalidate(self, channel=None):
+        self.cache.invalidate(channel)
 
     def _request(self, channel):
-        content = self.connector.get(url=self.url_base.format(channel))
-        return self.trim_response(content)
+        with metrics.timer('url_resolve_seconds', channel=channel):
+            content = self.connector.get(url=self.url_base.format(channel))
+            return self.trim_response(content)
 
     def trim_response(self, content):
         mat = self.expr.match(content)
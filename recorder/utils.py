@@ -1,23 +1,38 @@
 from datetime import datetime, timedelta
 from re import compile as re_compile
 
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+
+from functools import partial
+
 from os import (
     getcwd,
-    listdir,
-    stat,
+    lstat,
+    scandir,
     unlink,
-    walk,
 )
 
 from os.path import (
     abspath,
     expanduser,
     expandvars,
-    join as path_join,
-    isfile,
     splitext,
 )
 
+from itertools import islice
+
+from heapq import (
+    heappush,
+    heappushpop,
+    nlargest,
+    nsmallest,
+)
+
 from operator import itemgetter
 
 from socket import (
@@ -25,12 +40,17 @@ from socket import (
     gethostbyname,
 )
 
+from time import monotonic
+
 
 class DirectoryCleaner(object):
 
     # NOTE: keep this order when using filter() method
     supported_orders = ('name', 'mtime', )
 
+    # files removed by a thread at a time in clean()
+    clean_batch_size = 64
+
     def __init__(self):
         self._target_dir = ''
         self._target_ext = ''
@@ -43,6 +63,7 @@ class DirectoryCleaner(object):
         self._recursive = False
         self._pattern = r''
         self._pattern_flags = 0
+        self._archive = None
 
         self.target = []
 
@@ -61,6 +82,7 @@ class DirectoryCleaner(object):
         self._recursive = False
         self._pattern = r''
         self._pattern_flags = 0
+        self._archive = None
 
         self.target = []
 
@@ -132,6 +154,14 @@ class DirectoryCleaner(object):
         self._limit = number
         return self
 
+    def index(self, archive):
+        """
+        list files of an ArchiveIndex, brought up to date by its reconcile(), instead of crawling the directory.
+        removed files are removed from the index too. None to crawl again.
+        """
+        self._archive = archive
+        return self
+
     def recursive(self, value: bool):
         """
         grab files in a recursive manner
@@ -186,14 +216,98 @@ class DirectoryCleaner(object):
             return [x[0] for x in self.target]
         return self.target
 
-    def clean(self):
+    def clean(self, dry_run=False, workers=1, reuse_target=False):
+        """
+        remove filtered files, as they are found. it used to return None: it returns a summary now.
+
+        :param dry_run:      remove nothing. only sum up what would be removed.
+        :param workers:      1, the default, removes files in this thread, one by one.
+                             more removes them in this many threads, worth it for many files on a network filesystem,
+                             where each unlink is a round trip. at most twice as many batches are queued.
+        :param reuse_target: remove the files listed by the last files() or filter() call, without crawling again.
+                             removed files are dropped from the list.
+        :return: dict of
+                 - removed: number of files removed, or to be removed on dry run.
+                 - bytes:   bytes freed, or to be freed on dry run.
+                 - errors:  list of (path, OSError). files which could not be removed.
+                 - elapsed: seconds.
+                 - dry_run: as given.
+        """
+        begin = monotonic()
+        summary = {'removed': 0, 'bytes': 0, 'errors': [], 'elapsed': 0.0, 'dry_run': dry_run}
+        removed = []
+
+        paths = (x[0] for x in (self.target if reuse_target else self.iter_files()))
+        # files go to a thread in batches: a future for each file costs more than a local unlink.
+        batches = _batched(paths, self.clean_batch_size)
+        remove = partial(_remove_files, dry_run=dry_run)
+
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = set()
+                for batch in batches:
+                    pending.add(executor.submit(remove, batch))
+                    if len(pending) >= workers * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            self._summarize(summary, future.result(), removed)
+                for future in as_completed(pending):
+                    self._summarize(summary, future.result(), removed)
+        else:
+            for batch in batches:
+                self._summarize(summary, remove(batch), removed)
+
+        if self._archive is not None and not dry_run:
+            self._archive.remove(removed)
+
+        if reuse_target and not dry_run:
+            failed = {path for path, _ in summary['errors']}
+            self.target = [x for x in self.target if x[0] in failed]
+
+        summary['elapsed'] = monotonic() - begin
+
+        return summary
+
+    @staticmethod
+    def _summarize(summary, results, removed):
+        for path, size, error in results:
+            if error:
+                summary['errors'].append((path, error))
+            else:
+                removed.append(path)
+                summary['removed'] += 1
+                summary['bytes'] += size
+
+    def filter(self):
+        filtered = self._iter_filtered()
+
+        if self._limit:
+            self.target = self._select_limited(filtered)
+        else:
+            # the rest of reserve() is listed in order too, so a full sort cannot be avoided here.
+            self.target = sorted(filtered, key=self._sort_key(), reverse=(self._order == 'desc'))
+            if self._reserve:
+                self.target = self.target[self._reserve:]
+
+    def iter_files(self):
         """
-        remove filtered files
+        generate filtered files while crawling, without building the whole list.
+        files are not in order, except with limit().
+
+        reserve() and limit() select with a heap of their number of files, not by sorting all files.
+        with reserve(), a file is generated as soon as enough files to keep are found ahead of it.
         """
-        for x in self.files():
-            unlink(x)
+        filtered = self._iter_filtered()
 
-    def filter(self):
+        if self._reserve:
+            return self._iter_unreserved(filtered)
+
+        elif self._limit:
+            return iter(self._select_limited(filtered))
+
+        return filtered
+
+    def _iter_filtered(self):
         if self._limit and self._reserve:
             raise AttributeError('Setting both limit and reserve is too ambiguous.')
 
@@ -202,7 +316,12 @@ class DirectoryCleaner(object):
         else:
             self._target_dir = abspath(expandvars(expanduser(self._target_dir)))
 
-        filtered = self._grab_files(self._target_dir, self._recursive)
+        # ext and pattern are checked while crawling, so that rejected files are never stat()ed.
+        if self._archive is not None:
+            self._archive.reconcile()
+            filtered = self._archive.iter_files(self._target_dir, self._recursive, self._name_filter())
+        else:
+            filtered = self._grab_files(self._target_dir, self._recursive, self._name_filter())
 
         if self._datetime_after:
             self._datetime_after = self._interpret_datetime(self._datetime_after)
@@ -214,24 +333,55 @@ class DirectoryCleaner(object):
             timestamp = self._datetime_before.timestamp()
             filtered = filter(lambda x: x[1] < timestamp, filtered)
 
-        if self._target_ext:
-            filtered = filter(lambda x: splitext(x[0])[1] == self._target_ext, filtered)
+        return filtered
 
-        if self._pattern:
-            r = re_compile(self._pattern, self._pattern_flags)
-            filtered = filter(lambda x: r.search(x[0]) is not None, filtered)
+    def _select_limited(self, files):
+        """
+        heading limited number of files in order, as sorted()[:limit] would list them.
+        """
+        select = nlargest if self._order == 'desc' else nsmallest
+        return select(self._limit, files, key=self._sort_key())
 
-        self.target = list(filtered)
-        self.target.sort(
-            key=itemgetter(self.supported_orders.index(self._order_by)),
-            reverse=(self._order == 'desc')
-        )
+    def _sort_key(self):
+        return itemgetter(self.supported_orders.index(self._order_by))
 
-        if self._reserve:
-            self.target = self.target[self._reserve:]
+    def _iter_unreserved(self, files):
+        """
+        generate files except the heading reserved number of them, in the order.
 
-        elif self._limit:
-            self.target = self.target[:self._limit]
+        the heap keeps the reserved candidates, with the one to be left out first at its root.
+        ties are ordered as a stable sort does: of equal keys, the later file is left out first.
+        """
+        key = self._sort_key()
+        descending = self._order == 'desc'
+        heap = []
+        for seq, item in enumerate(files):
+            value = key(item)
+            if len(heap) < self._reserve:
+                heappush(heap, (value if descending else _Reversed(value), -seq, item))
+                continue
+
+            # most files go after the root: they are left out at once, without touching the heap.
+            root = heap[0][0]
+            if (value < root) if descending else (root.value < value):
+                yield item
+            else:
+                yield heappushpop(heap, (value if descending else _Reversed(value), -seq, item))[2]
+
+    def _name_filter(self):
+        """
+        ext and pattern as a predicate of a path, or None if both are not set.
+        """
+        ext = self._target_ext
+        r = re_compile(self._pattern, self._pattern_flags) if self._pattern else None
+
+        if not ext and not r:
+            return None
+
+        def accept(path):
+            return (not ext or splitext(path)[1] == ext) and (not r or r.search(path) is not None)
+
+        return accept
 
     @staticmethod
     def _interpret_datetime(value):
@@ -270,29 +420,78 @@ class DirectoryCleaner(object):
         return obj
 
     @staticmethod
-    def _grab_files(target_dir: str, recursive: bool):
+    def _grab_files(target_dir: str, recursive: bool, accept=None):
         """
-        crawl files from target directory.
+        crawl files from target directory, lazily.
         all files are abstract.
-        :param target_dir:
+
+        os.scandir() gives file types without stat(), and only accepted files are stat()ed.
+        Unreadable subdirectories are skipped, as os.walk() does. Files removed while crawling are skipped.
+        :param target_dir: absolute path.
         :param recursive:
-        :return:
+        :param accept:     callable(path) returns bool, or None to accept all.
+        :return:           generator of (path, mtime)
         """
-        target = []
-        if recursive:
-            for dir_path, _, file_names in walk(target_dir):
-                for file_name in file_names:
-                    # NOTE: tuple's order of item must match supported_orders
-                    path = abspath(path_join(dir_path, file_name))
-                    mtime = stat(path).st_mtime
-                    target.append((path, mtime))
-        else:
-            for item in listdir(target_dir):
-                path = abspath(path_join(target_dir, item))
-                if isfile(path):
-                    mtime = stat(path).st_mtime
-                    target.append((path, mtime))
-        return target
+        pending = [target_dir]
+        while pending:
+            dir_path = pending.pop()
+            try:
+                entries = scandir(dir_path)
+            except OSError:
+                if dir_path == target_dir:
+                    raise
+                continue
+            with entries:
+                for entry in entries:
+                    try:
+                        if recursive and entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif entry.is_file() and (accept is None or accept(entry.path)):
+                            # NOTE: tuple's order of item must match supported_orders
+                            yield entry.path, entry.stat().st_mtime
+                    except FileNotFoundError:
+                        continue
+
+
+def _remove_files(paths, dry_run=False):
+    """
+    unlink the files. returns a list of (path, size, OSError or None).
+    """
+    results = []
+    for path in paths:
+        try:
+            size = lstat(path).st_size
+            if not dry_run:
+                unlink(path)
+            results.append((path, size, None))
+        except OSError as e:
+            results.append((path, 0, e))
+    return results
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class _Reversed(object):
+    """
+    reverses the order of a value, for a min-heap to work as a max-heap.
+    """
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
 
 
 def check_connection(remote_server=None, timeout=2):
@@ -0,0 +1,96 @@
+"""
+Micro-benchmark: streaming playlist parsers against the BeautifulSoup ones.
+
+    python -m scripts.bench_playlist_parsers --rows 200 --repeat 50
+"""
+from argparse import ArgumentParser
+from timeit import repeat as timeit_repeat
+from tracemalloc import (
+    get_traced_memory,
+    start as tracemalloc_start,
+    stop as tracemalloc_stop,
+)
+
+from recorder.playlist import (
+    MBCRadioPlaylistListParser,
+    MBCRadioPlaylistListSoupParser,
+    MBCRadioPlaylistViewParser,
+    MBCRadioPlaylistViewSoupParser,
+)
+
+
+def make_view_page(rows, trailing=20000):
+    """
+    A playlist view page of 'rows' songs, followed by 'trailing' characters of the rest of the page.
+    """
+    trs = []
+    for i in range(1, rows + 1):
+        if i % 20 == 1:
+            trs.append('<tr><td colspan="5">%d부</td></tr>' % (i // 20 + 1))
+        trs.append('<tr><td>%d</td><td>%d</td><td>노래 제목 %d</td><td>가수 %d</td><td></td></tr>' % (i, i, i, i))
+    return (
+        '<html><head><meta charset="euc-kr"><title>선곡표</title></head><body>'
+        '<table class="list_tb">'
+        '<thead><tr><th>번호</th><th>순서</th><th>제목</th><th>가수</th><th>비고</th></tr></thead>'
+        '<tbody>%s</tbody></table>'
+        '<div class="footer">%s</div></body></html>'
+    ) % (''.join(trs), '<p>footer</p>' * (trailing // 13))
+
+
+def make_list_page(rows, trailing=20000):
+    trs = ''.join(
+        '<tr><td>2016-12-%02d</td><td><a href="SelectView.asp?SEQ_NO=%d">선곡표</a></td></tr>' % (i % 28 + 1, i)
+        for i in range(rows)
+    )
+    return (
+        '<html><head><meta charset="euc-kr"></head><body>'
+        '<table class="select_tb"><tbody>%s</tbody></table>'
+        '<div class="footer">%s</div></body></html>'
+    ) % (trs, '<p>footer</p>' * (trailing // 13))
+
+
+def measure(parser_class, page, chunk_size, repeat, number):
+    def parse():
+        parser = parser_class()
+        if chunk_size and hasattr(parser, 'feed_chunks'):
+            parser.feed_chunks(page[i:i + chunk_size] for i in range(0, len(page), chunk_size))
+        else:
+            parser.feed(page)
+        return parser
+
+    best = min(timeit_repeat(parse, repeat=repeat, number=number)) / number
+
+    tracemalloc_start()
+    parse()
+    peak = get_traced_memory()[1]
+    tracemalloc_stop()
+
+    return best, peak
+
+
+def main():
+    arg_parser = ArgumentParser(description='Compare playlist page parsers.')
+    arg_parser.add_argument('--rows', type=int, default=100, help='songs in a view page')
+    arg_parser.add_argument('--trailing', type=int, default=20000, help='characters after the table')
+    arg_parser.add_argument('--chunk-size', type=int, default=8192, help='0 to feed a page at once')
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    arg_parser.add_argument('--number', type=int, default=20)
+    args = arg_parser.parse_args()
+
+    cases = (
+        ('view', make_view_page(args.rows, args.trailing), MBCRadioPlaylistViewSoupParser, MBCRadioPlaylistViewParser),
+        ('list', make_list_page(args.rows, args.trailing), MBCRadioPlaylistListSoupParser, MBCRadioPlaylistListParser),
+    )
+
+    print('%-6s %-10s %12s %12s' % ('PAGE', 'PARSER', 'TIME (ms)', 'PEAK (KB)'))
+    print('-' * 44)
+    for name, page, soup_class, stream_class in cases:
+        soup_time, soup_peak = measure(soup_class, page, 0, args.repeat, args.number)
+        stream_time, stream_peak = measure(stream_class, page, args.chunk_size, args.repeat, args.number)
+        print('%-6s %-10s %12.3f %12.1f' % (name, 'soup', soup_time * 1000, soup_peak / 1024))
+        print('%-6s %-10s %12.3f %12.1f' % (name, 'stream', stream_time * 1000, stream_peak / 1024))
+        print('%-6s %-10s %11.1fx %11.1fx' % (name, 'speedup', soup_time / stream_time, soup_peak / stream_peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+"""
+Offline benchmark suite of the recording and tagging hot paths. Nothing is fetched from the network.
+
+    python -m scripts.benchmark --output bench-$(git rev-parse --short HEAD).json
+    python -m scripts.benchmark --only cleaner table --compare bench-1a2b3c4.json
+
+Groups:
+ - ffmpeg:  FFMpeg.insert_metadata, and in-place write_tags for comparison, on sample.mp3 scaled to --sizes MB.
+            insert_metadata is skipped when ffmpeg is not found.
+ - parsers: playlist page parsers on the stored fixture pages.
+ - table:   MBCRadioProgramTable.load on synthetic tables of --rows rows, from CSV and from the snapshot.
+ - cleaner: DirectoryCleaner.filter, iter_files, dry-run clean, and the same through an ArchiveIndex,
+            on a synthetic tree of --files files.
+
+Each case reports the best and the median seconds of --repeat runs. Files are created under a temporary
+ directory, so the OS page cache is warm: the numbers are of CPU and syscalls, not of disk reads.
+"""
+from argparse import ArgumentParser
+from datetime import (
+    datetime,
+    timedelta,
+)
+from json import (
+    dump as json_dump,
+    dumps as json_dumps,
+    load as json_load,
+)
+from os import (
+    makedirs,
+    utime,
+)
+from os.path import (
+    abspath,
+    dirname,
+    exists,
+    join as path_join,
+)
+from platform import (
+    platform,
+    python_version,
+)
+from shutil import rmtree
+from statistics import median
+from subprocess import (
+    CalledProcessError,
+    check_output,
+    DEVNULL,
+)
+from tempfile import mkdtemp
+from time import (
+    perf_counter,
+    time,
+)
+
+from recorder.archive import ArchiveIndex
+from recorder.backends import (
+    FFMpeg,
+    FFMPEG_PATH,
+)
+from recorder.playlist import (
+    MBCRadioPlaylistListParser,
+    MBCRadioPlaylistListSoupParser,
+    MBCRadioPlaylistViewParser,
+    MBCRadioPlaylistViewSoupParser,
+    MBCRadioProgramTable,
+)
+from recorder.tags import write_tags
+from recorder.utils import DirectoryCleaner
+
+project_path = dirname(dirname(abspath(__file__)))
+
+resource_path = path_join(project_path, 'recorder', 'resources')
+
+groups = ('ffmpeg', 'parsers', 'table', 'cleaner')
+
+
+def time_call(func, repeat, number=1):
+    """
+    Seconds per call of func(): the best and the median of 'repeat' runs of 'number' calls.
+    """
+    runs = []
+    for _ in range(repeat):
+        begin = perf_counter()
+        for _ in range(number):
+            func()
+        runs.append((perf_counter() - begin) / number)
+    return {'best': min(runs), 'median': median(runs), 'repeat': repeat, 'number': number}
+
+
+def result(group, name, params, timing=None, skipped=None):
+    item = {'group': group, 'name': name, 'params': params}
+    if skipped:
+        item['skipped'] = skipped
+    else:
+        item.update(timing)
+    return item
+
+
+def bench_ffmpeg(work_dir, sizes, repeat):
+    with open(path_join(resource_path, 'sample.mp3'), 'rb') as f:
+        sample = f.read()
+
+    ffmpeg = FFMpeg() if exists(FFMPEG_PATH) else None
+    metadata = {'title': 'Benchmark', 'artist': 'Almond', 'comment': '#01/02 a - b\n#02/02 c - d'}
+    results = []
+
+    for size in sizes:
+        # MP3 frames may simply be concatenated.
+        input_path = path_join(work_dir, 'input_%dmb.mp3' % size)
+        with open(input_path, 'wb') as f:
+            for _ in range(max(1, size * 1024 * 1024 // len(sample))):
+                f.write(sample)
+        params = {'size_mb': size}
+
+        if ffmpeg:
+            output_path = path_join(work_dir, 'output_%dmb.mp3' % size)
+            timing = time_call(lambda: ffmpeg.insert_metadata(input_path, metadata, output_path), repeat)
+            results.append(result('ffmpeg', 'insert_metadata', params, timing))
+        else:
+            results.append(result('ffmpeg', 'insert_metadata', params, skipped='ffmpeg not found'))
+
+        timing = time_call(lambda: write_tags(input_path, metadata), repeat)
+        results.append(result('ffmpeg', 'write_tags', params, timing))
+
+    return results
+
+
+def bench_parsers(repeat, number):
+    cases = (
+        ('list', 'playlist_list.html', MBCRadioPlaylistListSoupParser, MBCRadioPlaylistListParser),
+        ('view', 'playlist_view.html', MBCRadioPlaylistViewSoupParser, MBCRadioPlaylistViewParser),
+    )
+    results = []
+
+    for page, file_name, soup_class, stream_class in cases:
+        with open(path_join(resource_path, file_name), 'rb') as f:
+            text = f.read().decode('euc-kr')
+
+        for name, parser_class in (('soup', soup_class), ('stream', stream_class)):
+            timing = time_call(lambda: parser_class().feed(text), repeat, number)
+            results.append(result('parsers', name, {'page': page}, timing))
+
+    return results
+
+
+def write_synthetic_table(path, rows):
+    channels = ('mfm', 'sfm', 'chm')
+    with open(path, 'w') as f:
+        f.write('version: 1\n')
+        for i in range(1, rows + 1):
+            f.write('%d,mon-fri,%s,%02d:%02d,Show %d,show%d,play%d\n' % (
+                i, channels[i % 3], i // 60 % 24, i % 60, i, i, i
+            ))
+
+
+def bench_table(work_dir, rows_list, repeat):
+    results = []
+
+    for rows in rows_list:
+        table_path = path_join(work_dir, 'table_%d.csv' % rows)
+        write_synthetic_table(table_path, rows)
+        params = {'rows': rows}
+
+        table = MBCRadioProgramTable(table_path=table_path, use_snapshot=False)
+        results.append(result('table', 'load_csv', params, time_call(table.load, repeat)))
+
+        # the first load writes the snapshot.
+        table = MBCRadioProgramTable(table_path=table_path, use_snapshot=True)
+        results.append(result('table', 'load_snapshot', params, time_call(table.load, repeat)))
+
+    return results
+
+
+def make_tree(root, files, per_dir=1000):
+    """
+    Recordings in per_dir files a directory, a minute apart, half of them .m4a, half .mp3.
+    """
+    now = time()
+    for i in range(files):
+        dir_path = path_join(root, 'd%04d' % (i // per_dir))
+        if i % per_dir == 0:
+            makedirs(dir_path)
+        recorded = now - i * 60
+        path = path_join(dir_path, 'mfm_%s_%06d.%s' % (
+            datetime.fromtimestamp(recorded).strftime('%Y-%m-%d'), i, 'm4a' if i % 2 else 'mp3'
+        ))
+        with open(path, 'wb'):
+            pass
+        utime(path, (recorded, recorded))
+
+
+def bench_cleaner(work_dir, files, repeat):
+    root = path_join(work_dir, 'tree')
+    make_tree(root, files)
+
+    cases = (
+        ('all', lambda c: c),
+        ('ext', lambda c: c.ext('.m4a')),
+        ('pattern', lambda c: c.pattern(r'_2\d{3}-\d{2}-01_')),
+        ('before', lambda c: c.before(datetime.utcnow() - timedelta(days=30))),
+        ('reserve', lambda c: c.order_by('mtime').desc().reserve(100)),
+        ('limit', lambda c: c.order_by('name').asc().limit(100)),
+    )
+    results = []
+
+    for name, setup in cases:
+        def run():
+            setup(DirectoryCleaner().dir(root).recursive(True)).filter()
+        results.append(result('cleaner', name, {'files': files}, time_call(run, repeat)))
+
+    # what clean() goes through: files are not listed in order.
+    for name, setup in cases[-2:]:
+        def run():
+            for _ in setup(DirectoryCleaner().dir(root).recursive(True)).iter_files():
+                pass
+        results.append(result('cleaner', 'iter_' + name, {'files': files}, time_call(run, repeat)))
+
+    # the same selection from an ArchiveIndex: a reconcile() of unchanged directories, then an indexed query.
+    index = ArchiveIndex(root, path=path_join(work_dir, 'archive.sqlite'))
+    index.reconcile()
+    for name, setup in cases[-2:]:
+        def run():
+            setup(DirectoryCleaner().dir(root).recursive(True).index(index)).filter()
+        results.append(result('cleaner', 'index_' + name, {'files': files}, time_call(run, repeat)))
+    index.close()
+
+    # dry run: a stat() for each file, in threads.
+    for workers in (1, 8):
+        def run():
+            DirectoryCleaner().dir(root).recursive(True).ext('.m4a').clean(dry_run=True, workers=workers)
+        results.append(result('cleaner', 'clean_dry_run', {'files': files, 'workers': workers}, time_call(run, repeat)))
+
+    return results
+
+
+def git_commit():
+    try:
+        return check_output(['git', 'rev-parse', 'HEAD'], cwd=project_path, stderr=DEVNULL).decode().strip()
+    except (CalledProcessError, OSError):
+        return None
+
+
+def result_key(item):
+    return item['group'], item['name'], json_dumps(item['params'], sort_keys=True)
+
+
+def print_results(results, baseline=None):
+    previous = {result_key(x): x for x in baseline['results']} if baseline else {}
+
+    print('%-8s %-16s %-20s %12s %12s %9s' % ('GROUP', 'CASE', 'PARAMS', 'BEST (ms)', 'MEDIAN (ms)', 'CHANGE'))
+    print('-' * 82)
+    for item in results:
+        params = ','.join('%s=%s' % x for x in sorted(item['params'].items()))
+        if 'skipped' in item:
+            print('%-8s %-16s %-20s %s' % (item['group'], item['name'], params, 'skipped: ' + item['skipped']))
+            continue
+        old = previous.get(result_key(item))
+        change = '%+8.1f%%' % ((item['best'] / old['best'] - 1) * 100) if old and 'best' in old else ''
+        print('%-8s %-16s %-20s %12.3f %12.3f %9s' % (
+            item['group'], item['name'], params, item['best'] * 1000, item['median'] * 1000, change
+        ))
+
+
+def main():
+    arg_parser = ArgumentParser(description='Benchmark the recording and tagging hot paths.')
+    arg_parser.add_argument('--only', nargs='+', choices=groups, default=groups)
+    arg_parser.add_argument('--output', help='save results as JSON')
+    arg_parser.add_argument('--compare', help='JSON results of an earlier run')
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    arg_parser.add_argument('--number', type=int, default=20, help='calls a run, for the fast cases')
+    arg_parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 50], help='MB')
+    arg_parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    arg_parser.add_argument('--files', type=int, default=100000)
+    args = arg_parser.parse_args()
+
+    work_dir = mkdtemp(prefix='almond-bench-')
+    results = []
+    try:
+        if 'ffmpeg' in args.only:
+            results += bench_ffmpeg(work_dir, args.sizes, args.repeat)
+        if 'parsers' in args.only:
+            results += bench_parsers(args.repeat, args.number)
+        if 'table' in args.only:
+            results += bench_table(work_dir, args.rows, args.repeat)
+        if 'cleaner' in args.only:
+            results += bench_cleaner(work_dir, args.files, args.repeat)
+    finally:
+        rmtree(work_dir)
+
+    report = {
+        'commit': git_commit(),
+        'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': python_version(),
+        'platform': platform(),
+        'results': results,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json_load(f)
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json_dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()